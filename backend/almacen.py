@@ -0,0 +1,123 @@
+import os
+import uuid
+import hashlib
+
+import config
+import database
+
+# Almacén direccionado por contenido para las subidas (fotos y firmas).
+# Cada archivo vive en almacen/<2 primeros hex>/<sha256><ext> y lleva un contador de
+# referencias en la tabla `blobs`: dos tablets que suben "image_picker_123.jpg" no se pisan,
+# un reintento con los mismos bytes no ocupa espacio extra, y el archivo se borra cuando
+# el último trabajo que lo usa termina.
+
+TAM_BLOQUE = 1024 * 1024
+
+
+def ruta_blob(hash_hex, extension):
+    return os.path.join(config.ALMACEN_FOLDER, hash_hex[:2], f"{hash_hex}{extension}")
+
+def ruta_derivada(hash_hex, variante):
+    """Ruta para un derivado cacheado de un blob (p. ej. la foto normalizada para el PDF)."""
+    return os.path.join(config.ALMACEN_FOLDER, hash_hex[:2], f"{hash_hex}.{variante}.jpg")
+
+def _extension(nombre):
+    ext = os.path.splitext(nombre or "")[1].lower()
+    return ext if ext and len(ext) <= 6 else ".bin"
+
+def guardar_stream(archivo, nombre_original):
+    """
+    Copia `archivo` (objeto tipo file) al almacén calculando el SHA-256 mientras escribe.
+    Retorna (hash, ruta). Toma una referencia: hay que liberarla con `liberar`.
+    """
+    os.makedirs(os.path.join(config.ALMACEN_FOLDER, "tmp"), exist_ok=True)
+    temporal = os.path.join(config.ALMACEN_FOLDER, "tmp", uuid.uuid4().hex)
+    sha = hashlib.sha256()
+    tamano = 0
+    try:
+        with open(temporal, "wb") as destino:
+            while True:
+                bloque = archivo.read(TAM_BLOQUE)
+                if not bloque:
+                    break
+                sha.update(bloque)
+                destino.write(bloque)
+                tamano += len(bloque)
+        return registrar_archivo(temporal, sha.hexdigest(), tamano, _extension(nombre_original))
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+def registrar_archivo(temporal, hash_hex, tamano, extension):
+    """Mueve un archivo ya hasheado al almacén (o lo descarta si ya existía) y suma una referencia."""
+    ruta = ruta_blob(hash_hex, extension)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+
+    def mover(ruta_final):
+        # ruta_final puede ser la de un alta anterior (mismo contenido con otra extensión)
+        if os.path.exists(ruta_final):
+            os.remove(temporal)  # Mismo contenido ya guardado: dedupe
+        else:
+            os.replace(temporal, ruta_final)
+
+    ruta = database.referenciar_blob(hash_hex, ruta, tamano, mover)
+    return hash_hex, ruta
+
+def liberar(hashes):
+    """Suelta una referencia por hash; borra el archivo (y sus derivados) al llegar a cero."""
+    for hash_hex in hashes:
+        ruta = database.liberar_blob(hash_hex, _borrar_archivos)
+        if ruta:
+            print(f"   - Blob liberado: {hash_hex[:12]}")
+
+def _borrar_archivos(hash_hex, ruta):
+    carpeta = os.path.dirname(ruta)
+    for nombre in (os.listdir(carpeta) if os.path.isdir(carpeta) else []):
+        if nombre.startswith(hash_hex):
+            try:
+                os.remove(os.path.join(carpeta, nombre))
+            except OSError as e:
+                print(f"   ⚠️ Error borrando {nombre}: {e}")
+
+def referenciar(hash_hex):
+    """Suma una referencia a un blob existente. Retorna su ruta o None si no existe."""
+    # Búsqueda e incremento en la misma transacción: si otro lo libera entre medio, no
+    # se resucita una fila que apunta a un archivo ya borrado
+    return database.referenciar_blob_existente(hash_hex)
+
+# --- ARCHIVOS PARCIALES (subidas reanudables) ---
+
+def ruta_parcial(id_subida):
+    return os.path.join(config.ALMACEN_FOLDER, "tmp", f"subida_{id_subida}")
+
+def escribir_parcial(id_subida, offset, datos):
+    """Escribe `datos` en la posición `offset` del archivo parcial."""
+    ruta = ruta_parcial(id_subida)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with open(ruta, "r+b" if os.path.exists(ruta) else "wb") as f:
+        f.seek(offset)
+        f.write(datos)
+        f.truncate()
+
+def finalizar_parcial(id_subida, nombre, sha256_esperado):
+    """
+    Verifica el SHA-256 del parcial y lo mueve al almacén. Retorna (hash, ruta) o
+    (None, mensaje) si el checksum no coincide (el parcial queda tal cual; /finalizar lo descarta).
+    """
+    ruta = ruta_parcial(id_subida)
+    sha = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        while True:
+            bloque = f.read(TAM_BLOQUE)
+            if not bloque:
+                break
+            sha.update(bloque)
+    hash_hex = sha.hexdigest()
+    if sha256_esperado and sha256_esperado.lower() != hash_hex:
+        return None, f"Checksum no coincide (servidor: {hash_hex})"
+    return registrar_archivo(ruta, hash_hex, os.path.getsize(ruta), _extension(nombre))
+
+def descartar_parcial(id_subida):
+    ruta = ruta_parcial(id_subida)
+    if os.path.exists(ruta):
+        os.remove(ruta)
@@ -1,24 +1,74 @@
 import shutil
 import os
 import json
-from typing import List, Optional
-from datetime import datetime
-# IMPORTANTE: Agregamos BackgroundTasks para tareas en segundo plano
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
+import time
+import uuid
+import asyncio
+from typing import List, Optional, Tuple
+from datetime import datetime, timedelta
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import uvicorn
 
 import database
 import utils
-import pdf_generator
 import config
+import worker_reportes
+import ejecutores
+import metricas
+import backfill_lista as backfill_lista_sp
+import reenvio
+import imagenes
+import almacen
 
 app = FastAPI(title="Tecnocomp API")
 
 # Inicializamos la DB
 database.inicializar_db()
 
+# --- WORKERS DE LA COLA DE REPORTES ---
+_procesos_workers = []
+
+@app.on_event("startup")
+def iniciar_workers_reportes():
+    if config.WORKERS_REPORTES > 0:
+        _procesos_workers.extend(worker_reportes.iniciar_workers(config.WORKERS_REPORTES))
+        print(f"👷 {len(_procesos_workers)} workers de reportes lanzados")
+
+@app.on_event("startup")
+async def precalentar_graph():
+    if config.PRECALENTAR_GRAPH:
+        ok, msg = await ejecutores.en_hilo(utils.precalentar_graph)
+        print(f"🔥 Precalentado Graph: {msg}")
+
+@app.on_event("startup")
+def iniciar_reenvio():
+    if config.REENVIO_ACTIVO:
+        app.state.detener_reenvio = reenvio.iniciar_programador()
+
+@app.on_event("shutdown")
+def detener_workers_reportes():
+    worker_reportes.detener_workers(_procesos_workers)
+    if getattr(app.state, "detener_reenvio", None):
+        app.state.detener_reenvio.set()
+    ejecutores.cerrar()
+
+# --- MÉTRICAS: LAG DEL EVENT LOOP Y LATENCIA POR RUTA ---
+@app.on_event("startup")
+async def iniciar_monitor_lag():
+    app.state.monitor_lag = asyncio.create_task(metricas.monitorear_lag_event_loop())
+
+@app.middleware("http")
+async def medir_latencia(request: Request, call_next):
+    inicio = time.perf_counter()
+    response = await call_next(request)
+    ruta = request.scope.get("route")
+    nombre = ruta.path if ruta is not None else "otras"
+    metricas.observar(f"http {request.method} {nombre}", (time.perf_counter() - inicio) * 1000)
+    return response
+
 # --- MODELOS ---
 class ClienteBase(BaseModel):
     nombre: str
@@ -42,14 +92,8 @@ def get_tecnicos(): return database.obtener_tecnicos()
 # --- NUEVO: OBTENER TODOS LOS USUARIOS (Para sincronizar entre tablets) ---
 @app.get("/usuarios_todos")
 def get_all_usuarios():
-    # Conectamos directamente para sacar todo el listado global
-    con = database.conectar()
-    cur = con.cursor()
-    cur.execute("SELECT nombre, cliente_nombre FROM usuarios")
     # Formateamos como lista de diccionarios
-    datos = [{"nombre": row[0], "cliente": row[1]} for row in cur.fetchall()]
-    con.close()
-    return datos
+    return [{"nombre": row[0], "cliente": row[1]} for row in database.obtener_todos_usuarios()]
 
 @app.post("/clientes")
 def create_cliente(cliente: ClienteBase):
@@ -69,15 +113,155 @@ def create_tecnico(tecnico: TecnicoBase):
 # --- NUEVO: CREAR USUARIO ---
 @app.post("/usuarios")
 def create_usuario(usuario: UsuarioBase):
-    if database.agregar_usuario(usuario.nombre, usuario.cliente):
-        return {"status": "ok", "message": "Usuario creado"}
-    else:
-        return {"status": "ok", "message": "Usuario ya existía o error"}
+    # Con foreign_keys activo el INSERT falla si el cliente no existe: avisamos en vez de
+    # responder ok (la app sube los clientes antes que sus usuarios)
+    if not database.existe_cliente(usuario.cliente):
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    if not database.agregar_usuario(usuario.nombre, usuario.cliente):
+        raise HTTPException(status_code=500, detail="No se pudo guardar el usuario")
+    return {"status": "ok", "message": "Usuario creado o ya existente"}
 
 @app.get("/usuarios/{cliente_nombre}")
 def get_usuarios(cliente_nombre: str):
     return database.obtener_usuarios_por_cliente(cliente_nombre)
 
+# --- LISTADO DE REPORTES (paginado) ---
+# Campos por defecto: todo menos los JSON pesados (detalles_usuarios, imagen_path)
+_CAMPOS_LISTADO_DEFECTO = [c for c in database.COLUMNAS_LISTADO if c not in database.COLUMNAS_JSON]
+_LOTE_LISTADO = 100
+
+def _validar_fecha(valor, nombre):
+    if valor is None: return None
+    try:
+        return datetime.strptime(valor, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{nombre} debe ser YYYY-MM-DD")
+
+@app.get("/reportes")
+async def listar_reportes(
+    limite: int = 50,
+    cursor: Optional[int] = None,
+    cliente: Optional[str] = None,
+    tecnico: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    email_enviado: Optional[int] = None,
+    fields: Optional[str] = None,
+):
+    """
+    Reportes del más nuevo al más antiguo, de a `limite` (máx. 500).
+    - `cursor`: el `next_cursor` de la página anterior (null en la última).
+    - `fields`: columnas separadas por coma; detalles_usuarios e imagen_path sólo si se piden.
+    La respuesta se arma y envía por lotes, así la memoria no depende del tamaño de página.
+    """
+    if not 1 <= limite <= 500:
+        raise HTTPException(status_code=400, detail="limite debe estar entre 1 y 500")
+    campos = [c.strip() for c in fields.split(",") if c.strip()] if fields else list(_CAMPOS_LISTADO_DEFECTO)
+    invalidos = [c for c in campos if c not in database.COLUMNAS_LISTADO]
+    if invalidos:
+        raise HTTPException(status_code=400, detail=f"Campos desconocidos: {', '.join(invalidos)}")
+    # El id siempre va primero: es el cursor
+    columnas = ["id"] + [c for c in campos if c != "id"]
+    desde_ts, hasta_ts = _rango_epoch(desde, hasta)
+    filtros = {
+        "cliente": cliente, "tecnico": tecnico, "email_enviado": email_enviado,
+        "desde_ts": desde_ts, "hasta_ts": hasta_ts,
+    }
+
+    async def generar():
+        yield '{"items": ['
+        ultimo, entregados = cursor, 0
+        while entregados < limite:
+            lote = min(_LOTE_LISTADO, limite - entregados)
+            filas = await ejecutores.en_hilo(database.listar_reportes, columnas, ultimo, lote, **filtros)
+            for fila in filas:
+                item = dict(zip(columnas, fila))
+                for col in database.COLUMNAS_JSON:
+                    if item.get(col):
+                        try: item[col] = json.loads(item[col])
+                        except ValueError: pass
+                yield ("," if entregados else "") + json.dumps(item, ensure_ascii=False)
+                entregados += 1
+            if len(filas) < lote:
+                ultimo = None  # No hay más
+                break
+            ultimo = filas[-1][0]
+        yield f'], "next_cursor": {json.dumps(ultimo if entregados == limite else None)}}}'
+
+    return StreamingResponse(generar(), media_type="application/json")
+
+@app.get("/reportes/buscar")
+def buscar_reportes(
+    q: str,
+    cliente: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    prefijo: bool = False,
+    limite: int = 20,
+):
+    """
+    Búsqueda de texto en observaciones y en el trabajo y motivo de cada usuario.
+    Todos los términos deben aparecer; "tone*" busca por prefijo (o `prefijo=true` para el último).
+    Resultados por relevancia, con un extracto y los términos marcados entre [ ].
+    """
+    consulta = database.consulta_fts(q, prefijo)
+    if not consulta:
+        raise HTTPException(status_code=400, detail="La búsqueda está vacía")
+    desde_ts, hasta_ts = _rango_epoch(desde, hasta)
+    filas = database.buscar_reportes(consulta, cliente, desde_ts, hasta_ts, min(max(limite, 1), 200))
+    return [
+        {"id": i, "fecha": f, "cliente": c, "tecnico": t, "extracto": s, "puntaje": round(p, 3)}
+        for i, f, c, t, s, p in filas
+    ]
+
+_RADIO_MAX_M = 500_000
+
+@app.get("/reportes/cerca")
+def reportes_cerca(
+    lat: Optional[float] = None,
+    lon: Optional[float] = None,
+    radio_m: Optional[float] = None,
+    lat_min: Optional[float] = None,
+    lat_max: Optional[float] = None,
+    lon_min: Optional[float] = None,
+    lon_max: Optional[float] = None,
+    cliente: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    limite: int = 100,
+):
+    """
+    Visitas cercanas, de la más cercana a la más lejana:
+    - `lat`, `lon` y `radio_m`: dentro de un radio (metros).
+    - `lat_min`, `lat_max`, `lon_min`, `lon_max`: dentro de una caja (ordenadas por distancia a
+      `lat`/`lon` si se dan, si no al centro de la caja).
+    """
+    caja = (lat_min, lat_max, lon_min, lon_max)
+    if all(v is not None for v in caja):
+        if not (database.coordenadas(lat_min, lon_min) and database.coordenadas(lat_max, lon_max)
+                and lat_min <= lat_max and lon_min <= lon_max):
+            raise HTTPException(status_code=400, detail="Caja inválida")
+        centro = database.coordenadas(lat, lon) or ((lat_min + lat_max) / 2, (lon_min + lon_max) / 2)
+        radio_m = None
+        cajas = [caja]
+    elif any(v is not None for v in caja):
+        raise HTTPException(status_code=400, detail="La caja necesita lat_min, lat_max, lon_min y lon_max")
+    else:
+        centro = database.coordenadas(lat, lon)
+        if not centro or radio_m is None:
+            raise HTTPException(status_code=400, detail="Indique lat, lon y radio_m, o una caja")
+        if not 0 < radio_m <= _RADIO_MAX_M:
+            raise HTTPException(status_code=400, detail=f"radio_m debe estar entre 0 y {_RADIO_MAX_M}")
+        cajas = database.caja_radio(centro[0], centro[1], radio_m)
+
+    desde_ts, hasta_ts = _rango_epoch(desde, hasta)
+    filas = database.reportes_cerca(centro[0], centro[1], cajas, radio_m, cliente, desde_ts, hasta_ts,
+                                    min(max(limite, 1), 1000))
+    return [
+        {"id": i, "fecha": f, "cliente": c, "tecnico": t, "lat": la, "lon": lo, "distancia_m": round(d, 1)}
+        for i, f, c, t, la, lo, d in filas
+    ]
+
 # --- ENDPOINT DE BACKUP MANUAL ---
 @app.get("/sistema/backup")
 def forzar_backup():
@@ -87,46 +271,134 @@ def forzar_backup():
     ok, msg = utils.subir_backup_database()
     return {"status": "ok" if ok else "error", "mensaje": msg}
 
-# --- FUNCIÓN DE LIMPIEZA (Se ejecuta después de responder) ---
-def eliminar_archivos_temporales(rutas: List[str]):
-    print(f"🧹 Iniciando limpieza de {len(rutas)} archivos temporales...")
-    for ruta in rutas:
-        try:
-            if os.path.exists(ruta):
-                os.remove(ruta)
-                print(f"   - Borrado: {ruta}")
-        except Exception as e:
-            print(f"   ⚠️ Error borrando {ruta}: {e}")
+@app.post("/sistema/backfill_lista")
+def backfill_lista(dry_run: bool = False):
+    """
+    Crea los items de la Lista de SharePoint que faltan (reportes antiguos), vía $batch.
+    Con dry_run=true sólo cuenta cuántos faltan.
+    """
+    return backfill_lista_sp.backfill_items_lista(dry_run=dry_run)
+
+@app.get("/sistema/metricas")
+def ver_metricas():
+    """
+    Contadores y percentiles (ms) del proceso API, incluido el lag del event loop.
+    `render` resume los últimos PDFs generados por los workers (tiempo, páginas, tamaño).
+    """
+    reenvio.actualizar_metricas_pendientes()
+    datos = metricas.instantanea()
+    stats = [r['pdf_stats'] for r in database.obtener_resultados_recientes(worker_reportes.TIPO_REPORTE) if r.get('pdf_stats')]
+    datos["render"] = {campo: metricas.resumir([s[campo] for s in stats]) for campo in ("ms", "paginas", "bytes")}
+    datos["render"]["cola"] = database.contar_trabajos_activos(worker_reportes.TIPO_REPORTE)
+    return datos
+
+# Rango por defecto de /metricas/serie según el período (días hacia atrás desde `hasta`; mes: ver abajo)
+_DIAS_SERIE_DEFECTO = {"dia": 29, "semana": 7 * 11, "mes": 0}
+_DIAS_SERIE_MAX = 3660
+
+@app.get("/metricas/serie")
+def ver_serie(
+    periodo: str = "dia",
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    cliente: Optional[str] = None,
+    tecnico: Optional[str] = None,
+):
+    """
+    Reportes por día, semana (clave = lunes) o mes, en hora de Chile, entre `desde` y
+    `hasta` (YYYY-MM-DD, inclusive). Los períodos sin reportes aparecen con 0.
+    """
+    if periodo not in _DIAS_SERIE_DEFECTO:
+        raise HTTPException(status_code=400, detail="periodo debe ser dia, semana o mes")
+    hoy = utils.obtener_hora_chile().date()
+    dia_hasta = datetime.strptime(_validar_fecha(hasta, "hasta"), "%Y-%m-%d").date() if hasta else hoy
+    dia_desde = (datetime.strptime(_validar_fecha(desde, "desde"), "%Y-%m-%d").date() if desde
+                 else dia_hasta - timedelta(days=_DIAS_SERIE_DEFECTO[periodo]))
+    if periodo == "mes" and not desde:
+        # Los últimos 12 meses, contando el de `hasta`, desde el día 1
+        mes = dia_hasta.year * 12 + dia_hasta.month - 1 - 11
+        dia_desde = dia_hasta.replace(year=mes // 12, month=mes % 12 + 1, day=1)
+    dias = (dia_hasta - dia_desde).days + 1
+    if not 1 <= dias <= _DIAS_SERIE_MAX:
+        raise HTTPException(status_code=400, detail=f"El rango debe tener entre 1 y {_DIAS_SERIE_MAX} días")
+
+    filas = dict(database.obtener_serie_temporal(
+        periodo, database.dia_a_epoch(dia_desde), database.dia_a_epoch(dia_hasta + timedelta(days=1)),
+        cliente=cliente, tecnico=tecnico))
+    # Todos los períodos del rango, también los vacíos (el gráfico no debe saltárselos)
+    claves = dict.fromkeys(
+        database.periodo_local(database.dia_a_epoch(dia_desde + timedelta(days=i)), periodo) for i in range(dias))
+    return {
+        "periodo": periodo,
+        "desde": dia_desde.isoformat(),
+        "hasta": dia_hasta.isoformat(),
+        "serie": [{"periodo": clave, "reportes": filas.get(clave, 0)} for clave in claves],
+    }
+
+def _rango_epoch(desde, hasta):
+    """desde/hasta 'YYYY-MM-DD' (inclusive, hora de Chile) -> (desde_ts, hasta_ts) para fecha_ts."""
+    desde_ts = hasta_ts = None
+    if desde:
+        desde_ts = database.dia_a_epoch(datetime.strptime(_validar_fecha(desde, "desde"), "%Y-%m-%d").date())
+    if hasta:
+        dia = datetime.strptime(_validar_fecha(hasta, "hasta"), "%Y-%m-%d").date() + timedelta(days=1)
+        hasta_ts = database.dia_a_epoch(dia)
+    return desde_ts, hasta_ts
+
+@app.get("/metricas/usuarios_no_atendidos")
+def ver_usuarios_no_atendidos(
+    cliente: Optional[str] = None,
+    nombre: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    limite: int = 50,
+):
+    """Usuarios con más visitas en que no fueron atendidos (con su total de visitas)."""
+    desde_ts, hasta_ts = _rango_epoch(desde, hasta)
+    filas = database.obtener_usuarios_no_atendidos(cliente, nombre, desde_ts, hasta_ts, min(max(limite, 1), 500))
+    return [
+        {"cliente": c, "nombre": n, "visitas": v, "no_atendido": na, "tasa": round(na / v, 3)}
+        for c, n, v, na in filas
+    ]
+
+@app.get("/metricas/tareas_omitidas")
+def ver_tareas_omitidas(cliente: Optional[str] = None, desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Tareas del checklist (config.TAREAS_MANTENIMIENTO) ordenadas por cuántas veces se omitieron."""
+    desde_ts, hasta_ts = _rango_epoch(desde, hasta)
+    filas = database.obtener_tareas_omitidas(config.TAREAS_MANTENIMIENTO, cliente, desde_ts, hasta_ts)
+    return [{"tarea": t, "omitida": o, "realizada": r} for t, o, r in filas]
+
+@app.post("/sistema/reconstruir_kpis")
+def reconstruir_kpis():
+    """Recalcula los contadores de /metricas desde reportes. Retorna cuántos estaban desviados."""
+    return {"status": "ok", "corregidos": database.reconstruir_kpis()}
+
+_MESES_KPI_MAX = 120
+
+@app.get("/metricas")
+def ver_kpis(meses: int = Query(12, ge=1, le=_MESES_KPI_MAX)):
+    """KPIs del panel (totales, por cliente, técnico, mes y estado de correo) desde los contadores."""
+    total, pendientes, cliente_top = database.obtener_kpis_generales()
+    resumen = database.obtener_resumen_kpis(meses=meses)
+    return {
+        "total": total,
+        "pendientes_email": pendientes,
+        "cliente_top": cliente_top,
+        "por_cliente": [{"cliente": c, "reportes": n} for c, n in resumen["cliente"]],
+        "por_tecnico": [{"tecnico": t, "reportes": n} for t, n in resumen["tecnico"]],
+        "por_mes": [{"mes": m, "reportes": n} for m, n in reversed(resumen["mes"])],
+        "por_estado_email": {({"1": "enviado", "0": "pendiente", "-1": "fallido"}.get(e) or e or "sin_estado"): n
+                             for e, n in resumen["email"]},
+    }
 
 # --- ENDPOINTS DE BORRADO ---
 
 @app.delete("/reporte/{reporte_id}")
 def borrar_reporte(reporte_id: int):
-    try:
-        # Nota: Asegúrate de que database.eliminar_reporte exista o usa una query directa
-        # Si no tienes la función en database.py, puedes descomentar esto:
-        # con = database.conectar()
-        # con.execute("DELETE FROM reportes WHERE id = ?", (reporte_id,))
-        # con.commit()
-        # con.close()
-        # return {"status": "ok"}
-        
-        # Asumiendo que existe o usando una genérica:
-        con = database.conectar()
-        cur = con.cursor()
-        cur.execute("DELETE FROM reportes WHERE id = ?", (reporte_id,))
-        filas = cur.rowcount
-        con.commit()
-        con.close()
-        
-        if filas > 0:
-            return {"status": "ok", "message": "Eliminado correctamente"}
-        else:
-            raise HTTPException(status_code=404, detail="Reporte no encontrado")
-            
-    except Exception as e:
-        print(f"Error borrando reporte: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    # eliminar_reporte registra el error y retorna False si falla
+    if database.eliminar_reporte(reporte_id):
+        return {"status": "ok", "message": "Eliminado correctamente"}
+    raise HTTPException(status_code=404, detail="Reporte no encontrado")
 
 @app.delete("/cliente/{nombre}")
 def borrar_cliente(nombre: str):
@@ -154,53 +426,263 @@ def borrar_usuario(cliente: str, nombre: str):
     raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
 
-@app.post("/reporte/crear")
+# --- SUBIDAS REANUDABLES (fotos y firmas desde conexiones inestables) ---
+# 1. POST /subidas -> id    2. PUT /subidas/{id} con Content-Range (se puede repetir)
+# 3. GET /subidas/{id} para saber el offset tras reconectar    4. POST /subidas/{id}/finalizar con sha256
+# Luego /reporte/crear recibe los ids en vez de los archivos.
+
+class SubidaNueva(BaseModel):
+    nombre: str = ""
+    tamano: Optional[int] = None
+
+class SubidaFinalizar(BaseModel):
+    sha256: str
+
+def _purgar_subidas_vencidas():
+    for subida in database.obtener_subidas_vencidas(time.time() - config.SUBIDA_TTL_SEGUNDOS):
+        if subida['estado'] == 'completa' and subida['hash']:
+            almacen.liberar([subida['hash']])
+        else:
+            almacen.descartar_parcial(subida['id'])
+        database.eliminar_subida(subida['id'])
+
+def _estado_subida(id_subida: str) -> dict:
+    subida = database.obtener_subida(id_subida)
+    if not subida:
+        raise HTTPException(status_code=404, detail="Subida no encontrada")
+    return subida
+
+@app.post("/subidas", status_code=201)
+async def crear_subida(datos: SubidaNueva):
+    if datos.tamano is not None and datos.tamano > config.SUBIDA_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+    await ejecutores.en_hilo(_purgar_subidas_vencidas)
+    id_subida = uuid.uuid4().hex
+    await ejecutores.en_hilo(database.crear_subida, id_subida, os.path.basename(datos.nombre), datos.tamano)
+    return {"id": id_subida, "offset": 0}
+
+@app.get("/subidas/{id_subida}")
+def ver_subida(id_subida: str):
+    s = _estado_subida(id_subida)
+    return {"id": s['id'], "offset": s['offset'], "tamano": s['tamano_total'], "estado": s['estado'], "hash": s['hash']}
+
+@app.put("/subidas/{id_subida}")
+async def subir_rango(id_subida: str, request: Request):
+    """
+    Recibe un rango de bytes. `Content-Range: bytes <inicio>-<fin>/<total|*>`; el inicio debe
+    coincidir con el offset actual (si no, 409 con el offset correcto para reanudar).
+    El PUT toma el bloqueo de escritura de la subida antes de tocar el parcial (un segundo
+    PUT concurrente recibe 409) y el offset avanza a medida que se escribe, así una conexión
+    cortada conserva lo recibido.
+    """
+    subida = await ejecutores.en_hilo(_estado_subida, id_subida)
+    if subida['estado'] != 'abierta':
+        raise HTTPException(status_code=409, detail={"mensaje": "Subida ya finalizada", "offset": subida['offset']})
+
+    inicio, total = subida['offset'], subida['tamano_total']
+    rango = request.headers.get("content-range")
+    if rango:
+        try:
+            unidad, resto = rango.split(" ", 1)
+            bytes_rango, total_txt = resto.split("/")
+            inicio = int(bytes_rango.split("-")[0])
+            total = None if total_txt.strip() == "*" else int(total_txt)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Content-Range inválido")
+        if unidad.strip().lower() != "bytes":
+            raise HTTPException(status_code=400, detail="Content-Range debe usar la unidad bytes")
+    if inicio != subida['offset']:
+        raise HTTPException(status_code=409, detail={"mensaje": "Offset incorrecto", "offset": subida['offset']})
+
+    escritor = uuid.uuid4().hex
+    if not await ejecutores.en_hilo(database.reclamar_escritura_subida, id_subida, escritor, inicio,
+                                    config.SUBIDA_BLOQUEO_SEGUNDOS):
+        raise HTTPException(status_code=409, detail="Otra petición está escribiendo esta subida")
+
+    offset = inicio
+    buffer = bytearray()
+    async def volcar():
+        nonlocal offset
+        if not buffer: return
+        if offset + len(buffer) > config.SUBIDA_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+        # Renovar antes de escribir: si el bloqueo venció y otro PUT lo tomó, no se pisa su parcial
+        if not await ejecutores.en_hilo(database.renovar_escritura_subida, id_subida, escritor,
+                                        config.SUBIDA_BLOQUEO_SEGUNDOS):
+            raise HTTPException(status_code=409, detail="Otra petición está escribiendo esta subida")
+        await ejecutores.en_hilo(almacen.escribir_parcial, id_subida, offset, bytes(buffer))
+        if not await ejecutores.en_hilo(database.avanzar_subida, id_subida, escritor, offset, offset + len(buffer), total):
+            raise HTTPException(status_code=409, detail="Otra petición está escribiendo esta subida")
+        offset += len(buffer)
+        buffer.clear()
+
+    try:
+        async for trozo in request.stream():
+            buffer.extend(trozo)
+            if len(buffer) >= 256 * 1024:
+                await volcar()
+        await volcar()
+    finally:
+        await ejecutores.en_hilo(database.liberar_escritura_subida, id_subida, escritor)
+    return {"id": id_subida, "offset": offset, "tamano": total}
+
+@app.post("/subidas/{id_subida}/finalizar")
+async def finalizar_subida(id_subida: str, datos: SubidaFinalizar):
+    subida = await ejecutores.en_hilo(_estado_subida, id_subida)
+    if subida['estado'] == 'completa':
+        return {"id": id_subida, "estado": "completa", "hash": subida['hash']}
+    if subida['tamano_total'] is not None and subida['offset'] != subida['tamano_total']:
+        raise HTTPException(status_code=409, detail={"mensaje": "Faltan bytes", "offset": subida['offset']})
+    # Con el bloqueo de escritura ningún PUT toca el parcial mientras se verifica
+    escritor = uuid.uuid4().hex
+    if not await ejecutores.en_hilo(database.reclamar_escritura_subida, id_subida, escritor, subida['offset'],
+                                    config.SUBIDA_BLOQUEO_SEGUNDOS):
+        raise HTTPException(status_code=409, detail="Otra petición está escribiendo esta subida")
+    try:
+        hash_hex, _ = await ejecutores.en_hilo(almacen.finalizar_parcial, id_subida, subida['nombre'], datos.sha256)
+        if hash_hex is None:
+            # El parcial no sirve: se descarta y el cliente vuelve a subir desde el byte 0
+            await ejecutores.en_hilo(almacen.descartar_parcial, id_subida)
+            await ejecutores.en_hilo(database.reiniciar_subida, id_subida, escritor)
+            raise HTTPException(status_code=422, detail={"mensaje": "El checksum no coincide; vuelva a subir el archivo",
+                                                         "offset": 0})
+        await ejecutores.en_hilo(database.completar_subida, id_subida, hash_hex)
+    finally:
+        await ejecutores.en_hilo(database.liberar_escritura_subida, id_subida, escritor)
+    return {"id": id_subida, "estado": "completa", "hash": hash_hex}
+
+async def _esperar_todas(tareas) -> list:
+    """
+    Como asyncio.gather, pero si una tarea falla espera igual a las demás antes de relanzar
+    el primer error: así `blobs` ya tiene todas las referencias tomadas cuando se liberan.
+    """
+    resultados = await asyncio.gather(*tareas, return_exceptions=True)
+    for r in resultados:
+        if isinstance(r, BaseException):
+            raise r
+    return resultados
+
+def _guardar_subida(upload: UploadFile, blobs: List[str]) -> Tuple[str, str]:
+    """Guarda la subida en el almacén por contenido y anota su hash (referencia a liberar)."""
+    hash_hex, ruta = almacen.guardar_stream(upload.file, os.path.basename(upload.filename or ""))
+    blobs.append(hash_hex)
+    return hash_hex, ruta
+
+async def _guardar_y_normalizar_foto(foto: UploadFile, blobs: List[str]) -> dict:
+    hash_hex, ruta = await ejecutores.en_hilo(_guardar_subida, foto, blobs)
+    return await _normalizar_foto(hash_hex, ruta)
+
+def _tomar_subida(id_subida: str, blobs: List[str]) -> Tuple[str, str]:
+    """Referencia el blob de una subida reanudable ya finalizada. Retorna (hash, ruta)."""
+    subida = database.obtener_subida(id_subida)
+    if not subida or subida['estado'] != 'completa':
+        raise HTTPException(status_code=400, detail=f"La subida {id_subida} no existe o no está finalizada")
+    ruta = almacen.referenciar(subida['hash'])
+    if not ruta:
+        raise HTTPException(status_code=410, detail=f"El archivo de la subida {id_subida} ya no existe")
+    blobs.append(subida['hash'])
+    return subida['hash'], ruta
+
+async def _tomar_y_normalizar_subida(id_subida: str, blobs: List[str]) -> dict:
+    hash_hex, ruta = await ejecutores.en_hilo(_tomar_subida, id_subida, blobs)
+    return await _normalizar_foto(hash_hex, ruta)
+
+async def _normalizar_foto(hash_hex: str, ruta: str) -> dict:
+    # La versión normalizada se cachea junto al blob: una foto repetida no se vuelve a procesar
+    destino = almacen.ruta_derivada(hash_hex, "pdf")
+    stats = await ejecutores.en_proceso(imagenes.normalizar_imagen, ruta, destino=destino)
+    metricas.observar("imagen_normalizar_ms", stats['ms'])
+    metricas.incrementar("imagen_bytes_ahorrados", stats['bytes_antes'] - stats['bytes_despues'])
+    print(f"🖼️ {hash_hex[:12]}: {stats['bytes_antes']} -> {stats['bytes_despues']} bytes en {stats['ms']} ms")
+    return stats
+
+@app.post("/reporte/crear", status_code=202)
 async def crear_reporte(
-    background_tasks: BackgroundTasks, 
     cliente: str = Form(...),
     tecnico: str = Form(...),
     obs: str = Form(""),
     datos_usuarios: str = Form(...), 
     email_cliente: str = Form(None), 
     email_tecnico: str = Form(None),
+    latitud: str = Form(None),
+    longitud: str = Form(None),
     firma_tecnico: UploadFile = File(None),
     fotos: List[UploadFile] = File(None),
-    firmas_usuarios: List[UploadFile] = File(None) 
+    firmas_usuarios: List[UploadFile] = File(None),
+    subidas_fotos: str = Form(None),
+    subidas_firmas: str = Form(None),
+    idempotency_key: str = Form(None),
+    idempotency_header: str = Header(None, alias="Idempotency-Key")
 ):
-    
-    archivos_para_borrar = []
+    """
+    Persiste las subidas y encola el trabajo. El PDF, SharePoint, la lista, el correo
+    y el registro en BD los hace worker_reportes.py; el estado se consulta en /reporte/job/{id}.
+
+    Con Idempotency-Key (header o campo de formulario) un reintento del cliente devuelve
+    el trabajo original en vez de generar otro PDF, otro correo y otra fila.
+
+    En vez de adjuntar los archivos, el cliente puede subirlos antes por /subidas y mandar
+    `subidas_fotos` (lista JSON de ids, en orden) y `subidas_firmas` (JSON {nombre_firma: id}).
+    """
+    clave = idempotency_header or idempotency_key
+    if clave:
+        job_previo = await _reclamar_idempotencia(clave)
+        if job_previo is not None:
+            return await ejecutores.en_hilo(_respuesta_trabajo, job_previo, True)
+
+    # Cola acotada: si los workers van atrasados, el cliente reintenta más tarde (su
+    # reporte sigue guardado en el teléfono) en vez de acumular PDFs sin procesar
+    activos = await ejecutores.en_hilo(database.contar_trabajos_activos, worker_reportes.TIPO_REPORTE)
+    if activos >= config.COLA_MAX_TRABAJOS:
+        metricas.incrementar("cola_llena")
+        if clave:
+            await ejecutores.en_hilo(database.liberar_clave_idempotencia, clave)
+        raise HTTPException(status_code=503, detail="Cola de reportes llena, reintente en unos minutos",
+                            headers={"Retry-After": "60"})
+
+    carpeta_trabajo = None
+    blobs = []
 
     try:
+        # Todo lo bloqueante (sqlite3, disco) va al ejecutor de I/O para no congelar el event loop.
         # 0. Actualizar email
         if email_cliente:
-            database.agregar_cliente(cliente, email_cliente)
+            await ejecutores.en_hilo(database.agregar_cliente, cliente, email_cliente)
             config.CORREOS_POR_CLIENTE[cliente] = email_cliente
 
         usuarios_parsed = json.loads(datos_usuarios)
-        temp_dir = config.TEMP_FOLDER
-        if not os.path.exists(temp_dir): os.makedirs(temp_dir)
+        # Cada trabajo tiene su propia carpeta persistente para el PDF (el worker la borra al terminar)
+        carpeta_trabajo = os.path.join(config.TRABAJOS_FOLDER, uuid.uuid4().hex)
+        await ejecutores.en_hilo(os.makedirs, carpeta_trabajo)
 
-        # 1. Guardar Fotos
+        # 1. Guardar Fotos en el almacén por contenido (cada una se normaliza en el pool de
+        #    procesos apenas queda en disco, mientras se siguen escribiendo las demás)
         rutas_fotos_servidor = []
+        normalizacion = []
         if fotos:
-            for foto in fotos:
-                clean_name = os.path.basename(foto.filename)
-                ruta_dest = f"{temp_dir}/{clean_name}"
-                with open(ruta_dest, "wb") as buffer:
-                    shutil.copyfileobj(foto.file, buffer)
-                rutas_fotos_servidor.append(os.path.abspath(ruta_dest))
-                archivos_para_borrar.append(os.path.abspath(ruta_dest))
-
-        # 2. Guardar Firmas
+            normalizacion = await _esperar_todas([
+                _guardar_y_normalizar_foto(foto, blobs) for foto in fotos
+            ])
+            rutas_fotos_servidor = [n['ruta'] for n in normalizacion]
+        if subidas_fotos:
+            normalizacion_subidas = await _esperar_todas([
+                _tomar_y_normalizar_subida(id_subida, blobs) for id_subida in json.loads(subidas_fotos)
+            ])
+            normalizacion += normalizacion_subidas
+            rutas_fotos_servidor += [n['ruta'] for n in normalizacion_subidas]
+
+        # 2. Guardar Firmas (el nombre que manda la tablet sólo sirve para emparejarlas)
         rutas_firmas_servidor = {} 
         if firmas_usuarios:
-            for firma in firmas_usuarios:
-                clean_name = os.path.basename(firma.filename)
-                ruta_dest = f"{temp_dir}/{clean_name}"
-                with open(ruta_dest, "wb") as buffer:
-                    shutil.copyfileobj(firma.file, buffer)
-                rutas_firmas_servidor[clean_name] = os.path.abspath(ruta_dest)
-                archivos_para_borrar.append(os.path.abspath(ruta_dest))
+            guardadas = await _esperar_todas([
+                ejecutores.en_hilo(_guardar_subida, firma, blobs) for firma in firmas_usuarios
+            ])
+            for firma, (_, ruta) in zip(firmas_usuarios, guardadas):
+                rutas_firmas_servidor[os.path.basename(firma.filename)] = ruta
+        if subidas_firmas:
+            for nombre_firma, id_subida in json.loads(subidas_firmas).items():
+                _, ruta = await ejecutores.en_hilo(_tomar_subida, id_subida, blobs)
+                rutas_firmas_servidor[os.path.basename(nombre_firma)] = ruta
 
         # 3. Mapear rutas
         contador_fotos = 0
@@ -213,6 +695,20 @@ async def crear_reporte(
                         contador_fotos += 1
                 usuario['fotos'] = nuevas_rutas
             
+            if usuario.get('firma_trazos'):
+                # Firma como trazos: se simplifica aquí y el PDF la dibuja como vector.
+                # La simplificación es CPU pura: va al pool de procesos, no al event loop.
+                try:
+                    usuario['firma_trazos'] = await ejecutores.en_proceso(utils.normalizar_trazos, usuario['firma_trazos'])
+                    if usuario.get('firma_lienzo') is not None:
+                        ancho, alto = (float(v) for v in usuario['firma_lienzo'])
+                        if ancho <= 0 or alto <= 0:
+                            raise ValueError("Lienzo inválido")
+                        usuario['firma_lienzo'] = [ancho, alto]
+                except (TypeError, ValueError):
+                    usuario.pop('firma_trazos')
+                    usuario.pop('firma_lienzo', None)
+
             if 'firma' in usuario and usuario['firma']:
                 nombre_archivo = os.path.basename(usuario['firma'])
                 if nombre_archivo in rutas_firmas_servidor:
@@ -220,67 +716,103 @@ async def crear_reporte(
                 else:
                     usuario['firma'] = None
 
-        # 4. Generar PDF
-        path_firma_tec = None 
-        pdf_path = pdf_generator.generar_pdf(
-            cliente=cliente,
-            tecnico=tecnico,
-            obs=obs,
-            path_firma=path_firma_tec,
-            datos_usuarios=usuarios_parsed 
-        )
-        if pdf_path:
-            archivos_para_borrar.append(pdf_path)
-
-        # 5. SUBIR A SHAREPOINT
-        ok_sp, msg_sp, web_url = utils.subir_archivo_sharepoint(pdf_path, cliente)
-
-        # 6. CREAR ITEM EN LISTA
-        msg_lista = "Lista omitida (sin URL)"
-        if ok_sp and web_url:
-            datos_lista = {
-                "titulo": f"Visita {cliente} - {tecnico}",
-                "cliente": cliente,
-                "tecnico": tecnico,
-                "fecha": datetime.now().strftime("%Y-%m-%d %H:%M"),
-                "link": web_url
-            }
-            try:
-                ok_lista, msg_lista = utils.crear_item_lista(datos_lista)
-            except:
-                msg_lista = "Error escribiendo en lista"
-
-        # 7. ENVIAR CORREOS
-        ok_email, msg_email = utils.enviar_correo_graph(pdf_path, cliente, tecnico, email_tecnico)
-
-        # 8. Guardar en BD Local
-        fecha_actual = utils.obtener_hora_chile().strftime('%Y-%m-%d %H:%M:%S')
-        server_id = database.guardar_reporte(
-            fecha=fecha_actual,
-            cliente=cliente,
-            tecnico=tecnico,
-            obs=obs,
-            fotos_json=json.dumps(rutas_fotos_servidor),
-            pdf_path=pdf_path,
-            detalles_json=json.dumps(usuarios_parsed),
-            estado_envio=1 if ok_email else 0
-        )
-
-        # 9. PROGRAMAR LIMPIEZA
-        background_tasks.add_task(eliminar_archivos_temporales, archivos_para_borrar)
+        # 4. Encolar (las fechas se fijan ahora, no cuando el worker lo procese)
+        payload = {
+            "cliente": cliente,
+            "tecnico": tecnico,
+            "obs": obs,
+            "email_tecnico": email_tecnico,
+            "latitud": latitud,
+            "longitud": longitud,
+            "usuarios": usuarios_parsed,
+            "rutas_fotos": rutas_fotos_servidor,
+            "carpeta": carpeta_trabajo,
+            "blobs": blobs,
+            "fecha": utils.obtener_hora_chile().strftime('%Y-%m-%d %H:%M:%S'),
+            "fecha_lista": datetime.now().strftime("%Y-%m-%d %H:%M"),
+            "normalizacion_fotos": {
+                "bytes_antes": sum(n['bytes_antes'] for n in normalizacion),
+                "bytes_despues": sum(n['bytes_despues'] for n in normalizacion),
+                "ms": [n['ms'] for n in normalizacion],
+            },
+        }
+        job_id = await ejecutores.en_hilo(database.encolar_trabajo, worker_reportes.TIPO_REPORTE, payload, clave)
 
         return {
-            "status": "success",
-            "server_id": server_id,
-            "pdf_generated": pdf_path,
-            "message": f"Email: {msg_email} | SP: {msg_sp}"
+            "status": "accepted",
+            "job_id": job_id,
+            "status_url": f"/reporte/job/{job_id}"
         }
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        if not isinstance(e, HTTPException):
+            import traceback
+            traceback.print_exc()
+        if blobs:
+            await ejecutores.en_hilo(almacen.liberar, blobs)
+        if carpeta_trabajo:
+            await ejecutores.en_hilo(shutil.rmtree, carpeta_trabajo, ignore_errors=True)
+        if clave:
+            # Liberamos la clave para que el reintento del cliente pueda procesarse
+            await ejecutores.en_hilo(database.liberar_clave_idempotencia, clave)
+        if isinstance(e, HTTPException):
+            raise
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _reclamar_idempotencia(clave: str) -> Optional[int]:
+    """
+    Retorna None si esta petición es la dueña de la clave (debe procesarse), o el
+    job_id original si es un duplicado. Un duplicado concurrente espera a que la
+    petición original encole su trabajo; si ésta falla, el duplicado toma su lugar.
+    """
+    limite = time.monotonic() + config.IDEMPOTENCIA_ESPERA_SEGUNDOS
+    while True:
+        reclamada, job_id = await ejecutores.en_hilo(
+            database.reclamar_clave_idempotencia, clave, config.IDEMPOTENCIA_EXPIRACION_RECLAMO,
+            config.IDEMPOTENCIA_TTL_SEGUNDOS
+        )
+        if reclamada:
+            return None
+        if job_id is not None:
+            metricas.incrementar("idempotencia_replay")
+            return job_id
+        if time.monotonic() > limite:
+            raise HTTPException(status_code=409, detail="Hay una petición con la misma Idempotency-Key en curso")
+        await asyncio.sleep(0.25)
+
+def _respuesta_trabajo(job_id: int, replay: bool = False):
+    trabajo = database.obtener_trabajo(job_id)
+    respuesta = {
+        "status": "accepted",
+        "job_id": job_id,
+        "status_url": f"/reporte/job/{job_id}"
+    }
+    if replay:
+        respuesta["replay"] = True
+        if trabajo:
+            respuesta["estado"] = trabajo['estado']
+            respuesta["server_id"] = trabajo['resultado'].get('server_id')
+    return respuesta
+
+@app.get("/reporte/job/{job_id}")
+def estado_trabajo(job_id: int):
+    trabajo = database.obtener_trabajo(job_id)
+    if not trabajo:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    resultado = trabajo['resultado']
+    return {
+        "job_id": trabajo['id'],
+        "estado": trabajo['estado'],
+        "etapas": trabajo['etapas'],
+        "error": trabajo['error'],
+        "normalizacion_fotos": trabajo['payload'].get('normalizacion_fotos'),
+        "server_id": resultado.get('server_id'),
+        "web_url": resultado.get('web_url'),
+        "message": f"Email: {resultado.get('msg_email', '-')} | SP: {resultado.get('msg_sp', '-')}",
+        "creado_en": trabajo['creado_en'],
+        "actualizado_en": trabajo['actualizado_en'],
+    }
+
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 8000))
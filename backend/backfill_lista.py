@@ -0,0 +1,61 @@
+import sys
+
+import database
+import utils
+import graph_cliente
+
+# Crea en la Lista de SharePoint los items que faltan (reportes cuya etapa "lista" falló),
+# de a 20 por petición $batch. Uso: python backfill_lista.py [--dry-run]
+
+
+def backfill_items_lista(dry_run=False):
+    """Retorna un resumen {'pendientes', 'creados', 'enlazados', 'fallidos', 'errores'}."""
+    filas = database.obtener_reportes_sin_item_lista()
+    resumen = {"pendientes": len(filas), "creados": 0, "enlazados": 0, "fallidos": 0, "errores": {}}
+    if dry_run or not filas:
+        return resumen
+
+    # Un item pudo crearse sin que alcanzáramos a guardar su id: si el link ya está en la
+    # Lista sólo se enlaza. Sin poder leer la Lista no se crea nada (mejor que duplicar).
+    existentes = utils.obtener_links_lista()
+    if existentes is None:
+        resumen["errores"]["lista"] = "No se pudo leer la Lista de SharePoint"
+        return resumen
+    faltantes = []
+    for fila in filas:
+        item_id = existentes.get(fila[4])
+        if item_id:
+            database.actualizar_item_lista(fila[0], item_id)
+            resumen["enlazados"] += 1
+        else:
+            faltantes.append(fila)
+    filas = faltantes
+
+    # Agrupamos de a varios lotes por vuelta para ir guardando el avance
+    paso = graph_cliente.TAM_LOTE * 5
+    for i in range(0, len(filas), paso):
+        items = {}
+        for id_rep, fecha, cliente, tecnico, web_url in filas[i:i + paso]:
+            items[id_rep] = {
+                "titulo": f"Visita {cliente} - {tecnico}",
+                "cliente": cliente,
+                "tecnico": tecnico,
+                "fecha": (fecha or "")[:16],
+                "link": web_url,
+            }
+        for id_rep, (ok, msg, item_id) in utils.crear_items_lista_lote(items).items():
+            if ok:
+                database.actualizar_item_lista(id_rep, item_id)
+                resumen["creados"] += 1
+            else:
+                resumen["fallidos"] += 1
+                resumen["errores"][id_rep] = msg
+    return resumen
+
+
+if __name__ == "__main__":
+    database.inicializar_db()
+    res = backfill_items_lista(dry_run="--dry-run" in sys.argv)
+    print(f"Pendientes: {res['pendientes']} | Creados: {res['creados']} | Enlazados: {res['enlazados']} | Fallidos: {res['fallidos']}")
+    for id_rep, msg in res["errores"].items():
+        print(f"   - Reporte {id_rep}: {msg}")
@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+import database
+
+# Micro-benchmark de acceso a SQLite: conexión nueva por llamada (como era antes) contra
+# la conexión por hilo de database.py (WAL, synchronous=NORMAL, busy_timeout).
+#
+#   python benchmark_db.py [--operaciones 2000] [--hilos 8]
+#
+# Usa bases temporales; no toca visitas.db.
+
+
+def _por_llamada_lectura(ruta, cliente):
+    con = sqlite3.connect(ruta)
+    cur = con.cursor()
+    cur.execute("SELECT email FROM clientes WHERE nombre = ?", (cliente,))
+    res = cur.fetchone()
+    con.close()
+    return res
+
+def _por_llamada_escritura(ruta, i):
+    con = sqlite3.connect(ruta)
+    cur = con.cursor()
+    cur.execute("UPDATE reportes SET email_enviado = ? WHERE id = ?", (i % 2, 1 + i % 50))
+    con.commit()
+    con.close()
+
+def _gestor_lectura(ruta, cliente):
+    return database.obtener_correo_cliente(cliente)
+
+def _gestor_escritura(ruta, i):
+    database.actualizar_estado_email(1 + i % 50, i % 2)
+
+MODOS = {
+    "por_llamada": (_por_llamada_lectura, _por_llamada_escritura),
+    "conexion_hilo": (_gestor_lectura, _gestor_escritura),
+}
+
+
+def _preparar(ruta):
+    database.DB_NAME = ruta
+    database.inicializar_db()
+    database.agregar_cliente("Cliente", "cliente@ejemplo.cl")
+    for i in range(50):
+        database.guardar_reporte("2024-01-01 10:00:00", "Cliente", "Técnico", "", "[]", None, "[]", 0)
+    database.cerrar_conexion()
+
+def _secuencial(fn, ruta, n, arg):
+    inicio = time.perf_counter()
+    for i in range(n):
+        fn(ruta, arg if arg is not None else i)
+    return (time.perf_counter() - inicio) * 1e6 / n
+
+def _concurrente(lectura, escritura, ruta, n, hilos):
+    """Cada hilo alterna 9 lecturas y 1 escritura. Retorna (ops/s, errores 'database is locked')."""
+    errores = [0]
+    lock = threading.Lock()
+
+    def trabajar(h):
+        for i in range(n // hilos):
+            try:
+                if i % 10 == 0:
+                    escritura(ruta, h * n + i)
+                else:
+                    lectura(ruta, "Cliente")
+            except sqlite3.OperationalError:
+                with lock:
+                    errores[0] += 1
+        database.cerrar_conexion()
+
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=trabajar, args=(h,)) for h in range(hilos)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return (n // hilos * hilos) / (time.perf_counter() - inicio), errores[0]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de conexiones SQLite")
+    parser.add_argument("--operaciones", type=int, default=2000)
+    parser.add_argument("--hilos", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    carpeta = tempfile.mkdtemp(prefix="bench_db_")
+    print(f"{'modo':<15} {'lectura µs':>11} {'escritura µs':>13} {'concurrente ops/s':>18} {'bloqueos':>9}")
+    for modo, (lectura, escritura) in MODOS.items():
+        ruta = os.path.join(carpeta, f"{modo}.db")
+        _preparar(ruta)
+        if modo == "por_llamada":
+            # Modo original: rollback journal
+            con = sqlite3.connect(ruta)
+            con.execute("PRAGMA journal_mode = DELETE")
+            con.close()
+        database.DB_NAME = ruta
+        us_lectura = _secuencial(lectura, ruta, args.operaciones, "Cliente")
+        us_escritura = _secuencial(escritura, ruta, args.operaciones // 4, None)
+        ops, bloqueos = _concurrente(lectura, escritura, ruta, args.operaciones, args.hilos)
+        database.cerrar_conexion()
+        print(f"{modo:<15} {us_lectura:>11.1f} {us_escritura:>13.1f} {ops:>18.0f} {bloqueos:>9}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import multiprocessing
+
+from PIL import Image, ImageDraw
+
+# Benchmark del generador de PDF con reportes sintéticos.
+# Cada caso corre en un proceso nuevo (spawn) para que el pico de RSS sea sólo suyo.
+#
+#   python benchmark_pdf.py --guardar benchmark_pdf_base.json      # medir y guardar la base
+#   python benchmark_pdf.py --comparar benchmark_pdf_base.json     # falla (exit 1) si hay regresión
+#
+# La base depende de la máquina: se genera localmente y no se versiona.
+
+RUTA_BASE_DEFECTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_pdf_base.json")
+
+# Métricas que se comparan contra la base (más alto = peor)
+METRICAS_COMPARADAS = ("ms_total", "rss_mb", "bytes")
+
+# nombre: (usuarios, fotos por usuario, resolución de foto, con firma, tareas por usuario, normalizar fotos)
+CASOS = {
+    "minimo":           (1,  0, None,         False, 3,  True),
+    "tipico":           (3,  3, (1600, 1200), True,  8,  True),
+    "tipico_sin_norm":  (3,  3, (1600, 1200), True,  8,  False),
+    "fotos_12mp":       (2,  6, (4000, 3000), True,  5,  True),
+    "muchos_usuarios":  (20, 1, (1280, 960),  True,  6,  True),
+    "checklist_largo":  (5,  0, None,         True,  80, True),
+}
+
+
+# --- DATOS SINTÉTICOS ---
+
+def _foto_sintetica(ruta, resolucion, semilla):
+    """JPEG con ruido sobre un degradado: comprime parecido a una foto real (no a un color plano)."""
+    ancho, alto = resolucion
+    ruido = Image.effect_noise((ancho, alto), 40 + semilla % 20)
+    degradado = Image.linear_gradient("L").resize((ancho, alto))
+    img = Image.merge("RGB", (ruido, degradado, degradado.transpose(Image.FLIP_LEFT_RIGHT)))
+    img.save(ruta, "JPEG", quality=90)
+
+def _firma_sintetica(ruta, semilla):
+    img = Image.new("RGB", (400, 200), "white")
+    draw = ImageDraw.Draw(img)
+    puntos = [(20 + i * 12, 100 + ((i * 37 + semilla) % 60) - 30) for i in range(30)]
+    draw.line(puntos, fill="black", width=3)
+    img.save(ruta)
+
+def construir_usuarios(carpeta, usuarios, fotos, resolucion, con_firma, tareas):
+    """Arma `datos_usuarios` como los que recibe generar_pdf, con archivos reales en `carpeta`."""
+    datos = []
+    for u in range(usuarios):
+        rutas_fotos = []
+        for f in range(fotos):
+            ruta = os.path.join(carpeta, f"foto_{u}_{f}.jpg")
+            _foto_sintetica(ruta, resolucion, u * 31 + f)
+            rutas_fotos.append(ruta)
+        firma = None
+        if con_firma:
+            firma = os.path.join(carpeta, f"firma_{u}.png")
+            _firma_sintetica(firma, u)
+        datos.append({
+            "nombre": f"Usuario {u + 1}",
+            "atendido": u % 7 != 6,  # De vez en cuando uno no atendido, con motivo
+            "motivo": "No se encontraba en su puesto",
+            "trabajo": ",".join(f"Tarea de mantención número {t + 1} sobre equipo" for t in range(tareas)),
+            "fotos": rutas_fotos,
+            "firma": firma,
+        })
+    return datos
+
+
+# --- EJECUCIÓN DE UN CASO (en proceso hijo) ---
+
+def _rss_pico_mb():
+    import resource
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo reporta en KB, macOS en bytes
+    return round(pico / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def ejecutar_caso(nombre, repeticiones):
+    import pdf_generator
+    import imagenes
+
+    usuarios, fotos, resolucion, con_firma, tareas, normalizar = CASOS[nombre]
+    carpeta = tempfile.mkdtemp(prefix=f"bench_{nombre}_")
+    try:
+        datos = construir_usuarios(carpeta, usuarios, fotos, resolucion, con_firma, tareas)
+        pdf_generator.precalentar()  # Igual que el worker: no medimos el primer import
+
+        tiempos_total, tiempos_norm, tiempos_render = [], [], []
+        stats = {}
+        for i in range(repeticiones):
+            inicio = time.perf_counter()
+            datos_pdf = datos
+            if normalizar:
+                # Mismo camino que la API: derivado aparte, la original queda intacta
+                datos_pdf = []
+                for j, u in enumerate(datos):
+                    fotos_norm = [
+                        imagenes.normalizar_imagen(fp, destino=os.path.join(carpeta, f"norm_{i}_{j}_{k}.jpg"))["ruta"]
+                        for k, fp in enumerate(u["fotos"])
+                    ]
+                    datos_pdf.append(dict(u, fotos=fotos_norm))
+            fin_norm = time.perf_counter()
+            stats = {}
+            pdf_generator.generar_pdf_en_memoria("Cliente Benchmark", "Técnico", "Observación de prueba",
+                                                 None, datos_pdf, estadisticas=stats)
+            fin = time.perf_counter()
+            tiempos_norm.append((fin_norm - inicio) * 1000)
+            tiempos_render.append((fin - fin_norm) * 1000)
+            tiempos_total.append((fin - inicio) * 1000)
+
+        return {
+            "ms_total": round(statistics.median(tiempos_total), 2),
+            "ms_normalizar": round(statistics.median(tiempos_norm), 2),
+            "ms_render": round(statistics.median(tiempos_render), 2),
+            "rss_mb": _rss_pico_mb(),
+            "bytes": stats["bytes"],
+            "paginas": stats["paginas"],
+        }
+    finally:
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+def medir(nombres, repeticiones):
+    resultados = {}
+    contexto = multiprocessing.get_context("spawn")
+    for nombre in nombres:
+        with contexto.Pool(1) as pool:
+            resultados[nombre] = pool.apply(ejecutar_caso, (nombre, repeticiones))
+        r = resultados[nombre]
+        print(f"{nombre:<18} {r['ms_total']:>9.1f} ms  (norm {r['ms_normalizar']:.1f} / render {r['ms_render']:.1f})"
+              f"  {r['rss_mb']:>6.1f} MB  {r['bytes'] / 1024:>8.1f} KB  {r['paginas']} pág")
+    return resultados
+
+
+# --- BASE Y COMPARACIÓN ---
+
+def comparar(base, actual, umbral):
+    """Retorna la lista de regresiones [(caso, métrica, base, actual, variación)]."""
+    regresiones = []
+    for nombre, medido in actual.items():
+        previo = base.get("casos", {}).get(nombre)
+        if not previo:
+            continue
+        for metrica in METRICAS_COMPARADAS:
+            antes, ahora = previo.get(metrica), medido.get(metrica)
+            if not antes or ahora is None:
+                continue
+            variacion = (ahora - antes) / antes
+            marca = "❌" if variacion > umbral else "  "
+            print(f"{marca} {nombre:<18} {metrica:<9} {antes:>10} -> {ahora:<10} ({variacion:+.1%})")
+            if variacion > umbral:
+                regresiones.append((nombre, metrica, antes, ahora, variacion))
+    return regresiones
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de generar_pdf con reportes sintéticos")
+    parser.add_argument("--casos", nargs="*", choices=sorted(CASOS), help="Casos a medir (por defecto todos)")
+    parser.add_argument("--repeticiones", type=int, default=3, help="Se reporta la mediana")
+    parser.add_argument("--guardar", nargs="?", const=RUTA_BASE_DEFECTO, help="Guarda los resultados como base")
+    parser.add_argument("--comparar", nargs="?", const=RUTA_BASE_DEFECTO, help="Compara contra una base")
+    parser.add_argument("--umbral", type=float, default=0.15, help="Regresión tolerada (0.15 = 15%%)")
+    args = parser.parse_args(argv)
+
+    resultados = medir(args.casos or list(CASOS), args.repeticiones)
+
+    if args.guardar:
+        with open(args.guardar, "w") as f:
+            json.dump({
+                "fecha": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "maquina": platform.platform(),
+                "repeticiones": args.repeticiones,
+                "casos": resultados,
+            }, f, indent=2)
+        print(f"Base guardada en {args.guardar}")
+
+    if args.comparar:
+        with open(args.comparar) as f:
+            base = json.load(f)
+        regresiones = comparar(base, resultados, args.umbral)
+        if regresiones:
+            print(f"{len(regresiones)} regresión(es) sobre {args.umbral:.0%}")
+            return 1
+        print("Sin regresiones")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
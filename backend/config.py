@@ -29,12 +29,27 @@ if os.getenv("RENDER"):
 else:
     # EN DESARROLLO (LOCAL):
     # Guardamos la DB en la misma carpeta del código
+    DATA_DIR = BASE_DIR
     DB_PATH = os.path.join(BASE_DIR, "visitas.db")
     print(f"--> MODO LOCAL. Usando DB en: {DB_PATH}")
 
+# Carpeta donde se persisten las subidas de cada trabajo hasta que el worker termina.
+# Vive junto a la DB para que sobreviva a reinicios en Render.
+TRABAJOS_FOLDER = os.path.join(DATA_DIR, "trabajos")
+
+# PDFs cuyo correo quedó pendiente: el reenvío los toma de aquí (no de la carpeta temporal)
+PDF_ARCHIVO_FOLDER = os.path.join(DATA_DIR, "pdfs")
+# El worker genera el PDF en memoria; con ARCHIVAR_PDF=1 guarda además una copia de todos
+# en PDF_ARCHIVO_FOLDER (si no, sólo los que quedaron con el correo pendiente)
+ARCHIVAR_PDF = os.getenv("ARCHIVAR_PDF", "0") == "1"
+
+# Subidas (fotos/firmas) guardadas por hash de contenido, compartidas entre reportes (almacen.py)
+ALMACEN_FOLDER = os.path.join(DATA_DIR, "almacen")
+
 # Asegurar que existan los directorios temporales necesarios al iniciar
-if not os.path.exists(TEMP_FOLDER):
-    os.makedirs(TEMP_FOLDER)
+for _carpeta in (TEMP_FOLDER, TRABAJOS_FOLDER, PDF_ARCHIVO_FOLDER, ALMACEN_FOLDER):
+    if not os.path.exists(_carpeta):
+        os.makedirs(_carpeta)
 
 # ==========================================
 # 2. CREDENCIALES MICROSOFT GRAPH (SEGURAS)
@@ -43,6 +58,14 @@ GRAPH_CLIENT_ID = os.getenv("GRAPH_CLIENT_ID", "TU_CLIENT_ID_LOCAL")
 GRAPH_CLIENT_SECRET = os.getenv("GRAPH_CLIENT_SECRET", "TU_SECRET_LOCAL")
 GRAPH_TENANT_ID = os.getenv("GRAPH_TENANT_ID", "TU_TENANT_ID_LOCAL")
 GRAPH_USER_EMAIL = os.getenv("GRAPH_USER_EMAIL", "soporte@tecnocomp.cl")
+# El token de Graph se renueva este margen (segundos) antes de que expire
+GRAPH_TOKEN_MARGEN_SEGUNDOS = int(os.getenv("GRAPH_TOKEN_MARGEN_SEGUNDOS", "300"))
+# Cliente HTTP de Graph (graph_cliente.py): timeouts en segundos, reintentos y tamaño del pool
+GRAPH_TIMEOUT_CONEXION = float(os.getenv("GRAPH_TIMEOUT_CONEXION", "5"))
+GRAPH_TIMEOUT_LECTURA = float(os.getenv("GRAPH_TIMEOUT_LECTURA", "60"))
+GRAPH_MAX_REINTENTOS = int(os.getenv("GRAPH_MAX_REINTENTOS", "4"))
+GRAPH_ESPERA_BASE = float(os.getenv("GRAPH_ESPERA_BASE", "1"))
+GRAPH_TAM_POOL = int(os.getenv("GRAPH_TAM_POOL", "10"))
 
 # ==========================================
 # 3. SHAREPOINT (ARCHIVOS Y LISTAS)
@@ -56,8 +79,86 @@ SHAREPOINT_BACKUP_FOLDER = "Backups_DB"
 SHAREPOINT_SITE_ID = "tecnocompcomputacion.sharepoint.com,f67a6766-495c-41e7-8caa-eb89b1801758,661e71e7-fee3-4a98-8c3e-323b2dd43bbe"
 SHAREPOINT_LIST_ID = "803eb871-8bcc-4561-bd91-599876787eb9"
 
+# Los IDs de sitio/biblioteca se cachean este tiempo (segundos) en utils._ResolverDriveSharePoint
+SHAREPOINT_IDS_TTL_SEGUNDOS = int(os.getenv("SHAREPOINT_IDS_TTL_SEGUNDOS", "21600"))
+# Archivos más grandes que el umbral se suben con createUploadSession, en fragmentos
+# (múltiplos de 320 KiB, como exige Graph) y reanudables si el worker se reinicia
+SHAREPOINT_UMBRAL_SESION_BYTES = int(os.getenv("SHAREPOINT_UMBRAL_SESION_BYTES", str(4 * 1024 * 1024)))
+SHAREPOINT_TAM_FRAGMENTO = int(os.getenv("SHAREPOINT_FRAGMENTOS_320K", "10")) * 320 * 1024
+# Correo: PDFs hasta este tamaño van inline en sendMail; los más grandes se adjuntan por
+# upload session ("sesion") o se manda sólo el link de SharePoint ("enlace")
+CORREO_UMBRAL_ADJUNTO_BYTES = int(os.getenv("CORREO_UMBRAL_ADJUNTO_BYTES", str(3 * 1024 * 1024)))
+CORREO_MODO_ADJUNTO_GRANDE = os.getenv("CORREO_MODO_ADJUNTO_GRANDE", "sesion")
+CORREO_TAM_FRAGMENTO = 4 * 1024 * 1024 - 320 * 1024
+# Tope aproximado de bytes por petición $batch de correos (Graph rechaza lotes muy pesados)
+CORREO_MAX_BYTES_LOTE = int(os.getenv("CORREO_MAX_BYTES_LOTE", str(4 * 1024 * 1024)))
+# Resolver token e IDs al iniciar la API y los workers en vez de en la primera subida
+PRECALENTAR_GRAPH = os.getenv("PRECALENTAR_GRAPH", "0") == "1"
+
+# ==========================================
+# 4. COLA DE TRABAJOS (REPORTES ASÍNCRONOS)
+# ==========================================
+# Procesos worker que lanza la API al iniciar (0 = se ejecutan aparte con `python worker_reportes.py`)
+WORKERS_REPORTES = int(os.getenv("WORKERS_REPORTES", "2"))
+# Reintentos por etapa antes de darla por fallida y seguir con la siguiente
+MAX_INTENTOS_ETAPA = int(os.getenv("MAX_INTENTOS_ETAPA", "5"))
+# Espera base (segundos) del backoff exponencial entre reintentos
+ESPERA_BASE_REINTENTO = float(os.getenv("ESPERA_BASE_REINTENTO", "10"))
+# Si un worker muere, su trabajo se libera tras este tiempo (segundos)
+BLOQUEO_TRABAJO_SEGUNDOS = int(os.getenv("BLOQUEO_TRABAJO_SEGUNDOS", "300"))
+# Tope de trabajos en cola (pendientes + procesando): sobre él /reporte/crear responde 503
+COLA_MAX_TRABAJOS = int(os.getenv("COLA_MAX_TRABAJOS", "200"))
+# Los trabajos terminados se borran pasado este plazo (el reporte ya quedó en `reportes`);
+# los workers lo revisan cada TRABAJOS_PURGA_INTERVALO segundos
+TRABAJOS_RETENCION_SEGUNDOS = int(os.getenv("TRABAJOS_RETENCION_SEGUNDOS", str(30 * 24 * 3600)))
+TRABAJOS_PURGA_INTERVALO = int(os.getenv("TRABAJOS_PURGA_INTERVALO", "3600"))
+
+# Reenvío automático de correos pendientes (reenvio.py)
+REENVIO_ACTIVO = os.getenv("REENVIO_ACTIVO", "1") == "1"
+REENVIO_INTERVALO_SEGUNDOS = int(os.getenv("REENVIO_INTERVALO_SEGUNDOS", "60"))
+# Pendientes por ciclo: se envían juntos vía $batch (20 sendMail por petición)
+REENVIO_LOTE = int(os.getenv("REENVIO_LOTE", "40"))
+REENVIO_ESPERA_BASE = int(os.getenv("REENVIO_ESPERA_BASE", "120"))
+REENVIO_ESPERA_MAXIMA = int(os.getenv("REENVIO_ESPERA_MAXIMA", str(6 * 3600)))
+# Tras estos intentos el reporte queda como fallido (email_enviado = -1) y no se reintenta más
+REENVIO_MAX_INTENTOS = int(os.getenv("REENVIO_MAX_INTENTOS", "10"))
+# Cuánto tiempo queda reclamado un pendiente por el proceso que lo está enviando (segundos)
+REENVIO_BLOQUEO_SEGUNDOS = int(os.getenv("REENVIO_BLOQUEO_SEGUNDOS", "600"))
+
+# Idempotency-Key de /reporte/crear: cuánto espera un duplicado concurrente a la petición
+# original, y tras cuánto un reclamo sin trabajo se considera abandonado (segundos)
+IDEMPOTENCIA_ESPERA_SEGUNDOS = float(os.getenv("IDEMPOTENCIA_ESPERA_SEGUNDOS", "30"))
+IDEMPOTENCIA_EXPIRACION_RECLAMO = float(os.getenv("IDEMPOTENCIA_EXPIRACION_RECLAMO", "120"))
+# Vida de una clave: pasado este plazo se purga y un reintento con la misma clave crea otro
+# trabajo. Holgado, porque una tablet puede reintentar tras días sin conexión (segundos)
+IDEMPOTENCIA_TTL_SEGUNDOS = float(os.getenv("IDEMPOTENCIA_TTL_SEGUNDOS", str(7 * 24 * 3600)))
+
+# Firmas enviadas como trazos: tolerancia de Douglas-Peucker, en píxeles del lienzo de la tablet
+FIRMA_TOLERANCIA_PX = float(os.getenv("FIRMA_TOLERANCIA_PX", "0.8"))
+
+# Normalización de fotos (imagenes.py): resolución objetivo en el PDF y calidad JPEG máxima
+IMAGEN_DPI = int(os.getenv("IMAGEN_DPI", "200"))
+IMAGEN_CALIDAD = int(os.getenv("IMAGEN_CALIDAD", "80"))
+
+# Subidas reanudables (/subidas): tamaño máximo por archivo, vida de una subida sin usar y
+# bloqueo de escritura de un PUT (se renueva en cada trozo; si el PUT muere, vence solo)
+SUBIDA_MAX_BYTES = int(os.getenv("SUBIDA_MAX_BYTES", str(50 * 1024 * 1024)))
+SUBIDA_TTL_SEGUNDOS = int(os.getenv("SUBIDA_TTL_SEGUNDOS", str(48 * 3600)))
+SUBIDA_BLOQUEO_SEGUNDOS = int(os.getenv("SUBIDA_BLOQUEO_SEGUNDOS", "60"))
+
+# Ejecutores acotados (ver ejecutores.py): hilos para I/O bloqueante y procesos para CPU
+HILOS_IO = int(os.getenv("HILOS_IO", "8"))
+PROCESOS_CPU = int(os.getenv("PROCESOS_CPU", str(max(1, (os.cpu_count() or 2) - 1))))
+
+# SQLite (database.py): espera ante un bloqueo de escritura y sentencias preparadas cacheadas por conexión
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SENTENCIAS = int(os.getenv("SQLITE_CACHE_SENTENCIAS", "256"))
+
+# Zona horaria de las fechas de reportes (se guardan en hora local) y de los agrupamientos por día/semana/mes
+ZONA_HORARIA = os.getenv("ZONA_HORARIA", "Chile/Continental")
+
 # ==========================================
-# 4. CONFIGURACIÓN GENERAL Y ESTILOS
+# 5. CONFIGURACIÓN GENERAL Y ESTILOS
 # ==========================================
 FONT_FAMILY = "Helvetica"
 NOMBRE_EMPRESA_ONEDRIVE = "Tecnocomp Computacion Ltda"
@@ -1,16 +1,183 @@
+import os
+import re
+import math
 import sqlite3
 import json
+import time
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+from contextlib import contextmanager
+import pytz
 import config
 
 DB_NAME = config.DB_PATH if hasattr(config, 'DB_PATH') else "visitas.db"
 
+# --- CONEXIONES ---
+# Una conexión por hilo (y por proceso), abierta una vez y reutilizada en cada llamada.
+# WAL deja leer mientras otro escribe; busy_timeout hace esperar en vez de fallar con
+# "database is locked". Las conexiones van en autocommit: las escrituras usan transaccion().
+
+_local = threading.local()
+# Conexiones heredadas por un fork: no se cierran, cerrarlas desde el hijo
+# podría hacer que SQLite borre el WAL que el proceso padre sigue usando.
+_heredadas = []
+
+def _abrir():
+    con = sqlite3.connect(DB_NAME, timeout=config.SQLITE_BUSY_TIMEOUT_MS / 1000,
+                          isolation_level=None, cached_statements=config.SQLITE_CACHE_SENTENCIAS)
+    con.execute(f"PRAGMA busy_timeout = {config.SQLITE_BUSY_TIMEOUT_MS}")
+    con.execute("PRAGMA journal_mode = WAL")
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA foreign_keys = ON")
+    con.create_function("periodo_local", 2, periodo_local, deterministic=True)
+    con.create_function("distancia_m", 4, distancia_m, deterministic=True)
+    return con
+
 def conectar():
-    return sqlite3.connect(DB_NAME)
+    """Conexión del hilo actual. No hay que cerrarla."""
+    con = getattr(_local, "con", None)
+    if con is not None and _local.pid == os.getpid() and _local.db == DB_NAME:
+        return con
+    if con is not None and _local.pid != os.getpid():
+        _heredadas.append(con)
+    _local.con, _local.pid, _local.db = _abrir(), os.getpid(), DB_NAME
+    return _local.con
 
-def inicializar_db():
+def cerrar_conexion():
+    """Cierra la conexión del hilo actual (al apagar, o en scripts)."""
+    con = getattr(_local, "con", None)
+    if con is not None and _local.pid == os.getpid():
+        con.close()
+    _local.con = None
+
+@contextmanager
+def transaccion(inmediata=False):
+    """
+    Cursor dentro de una transacción: COMMIT al salir, ROLLBACK si hay excepción.
+    `inmediata` toma el bloqueo de escritura de entrada (BEGIN IMMEDIATE), para
+    leer-y-escribir sin que otro proceso se cruce.
+    """
     con = conectar()
     cur = con.cursor()
-    
+    cur.execute("BEGIN IMMEDIATE" if inmediata else "BEGIN")
+    try:
+        yield cur
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+
+def _consultar(sql, parametros=()):
+    return conectar().execute(sql, parametros).fetchall()
+
+def _consultar_uno(sql, parametros=()):
+    return conectar().execute(sql, parametros).fetchone()
+
+# --- FECHAS ---
+# `fecha` es texto en hora local (utils.obtener_hora_chile). `fecha_ts` guarda el mismo instante
+# en segundos epoch (UTC) para filtrar por rango con índice.
+
+def _zona():
+    return pytz.timezone(config.ZONA_HORARIA)
+
+def fecha_a_epoch(fecha):
+    """'YYYY-MM-DD[ HH:MM[:SS]]' (hora local, o ISO con offset) -> epoch entero. None si no se entiende."""
+    try:
+        dt = datetime.fromisoformat(str(fecha).strip())
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = _zona().localize(dt)
+    return int(dt.timestamp())
+
+def dia_a_epoch(dia):
+    """Medianoche local de un date -> epoch (límite de rango para fecha_ts)."""
+    return int(_zona().localize(datetime(dia.year, dia.month, dia.day)).timestamp())
+
+@lru_cache(maxsize=65536)
+def _hora_local(hora_epoch):
+    # Los cambios de horario son en horas en punto: todo instante de una hora UTC cae en el mismo día local
+    return datetime.fromtimestamp(hora_epoch * 3600, _zona()).date()
+
+def periodo_local(ts, periodo):
+    """
+    Clave del período (hora local) de un epoch: 'dia' -> 'YYYY-MM-DD', 'semana' -> lunes
+    'YYYY-MM-DD', 'mes' -> 'YYYY-MM'. Registrada como función SQL en cada conexión.
+    """
+    if ts is None:
+        return None
+    dia = _hora_local(int(ts) // 3600)
+    if periodo == "semana":
+        dia -= timedelta(days=dia.weekday())
+    elif periodo == "mes":
+        return dia.strftime("%Y-%m")
+    return dia.isoformat()
+
+# --- COORDENADAS ---
+# latitud/longitud se guardan como texto en reportes (tal como llegan); reportes_geo (R*Tree)
+# tiene la versión numérica validada para las búsquedas por cercanía.
+
+RADIO_TIERRA_M = 6371008.8
+
+def coordenadas(lat, lon):
+    """(lat, lon) como floats válidos (grados), o None si faltan o están fuera de rango."""
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+def distancia_m(lat1, lon1, lat2, lon2):
+    """Distancia haversine en metros. Registrada como función SQL en cada conexión."""
+    if None in (lat1, lon1, lat2, lon2):
+        return None
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(min(1.0, math.sqrt(a)))
+
+def caja_radio(lat, lon, radio_m):
+    """
+    Cajas [(lat_min, lat_max, lon_min, lon_max), ...] que cubren el círculo de `radio_m` metros.
+    Normalmente una; dos si el círculo cruza el antimeridiano (±180°), una a cada lado.
+    """
+    angulo = radio_m / RADIO_TIERRA_M
+    dlat = math.degrees(angulo)
+    lat_min, lat_max = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+    if abs(lat) + dlat >= 90:
+        # El círculo incluye un polo: cualquier longitud
+        return [(lat_min, lat_max, -180.0, 180.0)]
+    dlon = math.degrees(math.asin(math.sin(angulo) / math.cos(math.radians(lat))))
+    lon_min, lon_max = lon - dlon, lon + dlon
+    if lon_min < -180.0:
+        return [(lat_min, lat_max, lon_min + 360.0, 180.0), (lat_min, lat_max, -180.0, lon_max)]
+    if lon_max > 180.0:
+        return [(lat_min, lat_max, lon_min, 180.0), (lat_min, lat_max, -180.0, lon_max - 360.0)]
+    return [(lat_min, lat_max, lon_min, lon_max)]
+
+def _guardar_geo(cur, id_reporte, lat, lon):
+    punto = coordenadas(lat, lon)
+    if punto:
+        cur.execute("INSERT OR REPLACE INTO reportes_geo VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (id_reporte, punto[0], punto[0], punto[1], punto[1], punto[0], punto[1]))
+
+# --- MIGRACIONES ---
+# Cada migración corre una sola vez: PRAGMA user_version guarda cuántas van aplicadas.
+# Las nuevas se agregan al final de MIGRACIONES; las ya publicadas no se editan ni reordenan.
+
+def _columnas(cur, tabla):
+    return {fila[1] for fila in cur.execute(f"PRAGMA table_info({tabla})").fetchall()}
+
+def _agregar_columnas(cur, tabla, columnas):
+    existentes = _columnas(cur, tabla)
+    for col, tipo in columnas:
+        if col not in existentes:
+            cur.execute(f"ALTER TABLE {tabla} ADD COLUMN {col} {tipo}")
+
+def _m001_esquema_base(cur):
+    """Tablas y columnas existentes antes del versionado (idempotente para BDs antiguas)."""
     # --- CREACIÓN DE TABLAS ---
     cur.execute("""
         CREATE TABLE IF NOT EXISTS reportes (
@@ -41,20 +208,79 @@ def inicializar_db():
             FOREIGN KEY(cliente_nombre) REFERENCES clientes(nombre) ON DELETE CASCADE
         )
     """)
+    # Cola de trabajos: cada POST /reporte/crear deja aquí su payload y los workers lo procesan
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS trabajos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT,
+            estado TEXT DEFAULT 'pendiente',
+            payload TEXT,
+            etapas TEXT,
+            resultado TEXT,
+            error TEXT,
+            intentos INTEGER DEFAULT 0,
+            creado_en REAL,
+            actualizado_en REAL,
+            proximo_intento REAL DEFAULT 0,
+            bloqueado_hasta REAL DEFAULT 0,
+            worker TEXT
+        )
+    """)
+    # Claves de idempotencia de /reporte/crear (trabajo_id NULL = la primera petición aún se procesa)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS idempotencia (
+            clave TEXT PRIMARY KEY,
+            trabajo_id INTEGER,
+            creado_en REAL
+        )
+    """)
+    # Almacén de subidas por contenido (almacen.py): una fila por archivo con su contador de referencias
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            ruta TEXT,
+            tamano INTEGER,
+            refs INTEGER DEFAULT 0,
+            creado_en REAL
+        )
+    """)
+    # Subidas reanudables desde las tablets (POST/PUT /subidas): bytes recibidos y hash al finalizar
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS subidas (
+            id TEXT PRIMARY KEY,
+            nombre TEXT,
+            tamano_total INTEGER,
+            offset INTEGER DEFAULT 0,
+            estado TEXT DEFAULT 'abierta',
+            hash TEXT,
+            creado_en REAL,
+            actualizado_en REAL
+        )
+    """)
+    # Sesiones de subida a SharePoint en curso (para reanudar archivos grandes tras un reinicio)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS sesiones_subida (
+            clave TEXT PRIMARY KEY,
+            upload_url TEXT,
+            expira TEXT,
+            creado_en REAL
+        )
+    """)
 
-    # --- MIGRACIONES DE COLUMNAS (Para evitar errores si ya existen) ---
-    columnas_reportes = [
+    # --- COLUMNAS AGREGADAS CON EL TIEMPO (las BDs antiguas no las tienen) ---
+    _agregar_columnas(cur, "reportes", [
         ("pdf_path", "TEXT"),
         ("detalles_usuarios", "TEXT"),
         ("email_enviado", "INTEGER DEFAULT 0"),
         ("latitud", "TEXT"),
-        ("longitud", "TEXT")
-    ]
-    
-    for col, tipo in columnas_reportes:
-        try: 
-            cur.execute(f"ALTER TABLE reportes ADD COLUMN {col} {tipo}")
-        except: pass
+        ("longitud", "TEXT"),
+        ("sp_web_url", "TEXT"),
+        ("sp_item_id", "TEXT"),
+        ("email_tecnico", "TEXT"),
+        ("intentos_email", "INTEGER DEFAULT 0"),
+        ("ultimo_error_email", "TEXT"),
+        ("proximo_intento_email", "REAL DEFAULT 0")
+    ])
 
     # --- DATOS POR DEFECTO (ELIMINADO) ---
     # He comentado estas líneas para evitar que los datos borrados reaparezcan.
@@ -75,37 +301,317 @@ def inicializar_db():
     #         for u in lista_users:
     #             cur.execute("INSERT INTO usuarios (nombre, cliente_nombre) VALUES (?, ?)", (u, cli))
 
-    con.commit()
-    con.close()
+def _m002_usuarios_unicos(cur):
+    """usuarios con UNIQUE(cliente_nombre, nombre): sin duplicados y con índice por cliente."""
+    # SQLite no agrega restricciones con ALTER TABLE: se reconstruye la tabla.
+    # Los duplicados existentes se colapsan en la fila más antigua.
+    cur.execute("""
+        CREATE TABLE usuarios_nueva (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            nombre TEXT, 
+            cliente_nombre TEXT, 
+            UNIQUE(cliente_nombre, nombre),
+            FOREIGN KEY(cliente_nombre) REFERENCES clientes(nombre) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("""
+        INSERT INTO usuarios_nueva (id, nombre, cliente_nombre)
+        SELECT MIN(id), nombre, cliente_nombre FROM usuarios GROUP BY cliente_nombre, nombre
+    """)
+    cur.execute("DROP TABLE usuarios")
+    cur.execute("ALTER TABLE usuarios_nueva RENAME TO usuarios")
+
+def _m003_indices_reportes(cur):
+    """Índices para los filtros y agrupaciones de reportes."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_cliente ON reportes(cliente)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_tecnico ON reportes(tecnico)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_fecha ON reportes(fecha)")
+    # Parcial: sólo los pendientes de correo (pocos), para el reenvío y sus estadísticas
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_email_pendiente ON reportes(fecha) WHERE email_enviado = 0")
+
+# Dimensiones de los contadores KPI: nombre -> expresión de la clave sobre una fila de reportes.
+# Los NULL se guardan como '' (en una PK de texto cada NULL sería una clave distinta).
+DIMENSIONES_KPI = {
+    "cliente": "COALESCE({t}.cliente, '')",
+    "tecnico": "COALESCE({t}.tecnico, '')",
+    "mes": "substr(COALESCE({t}.fecha, ''), 1, 7)",
+    "email": "COALESCE(CAST({t}.email_enviado AS TEXT), '')",
+}
+# Columna de reportes de la que depende cada dimensión (para los triggers de UPDATE)
+_COLUMNA_KPI = {"cliente": "cliente", "tecnico": "tecnico", "mes": "fecha", "email": "email_enviado"}
+
+def _poblar_kpis(cur):
+    """Recalcula kpi_resumen desde reportes (backfill y reconstrucción)."""
+    cur.execute("DELETE FROM kpi_resumen")
+    for dimension, expresion in DIMENSIONES_KPI.items():
+        cur.execute(f"""
+            INSERT INTO kpi_resumen (dimension, clave, reportes)
+            SELECT ?, {expresion.format(t="reportes")} AS clave, COUNT(*) FROM reportes GROUP BY clave
+        """, (dimension,))
+
+def _m004_resumenes_kpi(cur):
+    """Contadores por cliente, técnico, mes y estado de correo, mantenidos por triggers."""
+    cur.execute("""
+        CREATE TABLE kpi_resumen (
+            dimension TEXT NOT NULL,
+            clave TEXT NOT NULL,
+            reportes INTEGER NOT NULL,
+            PRIMARY KEY (dimension, clave)
+        ) WITHOUT ROWID
+    """)
+    # Para "el cliente con más reportes" sin recorrer todos los clientes
+    cur.execute("CREATE INDEX idx_kpi_resumen_ranking ON kpi_resumen(dimension, reportes)")
+
+    def sumar(dimension, fila):
+        clave = DIMENSIONES_KPI[dimension].format(t=fila)
+        return f"""
+            INSERT INTO kpi_resumen (dimension, clave, reportes) VALUES ('{dimension}', {clave}, 1)
+            ON CONFLICT(dimension, clave) DO UPDATE SET reportes = reportes + 1;"""
+
+    def restar(dimension, fila):
+        clave = DIMENSIONES_KPI[dimension].format(t=fila)
+        return f"""
+            UPDATE kpi_resumen SET reportes = reportes - 1 WHERE dimension = '{dimension}' AND clave = {clave};
+            DELETE FROM kpi_resumen WHERE dimension = '{dimension}' AND clave = {clave} AND reportes <= 0;"""
+
+    cur.execute(f"CREATE TRIGGER trg_kpi_insertar AFTER INSERT ON reportes BEGIN {''.join(sumar(d, 'NEW') for d in DIMENSIONES_KPI)} END")
+    cur.execute(f"CREATE TRIGGER trg_kpi_borrar AFTER DELETE ON reportes BEGIN {''.join(restar(d, 'OLD') for d in DIMENSIONES_KPI)} END")
+    # Un trigger de UPDATE por dimensión: registrar_intento_email sólo toca el contador de correo
+    for dimension, columna in _COLUMNA_KPI.items():
+        antes, despues = DIMENSIONES_KPI[dimension].format(t="OLD"), DIMENSIONES_KPI[dimension].format(t="NEW")
+        cur.execute(f"""
+            CREATE TRIGGER trg_kpi_actualizar_{dimension} AFTER UPDATE OF {columna} ON reportes
+            WHEN {antes} IS NOT {despues}
+            BEGIN {restar(dimension, 'OLD')}{sumar(dimension, 'NEW')} END
+        """)
+    _poblar_kpis(cur)
+
+def _m005_fecha_ts(cur):
+    """Columna fecha_ts (epoch) con índices por fecha, cliente y técnico."""
+    _agregar_columnas(cur, "reportes", [("fecha_ts", "INTEGER")])
+    filas = cur.execute("SELECT id, fecha FROM reportes").fetchall()
+    cur.executemany("UPDATE reportes SET fecha_ts = ? WHERE id = ?",
+                    [(fecha_a_epoch(fecha), id_rep) for id_rep, fecha in filas])
+    cur.execute("CREATE INDEX idx_reportes_fecha_ts ON reportes(fecha_ts)")
+    # Cubren también la igualdad por cliente/técnico: los índices simples de la migración 3 sobran
+    cur.execute("CREATE INDEX idx_reportes_cliente_ts ON reportes(cliente, fecha_ts)")
+    cur.execute("CREATE INDEX idx_reportes_tecnico_ts ON reportes(tecnico, fecha_ts)")
+    cur.execute("DROP INDEX IF EXISTS idx_reportes_cliente")
+    cur.execute("DROP INDEX IF EXISTS idx_reportes_tecnico")
+
+# "Tarea (HH:MM)", como arma la app el texto `trabajo` a partir del checklist
+_TAREA_CON_HORA = re.compile(r"^(.*?)\s*\((\d{1,2}:\d{2})\)$")
+
+def _tareas_usuario(usuario):
+    """[(tarea, hora)] de un usuario: de `tareas_map` si viene, si no del texto `trabajo`."""
+    mapa = usuario.get("tareas_map")
+    if isinstance(mapa, dict) and mapa:
+        return [(str(tarea), str(hora) if hora is not None else None) for tarea, hora in mapa.items()]
+    tareas = []
+    for item in str(usuario.get("trabajo") or "").split(","):
+        # Sólo los ítems con hora son del checklist; el resto es texto libre
+        encontrado = _TAREA_CON_HORA.match(item.strip())
+        if encontrado:
+            tareas.append(encontrado.groups())
+    return tareas
+
+def _guardar_detalle_usuarios(cur, id_reporte, detalles_json):
+    """Reemplaza las filas de reporte_usuarios (y sus tareas) de un reporte a partir del JSON."""
+    cur.execute("DELETE FROM reporte_usuarios WHERE reporte_id = ?", (id_reporte,))
+    try:
+        usuarios = json.loads(detalles_json or "[]")
+    except ValueError:
+        return
+    for posicion, usuario in enumerate(usuarios if isinstance(usuarios, list) else []):
+        if not isinstance(usuario, dict):
+            continue
+        cur.execute("""
+            INSERT INTO reporte_usuarios (reporte_id, posicion, nombre, atendido, motivo, trabajo, fotos, con_firma)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (id_reporte, posicion, usuario.get("nombre"), 1 if usuario.get("atendido") else 0,
+              usuario.get("motivo") or None, usuario.get("trabajo") or None, len(usuario.get("fotos") or []),
+              1 if usuario.get("firma") or usuario.get("firma_trazos") else 0))
+        cur.executemany(
+            "INSERT OR IGNORE INTO reporte_usuario_tareas (reporte_usuario_id, tarea, hora) VALUES (?, ?, ?)",
+            [(cur.lastrowid, tarea, hora) for tarea, hora in _tareas_usuario(usuario)])
+
+def _m006_detalle_usuarios(cur):
+    """Tablas reporte_usuarios y reporte_usuario_tareas (detalles_usuarios normalizado)."""
+    cur.execute("""
+        CREATE TABLE reporte_usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reporte_id INTEGER NOT NULL REFERENCES reportes(id) ON DELETE CASCADE,
+            posicion INTEGER NOT NULL,
+            nombre TEXT,
+            atendido INTEGER NOT NULL,
+            motivo TEXT,
+            trabajo TEXT,
+            fotos INTEGER NOT NULL DEFAULT 0,
+            con_firma INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE reporte_usuario_tareas (
+            reporte_usuario_id INTEGER NOT NULL REFERENCES reporte_usuarios(id) ON DELETE CASCADE,
+            tarea TEXT NOT NULL,
+            hora TEXT,
+            PRIMARY KEY (reporte_usuario_id, tarea)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX idx_reporte_usuarios_reporte ON reporte_usuarios(reporte_id)")
+    cur.execute("CREATE INDEX idx_reporte_usuarios_nombre ON reporte_usuarios(nombre, atendido)")
+    cur.execute("CREATE INDEX idx_reporte_usuario_tareas_tarea ON reporte_usuario_tareas(tarea)")
+    for id_rep, detalles in cur.execute("SELECT id, detalles_usuarios FROM reportes").fetchall():
+        _guardar_detalle_usuarios(cur, id_rep, detalles)
+
+# Texto de usuarios de un reporte para el índice de búsqueda (trabajo y motivo de todos)
+_TEXTO_USUARIOS_FTS = """
+    (SELECT group_concat(trabajo, ' | ') FROM reporte_usuarios WHERE reporte_id = {id}),
+    (SELECT group_concat(motivo, ' | ') FROM reporte_usuarios WHERE reporte_id = {id})
+"""
+
+def _m007_busqueda_texto(cur):
+    """Índice FTS5 reportes_fts (observaciones, trabajo, motivo) mantenido por triggers."""
+    # rowid = reportes.id. Guarda su propia copia del texto para poder armar snippets.
+    # prefix: índices de prefijo de 2 y 3 letras para las búsquedas "tone*"
+    cur.execute("""
+        CREATE VIRTUAL TABLE reportes_fts USING fts5(
+            observaciones, trabajo, motivo,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+    """)
+    cur.execute(f"""
+        INSERT INTO reportes_fts (rowid, observaciones, trabajo, motivo)
+        SELECT r.id, r.observaciones, {_TEXTO_USUARIOS_FTS.format(id="r.id")} FROM reportes r
+    """)
+    cur.execute("""
+        CREATE TRIGGER trg_fts_insertar AFTER INSERT ON reportes BEGIN
+            INSERT INTO reportes_fts (rowid, observaciones) VALUES (NEW.id, NEW.observaciones);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER trg_fts_actualizar AFTER UPDATE OF observaciones ON reportes BEGIN
+            UPDATE reportes_fts SET observaciones = NEW.observaciones WHERE rowid = NEW.id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER trg_fts_borrar AFTER DELETE ON reportes BEGIN
+            DELETE FROM reportes_fts WHERE rowid = OLD.id;
+        END
+    """)
+    # Los usuarios se escriben después del reporte: cada cambio recalcula el texto de su reporte
+    for evento, fila in (("INSERT", "NEW"), ("UPDATE OF trabajo, motivo", "NEW"), ("DELETE", "OLD")):
+        cur.execute(f"""
+            CREATE TRIGGER trg_fts_usuarios_{evento.split()[0].lower()} AFTER {evento} ON reporte_usuarios BEGIN
+                UPDATE reportes_fts SET (trabajo, motivo) = ({_TEXTO_USUARIOS_FTS.format(id=f"{fila}.reporte_id")})
+                WHERE rowid = {fila}.reporte_id;
+            END
+        """)
+
+def _m008_indice_geo(cur):
+    """Índice R*Tree reportes_geo con las coordenadas numéricas de cada reporte."""
+    # Un punto es una caja de lado 0. El R*Tree guarda los límites en float32 (redondeados hacia
+    # afuera: sirven de prefiltro); +lat/+lon guardan el valor exacto para calcular la distancia.
+    cur.execute("CREATE VIRTUAL TABLE reportes_geo USING rtree(id, lat_min, lat_max, lon_min, lon_max, +lat, +lon)")
+    for id_rep, lat, lon in cur.execute("SELECT id, latitud, longitud FROM reportes").fetchall():
+        _guardar_geo(cur, id_rep, lat, lon)
+    cur.execute("""
+        CREATE TRIGGER trg_geo_borrar AFTER DELETE ON reportes BEGIN
+            DELETE FROM reportes_geo WHERE id = OLD.id;
+        END
+    """)
+
+def _m009_idempotencia_ttl(cur):
+    """Índice por creado_en en idempotencia, para purgar las claves vencidas."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_idempotencia_creado ON idempotencia(creado_en)")
+
+def _m010_indices_trabajos(cur):
+    """Índices de la cola de trabajos: el sondeo de los workers y el conteo de admisión."""
+    # tomar_trabajo: (estado = 'pendiente' AND proximo_intento <= ?) OR (estado = 'procesando' ...)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos(estado, proximo_intento)")
+    # contar_trabajos_activos y obtener_resultados_recientes
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trabajos_tipo_estado ON trabajos(tipo, estado)")
+
+def _m011_indices_cliente_tecnico(cur):
+    """Vuelven los índices simples por cliente y técnico: el listado keyset los recorre en orden de id."""
+    # (cliente, fecha_ts) sirve para rangos de fecha, pero ordenar por id con él obliga a un
+    # sort temporal; en un índice simple las filas de cada cliente ya van por rowid.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_cliente ON reportes(cliente)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_tecnico ON reportes(tecnico)")
+
+def _m012_indice_reenvio(cur):
+    """Índice parcial de los pendientes de correo por proximo_intento_email, para el reenvío."""
+    # El reclamo compara la columna directamente (sin COALESCE) para poder usar el índice
+    cur.execute("UPDATE reportes SET proximo_intento_email = 0 WHERE proximo_intento_email IS NULL")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reportes_reenvio ON reportes(proximo_intento_email, id)
+        WHERE email_enviado = 0
+    """)
+
+def _m013_escritor_subidas(cur):
+    """Bloqueo de escritura en subidas: un solo PUT (o finalizar) a la vez por subida."""
+    _agregar_columnas(cur, "subidas", [("escritor", "TEXT"), ("escritor_hasta", "REAL DEFAULT 0")])
+
+MIGRACIONES = [
+    _m001_esquema_base,
+    _m002_usuarios_unicos,
+    _m003_indices_reportes,
+    _m004_resumenes_kpi,
+    _m005_fecha_ts,
+    _m006_detalle_usuarios,
+    _m007_busqueda_texto,
+    _m008_indice_geo,
+    _m009_idempotencia_ttl,
+    _m010_indices_trabajos,
+    _m011_indices_cliente_tecnico,
+    _m012_indice_reenvio,
+    _m013_escritor_subidas,
+]
+
+def inicializar_db():
+    """Aplica las migraciones pendientes. Si la BD ya está al día no hace nada más que leer user_version."""
+    # Conexión propia (no la del hilo): corre antes de lanzar los workers
+    con = _abrir()
+    # Reconstruir tablas requiere las FK apagadas (y no se puede cambiar dentro de una transacción)
+    con.execute("PRAGMA foreign_keys = OFF")
+    try:
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        for numero in range(version + 1, len(MIGRACIONES) + 1):
+            migracion = MIGRACIONES[numero - 1]
+            cur = con.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                # La API y un worker pueden arrancar a la vez: el segundo ve la versión ya subida
+                if cur.execute("PRAGMA user_version").fetchone()[0] >= numero:
+                    cur.execute("COMMIT")
+                    continue
+                migracion(cur)
+                cur.execute(f"PRAGMA user_version = {numero}")
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+            print(f"--> Migración {numero} aplicada: {migracion.__doc__.splitlines()[0]}")
+    finally:
+        con.close()
 
 # --- FUNCIONES TÉCNICOS ---
 
 def obtener_tecnicos():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT nombre FROM tecnicos ORDER BY nombre ASC")
-    lista = [row[0] for row in cur.fetchall()]
-    con.close()
-    return lista
+    return [row[0] for row in _consultar("SELECT nombre FROM tecnicos ORDER BY nombre ASC")]
 
 def agregar_nuevo_tecnico(nombre):
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("INSERT INTO tecnicos (nombre) VALUES (?)", (nombre,))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("INSERT INTO tecnicos (nombre) VALUES (?)", (nombre,))
         return True
     except: 
         return False
 
 def eliminar_tecnico(nombre):
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("DELETE FROM tecnicos WHERE nombre = ?", (nombre,))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("DELETE FROM tecnicos WHERE nombre = ?", (nombre,))
         return True
     except: 
         return False
@@ -113,24 +619,24 @@ def eliminar_tecnico(nombre):
 # --- FUNCIONES CLIENTES ---
 
 def obtener_clientes():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT nombre, email FROM clientes ORDER BY nombre ASC")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    return _consultar("SELECT nombre, email FROM clientes ORDER BY nombre ASC")
 
 def obtener_nombres_clientes():
     return [c[0] for c in obtener_clientes()]
 
+def existe_cliente(nombre):
+    return _consultar_uno("SELECT 1 FROM clientes WHERE nombre = ?", (nombre,)) is not None
+
 def agregar_cliente(nombre, email):
     if not nombre: return False
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("INSERT OR REPLACE INTO clientes (nombre, email) VALUES (?, ?)", (nombre, email))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            # UPSERT y no INSERT OR REPLACE: el REPLACE borra la fila y, con foreign_keys,
+            # el ON DELETE CASCADE se llevaría los usuarios del cliente
+            cur.execute("""
+                INSERT INTO clientes (nombre, email) VALUES (?, ?)
+                ON CONFLICT(nombre) DO UPDATE SET email = excluded.email
+            """, (nombre, email))
         return True
     except Exception as e: 
         print(f"Error agregando cliente DB: {e}")
@@ -138,53 +644,41 @@ def agregar_cliente(nombre, email):
 
 def eliminar_cliente(nombre):
     try:
-        con = conectar()
-        cur = con.cursor()
-        # Primero borramos usuarios asociados para mantener integridad
-        cur.execute("DELETE FROM usuarios WHERE cliente_nombre = ?", (nombre,))
-        cur.execute("DELETE FROM clientes WHERE nombre = ?", (nombre,))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            # Los usuarios asociados se borran por el ON DELETE CASCADE
+            cur.execute("DELETE FROM clientes WHERE nombre = ?", (nombre,))
         return True
     except: 
         return False
 
 def obtener_correo_cliente(nombre_cliente):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT email FROM clientes WHERE nombre = ?", (nombre_cliente,))
-    res = cur.fetchone()
-    con.close()
+    res = _consultar_uno("SELECT email FROM clientes WHERE nombre = ?", (nombre_cliente,))
     return res[0] if res else ""
 
 # --- FUNCIONES USUARIOS ---
 
 def obtener_usuarios_por_cliente(cliente_nombre):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT nombre FROM usuarios WHERE cliente_nombre = ? ORDER BY nombre ASC", (cliente_nombre,))
-    lista = [row[0] for row in cur.fetchall()]
-    con.close()
-    return lista
+    filas = _consultar("SELECT nombre FROM usuarios WHERE cliente_nombre = ? ORDER BY nombre ASC", (cliente_nombre,))
+    return [row[0] for row in filas]
+
+def obtener_todos_usuarios():
+    return _consultar("SELECT nombre, cliente_nombre FROM usuarios")
 
 def agregar_usuario(nombre, cliente_nombre):
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("INSERT INTO usuarios (nombre, cliente_nombre) VALUES (?, ?)", (nombre, cliente_nombre))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            # Re-agregar un usuario existente (sincronización entre tablets) no es un error.
+            # Un cliente inexistente sí: la FK lo rechaza (IntegrityError) y retornamos False.
+            cur.execute("INSERT OR IGNORE INTO usuarios (nombre, cliente_nombre) VALUES (?, ?)", (nombre, cliente_nombre))
         return True
-    except: 
+    except Exception as e: 
+        print(f"Error agregando usuario DB: {e}")
         return False
 
 def eliminar_usuario(nombre, cliente_nombre):
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("DELETE FROM usuarios WHERE nombre = ? AND cliente_nombre = ?", (nombre, cliente_nombre))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("DELETE FROM usuarios WHERE nombre = ? AND cliente_nombre = ?", (nombre, cliente_nombre))
         return True
     except: 
         return False
@@ -193,124 +687,612 @@ def eliminar_usuario(nombre, cliente_nombre):
 
 def eliminar_reporte(id_reporte):
     try:
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("DELETE FROM reportes WHERE id = ?", (id_reporte,))
-        filas_afectadas = cur.rowcount
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("DELETE FROM reportes WHERE id = ?", (id_reporte,))
+            filas_afectadas = cur.rowcount
         return filas_afectadas > 0
     except Exception as e:
         print(f"Error eliminando reporte: {e}")
         return False
 
 def obtener_conteo_reportes():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT COUNT(*) FROM reportes")
-    total = cur.fetchone()[0]
-    con.close()
-    return total
+    return _consultar_uno("SELECT COALESCE(SUM(reportes), 0) FROM kpi_resumen WHERE dimension = 'email'")[0]
 
 def obtener_historial():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT id, fecha, cliente, tecnico, observaciones, pdf_path, email_enviado, detalles_usuarios, imagen_path FROM reportes ORDER BY id DESC")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    return _consultar("SELECT id, fecha, cliente, tecnico, observaciones, pdf_path, email_enviado, detalles_usuarios, imagen_path FROM reportes ORDER BY id DESC")
 
 def obtener_reporte_por_id(id_reporte):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT id, fecha, cliente, tecnico, observaciones, pdf_path, email_enviado, detalles_usuarios, imagen_path FROM reportes WHERE id = ?", (id_reporte,))
-    dato = cur.fetchone()
-    con.close()
-    return dato
+    return _consultar_uno("SELECT id, fecha, cliente, tecnico, observaciones, pdf_path, email_enviado, detalles_usuarios, imagen_path FROM reportes WHERE id = ?", (id_reporte,))
+
+# --- LISTADO PAGINADO (GET /reportes) ---
+# Columnas que se pueden pedir con fields=. Las JSON pesadas sólo se leen si se piden.
+COLUMNAS_LISTADO = ("id", "fecha", "cliente", "tecnico", "observaciones", "pdf_path", "email_enviado",
+                    "latitud", "longitud", "sp_web_url", "sp_item_id", "email_tecnico",
+                    "detalles_usuarios", "imagen_path")
+COLUMNAS_JSON = ("detalles_usuarios", "imagen_path")
+
+def listar_reportes(columnas, antes_de_id=None, limite=50, cliente=None, tecnico=None,
+                    desde_ts=None, hasta_ts=None, email_enviado=None):
+    """
+    Una página de reportes por id descendente. Paginación keyset: `antes_de_id` es el
+    último id de la página anterior, así cada página es un rango del índice y no un OFFSET.
+    `desde_ts`/`hasta_ts` acotan fecha_ts (epoch, [desde_ts, hasta_ts)).
+    """
+    if not columnas or any(c not in COLUMNAS_LISTADO for c in columnas):
+        raise ValueError(f"Columnas inválidas: {columnas}")
+    condiciones, parametros = [], []
+    for sql, valor in (("id < ?", antes_de_id), ("cliente = ?", cliente), ("tecnico = ?", tecnico),
+                       ("fecha_ts >= ?", desde_ts), ("fecha_ts < ?", hasta_ts),
+                       ("email_enviado = ?", email_enviado)):
+        if valor is not None:
+            condiciones.append(sql)
+            parametros.append(valor)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    return _consultar(f"SELECT {', '.join(columnas)} FROM reportes {where} ORDER BY id DESC LIMIT ?",
+                      (*parametros, limite))
+
+def _ranking_kpi(dimension, limite=-1):
+    return _consultar("""
+        SELECT NULLIF(clave, ''), reportes FROM kpi_resumen
+        WHERE dimension = ? ORDER BY reportes DESC LIMIT ?
+    """, (dimension, limite))
 
 def obtener_datos_clientes():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT cliente, COUNT(*) FROM reportes GROUP BY cliente ORDER BY COUNT(*) DESC")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    return _ranking_kpi("cliente")
 
 def obtener_datos_tecnicos():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT tecnico, COUNT(*) FROM reportes GROUP BY tecnico ORDER BY COUNT(*) DESC")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    return _ranking_kpi("tecnico")
 
 def actualizar_estado_email(id_reporte, estado):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("UPDATE reportes SET email_enviado = ? WHERE id = ?", (estado, id_reporte))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("UPDATE reportes SET email_enviado = ? WHERE id = ?", (estado, id_reporte))
 
-def guardar_reporte(fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, lat="", lon=""):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("""
-        INSERT INTO reportes (fecha, cliente, tecnico, observaciones, imagen_path, pdf_path, detalles_usuarios, email_enviado, latitud, longitud) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, lat, lon))
-    con.commit()
-    inserted_id = cur.lastrowid 
-    con.close()
+def guardar_reporte(fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, lat="", lon="", sp_web_url=None, sp_item_id=None, email_tecnico=None):
+    with transaccion() as cur:
+        cur.execute("""
+            INSERT INTO reportes (fecha, fecha_ts, cliente, tecnico, observaciones, imagen_path, pdf_path, detalles_usuarios, email_enviado, latitud, longitud, sp_web_url, sp_item_id, email_tecnico) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (fecha, fecha_a_epoch(fecha), cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, lat, lon, sp_web_url, sp_item_id, email_tecnico))
+        inserted_id = cur.lastrowid 
+        _guardar_detalle_usuarios(cur, inserted_id, detalles_json)
+        _guardar_geo(cur, inserted_id, lat, lon)
     return inserted_id 
 
 def actualizar_reporte(id_reporte, fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("""
-        UPDATE reportes 
-        SET fecha=?, cliente=?, tecnico=?, observaciones=?, imagen_path=?, pdf_path=?, detalles_usuarios=?, email_enviado=?
-        WHERE id=?
-    """, (fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, id_reporte))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE reportes 
+            SET fecha=?, fecha_ts=?, cliente=?, tecnico=?, observaciones=?, imagen_path=?, pdf_path=?, detalles_usuarios=?, email_enviado=?
+            WHERE id=?
+        """, (fecha, fecha_a_epoch(fecha), cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, id_reporte))
+        _guardar_detalle_usuarios(cur, id_reporte, detalles_json)
 
 def obtener_reportes_pendientes():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT id, pdf_path, cliente, tecnico FROM reportes WHERE email_enviado = 0")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    return _consultar("SELECT id, pdf_path, cliente, tecnico FROM reportes WHERE email_enviado = 0")
+
+# email_enviado: 0 pendiente, 1 enviado, -1 fallido (agotó REENVIO_MAX_INTENTOS)
+EMAIL_FALLIDO = -1
+
+def reclamar_reportes_para_reenvio(ahora, limite, duracion_bloqueo):
+    """
+    Pendientes de correo cuyo backoff ya venció, los más antiguos primero, reclamados:
+    su proximo_intento_email pasa a ahora + duracion_bloqueo en la misma transacción, así
+    otro proceso de reenvío no los toma mientras éste los envía.
+    """
+    with transaccion(inmediata=True) as cur:
+        cur.execute("""
+            SELECT id, pdf_path, cliente, tecnico, email_tecnico, sp_web_url, intentos_email
+            FROM reportes
+            WHERE email_enviado = 0 AND proximo_intento_email <= ?
+            ORDER BY id ASC LIMIT ?
+        """, (ahora, limite))
+        filas = cur.fetchall()
+        cur.executemany("UPDATE reportes SET proximo_intento_email = ? WHERE id = ?",
+                        [(ahora + duracion_bloqueo, fila[0]) for fila in filas])
+    return filas
+
+def registrar_intento_email(id_reporte, ok, error=None, proximo_intento=0, agotado=False):
+    """Registra un envío. Con `agotado` un fallo deja el reporte como fallido (sin más reintentos)."""
+    estado = 1 if ok else (EMAIL_FALLIDO if agotado else 0)
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE reportes
+            SET email_enviado = ?, intentos_email = COALESCE(intentos_email, 0) + 1,
+                ultimo_error_email = ?, proximo_intento_email = ?
+            WHERE id = ?
+        """, (estado, None if ok else error, proximo_intento, id_reporte))
+
+def quitar_pdf_reporte(id_reporte):
+    with transaccion() as cur:
+        cur.execute("UPDATE reportes SET pdf_path = NULL WHERE id = ?", (id_reporte,))
+
+def estadisticas_pendientes_email():
+    """Retorna (cantidad, fecha del pendiente más antiguo o None)."""
+    res = _consultar_uno("SELECT COUNT(*), MIN(fecha) FROM reportes WHERE email_enviado = 0")
+    return res[0], res[1]
+
+def obtener_reportes_sin_item_lista():
+    """
+    Reportes del flujo con cola cuyo item de Lista no se llegó a crear (para el backfill).
+    Los reportes antiguos no tienen sp_web_url (la columna es posterior) y su item ya lo creó
+    el flujo síncrono: se excluyen, igual que cualquiera sin link al PDF.
+    """
+    return _consultar("""
+        SELECT id, fecha, cliente, tecnico, sp_web_url FROM reportes
+        WHERE (sp_item_id IS NULL OR sp_item_id = '') AND sp_web_url IS NOT NULL AND sp_web_url != ''
+        ORDER BY id ASC
+    """)
+
+def actualizar_item_lista(id_reporte, item_id):
+    with transaccion() as cur:
+        cur.execute("UPDATE reportes SET sp_item_id = ? WHERE id = ?", (item_id, id_reporte))
 
 # --- NUEVAS FUNCIONES PARA MÉTRICAS ---
+# Se leen de kpi_resumen (contadores mantenidos por triggers), no de reportes:
+# el costo no crece con el historial.
 
 def obtener_kpis_generales():
-    con = conectar()
-    cur = con.cursor()
-    
-    cur.execute("SELECT COUNT(*) FROM reportes")
-    total = cur.fetchone()[0]
-    
-    cur.execute("SELECT COUNT(*) FROM reportes WHERE email_enviado = 0")
-    pendientes = cur.fetchone()[0]
-    
-    cur.execute("SELECT cliente, COUNT(*) as c FROM reportes GROUP BY cliente ORDER BY c DESC LIMIT 1")
-    top_cli = cur.fetchone()
+    # Una sola transacción de lectura: los tres números salen de la misma foto de la BD
+    with transaccion() as cur:
+        cur.execute("SELECT COALESCE(SUM(reportes), 0) FROM kpi_resumen WHERE dimension = 'email'")
+        total = cur.fetchone()[0]
+        
+        cur.execute("SELECT reportes FROM kpi_resumen WHERE dimension = 'email' AND clave = '0'")
+        pendientes = (cur.fetchone() or (0,))[0]
+        
+        cur.execute("SELECT NULLIF(clave, ''), reportes FROM kpi_resumen WHERE dimension = 'cliente' ORDER BY reportes DESC LIMIT 1")
+        top_cli = cur.fetchone()
     cliente_top = f"{top_cli[0]} ({top_cli[1]})" if top_cli else "N/A"
-    
-    con.close()
     return total, pendientes, cliente_top
 
 def obtener_evolucion_mensual():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("""
-        SELECT substr(fecha, 1, 7) as mes, COUNT(*) 
-        FROM reportes 
-        GROUP BY mes 
-        ORDER BY mes DESC 
+    datos = _consultar("""
+        SELECT clave, reportes FROM kpi_resumen
+        WHERE dimension = 'mes' AND clave != ''
+        ORDER BY clave DESC 
         LIMIT 6
     """)
-    datos = cur.fetchall() 
-    con.close()
-    return datos[::-1]
\ No newline at end of file
+    return datos[::-1]
+
+def obtener_serie_temporal(periodo, desde_ts, hasta_ts, cliente=None, tecnico=None):
+    """
+    Reportes por período local ('dia', 'semana' o 'mes') con fecha_ts en [desde_ts, hasta_ts).
+    Recorre sólo el rango en el índice (fecha_ts, o (cliente|tecnico, fecha_ts) si se filtra).
+    Retorna [(periodo, reportes)] ordenado; los períodos sin reportes no aparecen.
+    """
+    condiciones, parametros = ["fecha_ts >= ?", "fecha_ts < ?"], [desde_ts, hasta_ts]
+    if cliente is not None:
+        condiciones.append("cliente = ?")
+        parametros.append(cliente)
+    if tecnico is not None:
+        condiciones.append("tecnico = ?")
+        parametros.append(tecnico)
+    return _consultar(f"""
+        SELECT periodo_local(fecha_ts, ?) AS periodo, COUNT(*) FROM reportes
+        WHERE {' AND '.join(condiciones)}
+        GROUP BY periodo ORDER BY periodo
+    """, (periodo, *parametros))
+
+def _filtros_reportes(cliente=None, desde_ts=None, hasta_ts=None, alias="r"):
+    """(sql, parámetros) con las condiciones comunes sobre reportes: cliente y rango de fecha_ts."""
+    condiciones, parametros = [], []
+    for sql, valor in ((f"{alias}.cliente = ?", cliente), (f"{alias}.fecha_ts >= ?", desde_ts),
+                       (f"{alias}.fecha_ts < ?", hasta_ts)):
+        if valor is not None:
+            condiciones.append(sql)
+            parametros.append(valor)
+    return "".join(f" AND {c}" for c in condiciones), parametros
+
+def obtener_usuarios_no_atendidos(cliente=None, nombre=None, desde_ts=None, hasta_ts=None, limite=50):
+    """[(cliente, usuario, visitas, no_atendido)] ordenado por veces no atendido."""
+    filtros, parametros = _filtros_reportes(cliente, desde_ts, hasta_ts)
+    if nombre is not None:
+        filtros += " AND u.nombre = ?"
+        parametros.append(nombre)
+    return _consultar(f"""
+        SELECT r.cliente, u.nombre, COUNT(*) AS visitas, SUM(u.atendido = 0) AS no_atendido
+        FROM reporte_usuarios u JOIN reportes r ON r.id = u.reporte_id
+        WHERE 1 = 1{filtros}
+        GROUP BY r.cliente, u.nombre
+        HAVING no_atendido > 0
+        ORDER BY no_atendido DESC, visitas DESC
+        LIMIT ?
+    """, (*parametros, limite))
+
+def obtener_tareas_omitidas(tareas, cliente=None, desde_ts=None, hasta_ts=None):
+    """
+    [(tarea, omitida, realizada)] para cada tarea de `tareas` (el checklist), sobre los
+    usuarios atendidos: omitida = atendidos sin esa tarea marcada.
+    """
+    filtros, parametros = _filtros_reportes(cliente, desde_ts, hasta_ts)
+    return _consultar(f"""
+        WITH catalogo(tarea) AS (SELECT value FROM json_each(?)),
+        atendidos AS (
+            SELECT u.id FROM reporte_usuarios u JOIN reportes r ON r.id = u.reporte_id
+            WHERE u.atendido = 1{filtros}
+        ),
+        realizadas AS (
+            SELECT tarea, COUNT(*) AS n FROM reporte_usuario_tareas
+            WHERE reporte_usuario_id IN (SELECT id FROM atendidos)
+            GROUP BY tarea
+        )
+        SELECT c.tarea, (SELECT COUNT(*) FROM atendidos) - COALESCE(h.n, 0) AS omitida, COALESCE(h.n, 0)
+        FROM catalogo c LEFT JOIN realizadas h ON h.tarea = c.tarea
+        ORDER BY omitida DESC
+    """, (json.dumps(list(tareas)), *parametros))
+
+def consulta_fts(texto, prefijo=False):
+    """
+    Texto libre -> consulta FTS5 segura: cada término entre comillas (un modelo como "HP-M402"
+    queda como frase) y todos obligatorios. Un término que termina en * busca por prefijo;
+    con `prefijo` también el último (búsqueda mientras se escribe). None si no hay términos.
+    """
+    terminos = [t for t in texto.replace('"', " ").split() if t.strip("*")]
+    partes = []
+    for i, termino in enumerate(terminos):
+        es_prefijo = termino.endswith("*") or (prefijo and i == len(terminos) - 1)
+        partes.append(f'"{termino.strip("*")}"' + ("*" if es_prefijo else ""))
+    return " ".join(partes) or None
+
+def buscar_reportes(consulta, cliente=None, desde_ts=None, hasta_ts=None, limite=20):
+    """
+    [(id, fecha, cliente, tecnico, snippet, puntaje)] ordenados por relevancia (bm25).
+    `consulta` es sintaxis FTS5 (ver consulta_fts).
+    """
+    filtros, parametros = _filtros_reportes(cliente, desde_ts, hasta_ts)
+    return _consultar(f"""
+        SELECT r.id, r.fecha, r.cliente, r.tecnico,
+               snippet(reportes_fts, -1, '[', ']', '…', 12), -bm25(reportes_fts)
+        FROM reportes_fts JOIN reportes r ON r.id = reportes_fts.rowid
+        WHERE reportes_fts MATCH ?{filtros}
+        ORDER BY bm25(reportes_fts)
+        LIMIT ?
+    """, (consulta, *parametros, limite))
+
+def reportes_cerca(lat, lon, cajas, radio_m=None, cliente=None, desde_ts=None, hasta_ts=None, limite=100):
+    """
+    [(id, fecha, cliente, tecnico, lat, lon, distancia_m)] dentro de alguna de `cajas`
+    [(lat_min, lat_max, lon_min, lon_max), ...] (ver caja_radio) y, si se da, a menos de
+    `radio_m` de (lat, lon); ordenados por distancia a (lat, lon). Las cajas se resuelven
+    con el R*Tree y sólo los candidatos pasan por la haversine.
+    """
+    filtros, parametros = _filtros_reportes(cliente, desde_ts, hasta_ts)
+    radio = ""
+    if radio_m is not None:
+        radio = " AND distancia <= ?"
+        parametros.append(radio_m)
+    condicion_cajas = " OR ".join(
+        ["(g.lat_max >= ? AND g.lat_min <= ? AND g.lon_max >= ? AND g.lon_min <= ?)"] * len(cajas))
+    return _consultar(f"""
+        SELECT r.id, r.fecha, r.cliente, r.tecnico, g.lat, g.lon, distancia_m(?, ?, g.lat, g.lon) AS distancia
+        FROM reportes_geo g JOIN reportes r ON r.id = g.id
+        WHERE ({condicion_cajas}){filtros}{radio}
+        ORDER BY distancia
+        LIMIT ?
+    """, (lat, lon, *[v for caja in cajas for v in caja], *parametros, limite))
+
+def obtener_resumen_kpis(meses=12):
+    """Todos los contadores en una lectura: {dimension: [(clave, reportes), ...]}."""
+    with transaccion() as cur:
+        resumen = {}
+        for dimension in DIMENSIONES_KPI:
+            orden = "clave DESC" if dimension == "mes" else "reportes DESC"
+            limite = meses if dimension == "mes" else -1
+            cur.execute(f"""
+                SELECT NULLIF(clave, ''), reportes FROM kpi_resumen
+                WHERE dimension = ? ORDER BY {orden} LIMIT ?
+            """, (dimension, limite))
+            resumen[dimension] = cur.fetchall()
+    return resumen
+
+def reconstruir_kpis():
+    """
+    Recalcula kpi_resumen desde reportes (por si se editó la BD a mano o con los triggers apagados).
+    Retorna cuántos contadores estaban desviados.
+    """
+    with transaccion(inmediata=True) as cur:
+        cur.execute("SELECT dimension, clave, reportes FROM kpi_resumen")
+        antes = {(d, c): n for d, c, n in cur.fetchall()}
+        _poblar_kpis(cur)
+        cur.execute("SELECT dimension, clave, reportes FROM kpi_resumen")
+        despues = {(d, c): n for d, c, n in cur.fetchall()}
+    return sum(1 for k in antes.keys() | despues.keys() if antes.get(k) != despues.get(k))
+
+# --- COLA DE TRABAJOS ---
+# Estados: pendiente -> procesando -> completado | completado_con_errores
+# Un trabajo 'procesando' cuyo bloqueo expiró (worker caído) vuelve a ser tomable.
+
+def _fila_a_trabajo(row):
+    return {
+        "id": row[0],
+        "tipo": row[1],
+        "estado": row[2],
+        "payload": json.loads(row[3]) if row[3] else {},
+        "etapas": json.loads(row[4]) if row[4] else {},
+        "resultado": json.loads(row[5]) if row[5] else {},
+        "error": row[6],
+        "intentos": row[7],
+        "creado_en": row[8],
+        "actualizado_en": row[9],
+    }
+
+_COLUMNAS_TRABAJO = "id, tipo, estado, payload, etapas, resultado, error, intentos, creado_en, actualizado_en"
+
+def encolar_trabajo(tipo, payload, clave_idempotencia=None):
+    """Inserta el trabajo y, si viene, lo asocia a su clave de idempotencia en la misma transacción."""
+    ahora = time.time()
+    with transaccion() as cur:
+        cur.execute("""
+            INSERT INTO trabajos (tipo, estado, payload, etapas, resultado, creado_en, actualizado_en, proximo_intento)
+            VALUES (?, 'pendiente', ?, '{}', '{}', ?, ?, 0)
+        """, (tipo, json.dumps(payload), ahora, ahora))
+        trabajo_id = cur.lastrowid
+        if clave_idempotencia:
+            cur.execute("UPDATE idempotencia SET trabajo_id = ? WHERE clave = ?", (trabajo_id, clave_idempotencia))
+    return trabajo_id
+
+def tomar_trabajo(worker, duracion_bloqueo):
+    """
+    Reclama el siguiente trabajo listo para ejecutarse. Retorna el dict del trabajo o None.
+    BEGIN IMMEDIATE garantiza que dos workers no tomen el mismo trabajo.
+    """
+    ahora = time.time()
+    with transaccion(inmediata=True) as cur:
+        cur.execute(f"""
+            SELECT {_COLUMNAS_TRABAJO} FROM trabajos
+            WHERE (estado = 'pendiente' AND proximo_intento <= ?)
+               OR (estado = 'procesando' AND bloqueado_hasta < ?)
+            ORDER BY id ASC LIMIT 1
+        """, (ahora, ahora))
+        row = cur.fetchone()
+        if not row:
+            return None
+        cur.execute("""
+            UPDATE trabajos SET estado = 'procesando', worker = ?, bloqueado_hasta = ?, actualizado_en = ?
+            WHERE id = ?
+        """, (worker, ahora + duracion_bloqueo, ahora, row[0]))
+    trabajo = _fila_a_trabajo(row)
+    trabajo["estado"] = "procesando"
+    trabajo["worker"] = worker
+    return trabajo
+
+# Las escrituras de un worker sólo aplican mientras el trabajo siga siendo suyo
+# (estado 'procesando' y worker = él): si su bloqueo venció y otro lo tomó, retornan False.
+
+def renovar_bloqueo_trabajo(trabajo_id, worker, duracion_bloqueo):
+    """Extiende el bloqueo mientras una etapa sigue corriendo (latido del worker)."""
+    ahora = time.time()
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE trabajos SET bloqueado_hasta = ?, actualizado_en = ?
+            WHERE id = ? AND worker = ? AND estado = 'procesando'
+        """, (ahora + duracion_bloqueo, ahora, trabajo_id, worker))
+        return cur.rowcount > 0
+
+def guardar_progreso_trabajo(trabajo_id, worker, etapas, resultado, duracion_bloqueo):
+    """Persiste el avance por etapa y renueva el bloqueo del worker."""
+    ahora = time.time()
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE trabajos SET etapas = ?, resultado = ?, bloqueado_hasta = ?, actualizado_en = ?
+            WHERE id = ? AND worker = ? AND estado = 'procesando'
+        """, (json.dumps(etapas), json.dumps(resultado), ahora + duracion_bloqueo, ahora, trabajo_id, worker))
+        return cur.rowcount > 0
+
+def reprogramar_trabajo(trabajo_id, worker, etapas, resultado, error, espera):
+    ahora = time.time()
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE trabajos
+            SET estado = 'pendiente', etapas = ?, resultado = ?, error = ?, intentos = intentos + 1,
+                proximo_intento = ?, bloqueado_hasta = 0, worker = NULL, actualizado_en = ?
+            WHERE id = ? AND worker = ? AND estado = 'procesando'
+        """, (json.dumps(etapas), json.dumps(resultado), error, ahora + espera, ahora, trabajo_id, worker))
+        return cur.rowcount > 0
+
+def finalizar_trabajo(trabajo_id, worker, estado, etapas, resultado, error=None):
+    ahora = time.time()
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE trabajos
+            SET estado = ?, etapas = ?, resultado = ?, error = ?, bloqueado_hasta = 0, worker = NULL, actualizado_en = ?
+            WHERE id = ? AND worker = ? AND estado = 'procesando'
+        """, (estado, json.dumps(etapas), json.dumps(resultado), error, ahora, trabajo_id, worker))
+        return cur.rowcount > 0
+
+def contar_trabajos_activos(tipo):
+    return _consultar_uno("SELECT COUNT(*) FROM trabajos WHERE tipo = ? AND estado IN ('pendiente', 'procesando')", (tipo,))[0]
+
+def obtener_resultados_recientes(tipo, limite=200):
+    """Resultados (dict) de los últimos trabajos terminados, para métricas agregadas."""
+    filas = _consultar("""
+        SELECT resultado FROM trabajos
+        WHERE tipo = ? AND estado IN ('completado', 'completado_con_errores')
+        ORDER BY id DESC LIMIT ?
+    """, (tipo, limite))
+    return [json.loads(r[0] or '{}') for r in filas]
+
+def purgar_trabajos_terminados(antes_de):
+    """Borra los trabajos terminados cuya última actualización es anterior a `antes_de` (epoch). Retorna cuántos."""
+    with transaccion() as cur:
+        cur.execute("""
+            DELETE FROM trabajos
+            WHERE estado IN ('completado', 'completado_con_errores') AND actualizado_en < ?
+        """, (antes_de,))
+        return cur.rowcount
+
+def obtener_trabajo(trabajo_id):
+    row = _consultar_uno(f"SELECT {_COLUMNAS_TRABAJO} FROM trabajos WHERE id = ?", (trabajo_id,))
+    return _fila_a_trabajo(row) if row else None
+
+# --- SESIONES DE SUBIDA A SHAREPOINT ---
+
+def guardar_sesion_subida(clave, upload_url, expira):
+    """Guarda la sesión (expira = expirationDateTime ISO de Graph) y purga las ya vencidas."""
+    with transaccion() as cur:
+        cur.execute("DELETE FROM sesiones_subida WHERE julianday(expira) < julianday('now')")
+        cur.execute("INSERT OR REPLACE INTO sesiones_subida (clave, upload_url, expira, creado_en) VALUES (?, ?, ?, ?)",
+                    (clave, upload_url, expira, time.time()))
+
+def obtener_sesion_subida(clave):
+    res = _consultar_uno("SELECT upload_url FROM sesiones_subida WHERE clave = ?", (clave,))
+    return res[0] if res else None
+
+def eliminar_sesion_subida(clave):
+    with transaccion() as cur:
+        cur.execute("DELETE FROM sesiones_subida WHERE clave = ?", (clave,))
+
+# --- IDEMPOTENCIA DE /reporte/crear ---
+
+def reclamar_clave_idempotencia(clave, expiracion_reclamo, ttl):
+    """
+    Intenta registrar la clave. Retorna (True, None) si esta petición es la primera,
+    o (False, trabajo_id) si ya existía (trabajo_id es None mientras la primera no termina).
+    Un reclamo sin trabajo más viejo que `expiracion_reclamo` segundos se considera
+    abandonado (la petición original murió) y se puede volver a tomar. De paso purga
+    todas las claves con más de `ttl` segundos (la tabla no crece sin límite).
+    """
+    ahora = time.time()
+    with transaccion(inmediata=True) as cur:
+        cur.execute("DELETE FROM idempotencia WHERE creado_en < ?", (ahora - ttl,))
+        cur.execute("DELETE FROM idempotencia WHERE clave = ? AND trabajo_id IS NULL AND creado_en < ?",
+                    (clave, ahora - expiracion_reclamo))
+        cur.execute("INSERT OR IGNORE INTO idempotencia (clave, trabajo_id, creado_en) VALUES (?, NULL, ?)", (clave, ahora))
+        reclamada = cur.rowcount == 1
+        trabajo_id = None
+        if not reclamada:
+            cur.execute("SELECT trabajo_id FROM idempotencia WHERE clave = ?", (clave,))
+            res = cur.fetchone()
+            trabajo_id = res[0] if res else None
+    return reclamada, trabajo_id
+
+def liberar_clave_idempotencia(clave):
+    with transaccion() as cur:
+        cur.execute("DELETE FROM idempotencia WHERE clave = ? AND trabajo_id IS NULL", (clave,))
+
+# --- ALMACÉN DE BLOBS (CONTADOR DE REFERENCIAS) ---
+# El movimiento/borrado del archivo ocurre dentro de la transacción (BEGIN IMMEDIATE)
+# para que un alta y una baja concurrentes del mismo hash no se crucen.
+
+def referenciar_blob(hash_hex, ruta, tamano, al_registrar):
+    """Suma una referencia al blob (creándolo si no existe) y ejecuta `al_registrar(ruta)`. Retorna la ruta."""
+    with transaccion(inmediata=True) as cur:
+        cur.execute("SELECT ruta FROM blobs WHERE hash = ?", (hash_hex,))
+        res = cur.fetchone()
+        if res:
+            ruta = res[0]
+            cur.execute("UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (hash_hex,))
+        else:
+            cur.execute("INSERT INTO blobs (hash, ruta, tamano, refs, creado_en) VALUES (?, ?, ?, 1, ?)",
+                        (hash_hex, ruta, tamano, time.time()))
+        al_registrar(ruta)
+    return ruta
+
+def liberar_blob(hash_hex, al_borrar):
+    """Resta una referencia; si llega a cero borra la fila y llama `al_borrar(hash, ruta)`. Retorna la ruta borrada o None."""
+    with transaccion(inmediata=True) as cur:
+        cur.execute("SELECT ruta, refs FROM blobs WHERE hash = ?", (hash_hex,))
+        res = cur.fetchone()
+        borrada = None
+        if res and res[1] <= 1:
+            cur.execute("DELETE FROM blobs WHERE hash = ?", (hash_hex,))
+            al_borrar(hash_hex, res[0])
+            borrada = res[0]
+        elif res:
+            cur.execute("UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (hash_hex,))
+    return borrada
+
+def referenciar_blob_existente(hash_hex):
+    """Suma una referencia a un blob ya registrado. Retorna su ruta, o None si no existe."""
+    with transaccion(inmediata=True) as cur:
+        cur.execute("SELECT ruta FROM blobs WHERE hash = ?", (hash_hex,))
+        res = cur.fetchone()
+        if not res:
+            return None
+        cur.execute("UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (hash_hex,))
+    return res[0]
+
+def obtener_blob(hash_hex):
+    return _consultar_uno("SELECT ruta, tamano, refs FROM blobs WHERE hash = ?", (hash_hex,))
+
+# --- SUBIDAS REANUDABLES ---
+
+_COLUMNAS_SUBIDA = "id, nombre, tamano_total, offset, estado, hash, creado_en, actualizado_en"
+
+def _fila_a_subida(row):
+    return {"id": row[0], "nombre": row[1], "tamano_total": row[2], "offset": row[3],
+            "estado": row[4], "hash": row[5], "creado_en": row[6], "actualizado_en": row[7]}
+
+def crear_subida(id_subida, nombre, tamano_total):
+    ahora = time.time()
+    with transaccion() as cur:
+        cur.execute("INSERT INTO subidas (id, nombre, tamano_total, offset, estado, creado_en, actualizado_en) VALUES (?, ?, ?, 0, 'abierta', ?, ?)",
+                    (id_subida, nombre, tamano_total, ahora, ahora))
+
+def obtener_subida(id_subida):
+    row = _consultar_uno(f"SELECT {_COLUMNAS_SUBIDA} FROM subidas WHERE id = ?", (id_subida,))
+    return _fila_a_subida(row) if row else None
+
+def reclamar_escritura_subida(id_subida, escritor, offset_esperado, duracion_bloqueo):
+    """
+    Toma el bloqueo de escritura de una subida abierta si su offset sigue siendo el esperado
+    y nadie más lo tiene (o el suyo venció). Sólo el dueño escribe el parcial y mueve el offset.
+    """
+    ahora = time.time()
+    with transaccion(inmediata=True) as cur:
+        cur.execute("""
+            UPDATE subidas SET escritor = ?, escritor_hasta = ?
+            WHERE id = ? AND offset = ? AND estado = 'abierta'
+              AND (escritor IS NULL OR escritor_hasta < ?)
+        """, (escritor, ahora + duracion_bloqueo, id_subida, offset_esperado, ahora))
+        return cur.rowcount == 1
+
+def renovar_escritura_subida(id_subida, escritor, duracion_bloqueo):
+    """Extiende el bloqueo antes de escribir otro trozo; False si ya no es del escritor."""
+    with transaccion() as cur:
+        cur.execute("UPDATE subidas SET escritor_hasta = ? WHERE id = ? AND escritor = ? AND estado = 'abierta'",
+                    (time.time() + duracion_bloqueo, id_subida, escritor))
+        return cur.rowcount == 1
+
+def liberar_escritura_subida(id_subida, escritor):
+    with transaccion() as cur:
+        cur.execute("UPDATE subidas SET escritor = NULL, escritor_hasta = 0 WHERE id = ? AND escritor = ?",
+                    (id_subida, escritor))
+
+def avanzar_subida(id_subida, escritor, offset_esperado, nuevo_offset, tamano_total=None):
+    """Mueve el offset tras escribir, sólo si el bloqueo sigue siendo del escritor."""
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE subidas SET offset = ?, tamano_total = COALESCE(tamano_total, ?), actualizado_en = ?
+            WHERE id = ? AND escritor = ? AND offset = ? AND estado = 'abierta'
+        """, (nuevo_offset, tamano_total, time.time(), id_subida, escritor, offset_esperado))
+        ok = cur.rowcount == 1
+    return ok
+
+def reiniciar_subida(id_subida, escritor):
+    """Vuelve el offset a 0 (p. ej. tras un checksum fallido): el cliente sube todo de nuevo."""
+    with transaccion() as cur:
+        cur.execute("UPDATE subidas SET offset = 0, actualizado_en = ? WHERE id = ? AND escritor = ? AND estado = 'abierta'",
+                    (time.time(), id_subida, escritor))
+
+def completar_subida(id_subida, hash_hex):
+    with transaccion() as cur:
+        cur.execute("UPDATE subidas SET estado = 'completa', hash = ?, escritor = NULL, actualizado_en = ? WHERE id = ?",
+                    (hash_hex, time.time(), id_subida))
+
+def obtener_subidas_vencidas(antes_de):
+    filas = _consultar(f"SELECT {_COLUMNAS_SUBIDA} FROM subidas WHERE actualizado_en < ?", (antes_de,))
+    return [_fila_a_subida(r) for r in filas]
+
+def eliminar_subida(id_subida):
+    with transaccion() as cur:
+        cur.execute("DELETE FROM subidas WHERE id = ?", (id_subida,))
+
+
+if __name__ == "__main__":
+    import sys
+    inicializar_db()
+    if sys.argv[1:] == ["reconstruir_kpis"]:
+        print(f"Contadores KPI reconstruidos ({reconstruir_kpis()} corregidos)")
+    else:
+        print("Uso: python database.py reconstruir_kpis")
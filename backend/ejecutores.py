@@ -0,0 +1,40 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import config
+
+# Ejecutores acotados para sacar trabajo bloqueante del event loop de FastAPI.
+# - EJECUTOR_IO: escritura de archivos, sqlite3 y llamadas HTTP síncronas.
+# - Pool de procesos (perezoso): trabajo CPU puro que sufriría con el GIL.
+#   Sus procesos salen de un forkserver (o spawn), no de un fork de la API: ésta ya tiene
+#   hilos corriendo y un hijo podría heredar un lock tomado (p. ej. el de stdout) y colgarse.
+
+EJECUTOR_IO = ThreadPoolExecutor(max_workers=config.HILOS_IO, thread_name_prefix="io")
+
+_ejecutor_cpu = None
+
+def contexto_procesos():
+    """Contexto de multiprocessing para todo proceso que lance la API (pool CPU y workers)."""
+    metodo = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(metodo)
+
+def ejecutor_cpu():
+    global _ejecutor_cpu
+    if _ejecutor_cpu is None:
+        _ejecutor_cpu = ProcessPoolExecutor(max_workers=config.PROCESOS_CPU, mp_context=contexto_procesos())
+    return _ejecutor_cpu
+
+async def en_hilo(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(EJECUTOR_IO, functools.partial(fn, *args, **kwargs))
+
+async def en_proceso(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ejecutor_cpu(), functools.partial(fn, *args, **kwargs))
+
+def cerrar():
+    EJECUTOR_IO.shutdown(wait=False)
+    if _ejecutor_cpu is not None:
+        _ejecutor_cpu.shutdown(wait=False)
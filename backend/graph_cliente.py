@@ -0,0 +1,185 @@
+import time
+import random
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+import metricas
+
+# Códigos en los que Graph pide volver a intentar (throttling / caída temporal)
+_CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+# Métodos que se pueden repetir aunque el servidor alcanzara a recibir la petición
+_METODOS_IDEMPOTENTES = {"GET", "PUT", "DELETE", "HEAD"}
+# Para el resto (POST: sendMail, crear item, crear sesión) un 500/502/504 no garantiza que
+# no se haya aplicado: sólo se reintentan los rechazos explícitos (throttling / no disponible)
+_CODIGOS_REINTENTABLES_NO_IDEMPOTENTES = {429, 503}
+
+
+def _reintentable(metodo, estado):
+    if metodo.upper() in _METODOS_IDEMPOTENTES:
+        return estado in _CODIGOS_REINTENTABLES
+    return estado in _CODIGOS_REINTENTABLES_NO_IDEMPOTENTES
+
+URL_BATCH = "https://graph.microsoft.com/v1.0/$batch"
+# Máximo de sub-requests que Graph acepta por $batch
+TAM_LOTE = 20
+
+
+class ClienteGraph:
+    """
+    Cliente HTTP compartido para Microsoft Graph y Azure AD.
+    - Session con pool keep-alive (una conexión TLS reutilizada por host).
+    - Timeouts de conexión y lectura en todas las llamadas.
+    - Backoff exponencial con jitter que respeta Retry-After en 429/503.
+    - Los POST sólo se repiten si Graph no los aplicó (429/503 o sin conexión establecida).
+    - Ante un 401 pide un token nuevo con `renovar_token` y repite la llamada una vez.
+    - Latencia y reintentos por endpoint en metricas.
+    """
+    def __init__(self, timeout_conexion, timeout_lectura, max_reintentos, espera_base, tam_pool):
+        self.timeout = (timeout_conexion, timeout_lectura)
+        self.max_reintentos = max_reintentos
+        self.espera_base = espera_base
+        self.session = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=tam_pool, pool_maxsize=tam_pool)
+        self.session.mount("https://", adaptador)
+        self.session.mount("http://", adaptador)
+        # renovar_token(token_rechazado) -> token nuevo o None. Lo registra utils (que es
+        # quien cachea el token); aquí no se importa para no crear un ciclo.
+        self.renovar_token = None
+
+    def _espera(self, intento, response=None):
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), 120.0)
+                except ValueError:
+                    pass
+        # Full jitter: entre 0 y base * 2^intento
+        return random.uniform(0, self.espera_base * (2 ** intento))
+
+    def solicitar(self, metodo, url, endpoint="graph", **kwargs):
+        """
+        Igual que requests.request, pero con pool, timeouts y reintentos.
+        `endpoint` es la etiqueta con la que se agrupan las métricas.
+        Retorna el último Response (o relanza la última excepción de red).
+        """
+        metodo = metodo.upper()
+        kwargs.setdefault("timeout", self.timeout)
+        # Si el cuerpo es un archivo, hay que rebobinarlo antes de cada reintento
+        cuerpo = kwargs.get("data")
+        posicion = cuerpo.tell() if hasattr(cuerpo, "seek") else None
+
+        intento = 0
+        token_renovado = False
+        while True:
+            if posicion is not None:
+                cuerpo.seek(posicion)
+            inicio = time.perf_counter()
+            response, error_red = None, None
+            try:
+                response = self.session.request(metodo, url, **kwargs)
+                reintentable = _reintentable(metodo, response.status_code)
+            except requests.exceptions.ConnectTimeout as e:
+                error_red, reintentable = e, True
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error_red, reintentable = e, metodo in _METODOS_IDEMPOTENTES
+            metricas.observar(f"graph_ms {endpoint}", (time.perf_counter() - inicio) * 1000)
+
+            # Token revocado o expirado antes de lo previsto: Graph no aplicó la petición,
+            # así que se repite una vez (con cualquier método) con un token nuevo
+            if response is not None and response.status_code == 401 and not token_renovado:
+                headers = kwargs.get("headers") or {}
+                autorizacion = headers.get("Authorization", "")
+                if self.renovar_token and autorizacion.startswith("Bearer "):
+                    token_renovado = True
+                    nuevo = self.renovar_token(autorizacion[len("Bearer "):])
+                    if nuevo:
+                        kwargs["headers"] = {**headers, "Authorization": f"Bearer {nuevo}"}
+                        metricas.incrementar(f"graph_token_renovado {endpoint}")
+                        print(f"↻ Graph {endpoint}: 401, se repite con un token nuevo")
+                        continue
+
+            if not reintentable or intento >= self.max_reintentos:
+                if error_red:
+                    metricas.incrementar(f"graph_errores {endpoint}")
+                    raise error_red
+                if response.status_code >= 400:
+                    metricas.incrementar(f"graph_errores {endpoint}")
+                return response
+
+            espera = self._espera(intento, response)
+            metricas.incrementar(f"graph_reintentos {endpoint}")
+            estado = "error de red" if error_red else response.status_code
+            print(f"↻ Graph {endpoint}: {estado}, reintento {intento + 1} en {espera:.1f}s")
+            time.sleep(espera)
+            intento += 1
+
+    def get(self, url, endpoint="graph", **kwargs):
+        return self.solicitar("GET", url, endpoint, **kwargs)
+
+    def post(self, url, endpoint="graph", **kwargs):
+        return self.solicitar("POST", url, endpoint, **kwargs)
+
+    def put(self, url, endpoint="graph", **kwargs):
+        return self.solicitar("PUT", url, endpoint, **kwargs)
+
+    # --- JSON $batch ---
+    def lote(self, solicitudes, headers, endpoint="batch"):
+        """
+        Ejecuta operaciones independientes vía POST /$batch, de a TAM_LOTE por petición.
+        `solicitudes`: lista de dicts {"id", "method", "url" (relativa a /v1.0), "body"?}.
+        Los sub-requests con 429/5xx se reintentan solos (respetando Retry-After), salvo los
+        POST con 500/502/504, que pudieron aplicarse; los demás errores se devuelven tal cual.
+        Retorna {id: {"status": int, "body": dict, "headers": dict}}.
+        """
+        resultados = {}
+        pendientes = list(solicitudes)
+        intento = 0
+        while pendientes:
+            reintentar = []
+            espera = 0.0
+            for i in range(0, len(pendientes), TAM_LOTE):
+                grupo = pendientes[i:i + TAM_LOTE]
+                requests_lote = []
+                for sol in grupo:
+                    item = {"id": str(sol["id"]), "method": sol["method"], "url": sol["url"]}
+                    if sol.get("body") is not None:
+                        item["body"] = sol["body"]
+                        item["headers"] = {"Content-Type": "application/json"}
+                    requests_lote.append(item)
+                r = self.post(URL_BATCH, endpoint=endpoint, headers=headers, json={"requests": requests_lote})
+                if r.status_code != 200:
+                    for sol in grupo:
+                        resultados[str(sol["id"])] = {"status": r.status_code, "body": {"error": r.text}, "headers": {}}
+                    continue
+                por_id = {str(sol["id"]): sol for sol in grupo}
+                for resp in r.json().get("responses", []):
+                    resultados[resp["id"]] = {
+                        "status": resp.get("status"),
+                        "body": resp.get("body") or {},
+                        "headers": resp.get("headers") or {},
+                    }
+                    if _reintentable(por_id[resp["id"]]["method"], resp.get("status")):
+                        reintentar.append(por_id[resp["id"]])
+                        try:
+                            espera = max(espera, float((resp.get("headers") or {}).get("Retry-After", 0)))
+                        except ValueError:
+                            pass
+            metricas.incrementar(f"batch_subrequests {endpoint}", len(pendientes))
+            if not reintentar or intento >= self.max_reintentos:
+                break
+            metricas.incrementar(f"batch_reintentos {endpoint}", len(reintentar))
+            time.sleep(min(espera, 120.0) or self._espera(intento))
+            pendientes = reintentar
+            intento += 1
+        return resultados
+
+
+cliente = ClienteGraph(
+    timeout_conexion=config.GRAPH_TIMEOUT_CONEXION,
+    timeout_lectura=config.GRAPH_TIMEOUT_LECTURA,
+    max_reintentos=config.GRAPH_MAX_REINTENTOS,
+    espera_base=config.GRAPH_ESPERA_BASE,
+    tam_pool=config.GRAPH_TAM_POOL,
+)
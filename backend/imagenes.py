@@ -0,0 +1,64 @@
+import os
+import time
+from PIL import Image, ImageOps
+
+import config
+
+# Normalización de fotos de evidencia antes de generar el PDF.
+# generar_pdf las dibuja en celdas de 45x35 mm: no tiene sentido embeber 12 MP.
+
+ANCHO_FOTO_MM = 45
+ALTO_FOTO_MM = 35
+
+
+def _px(mm, dpi):
+    return int(round(mm / 25.4 * dpi))
+
+def normalizar_imagen(ruta, ancho_mm=ANCHO_FOTO_MM, alto_mm=ALTO_FOTO_MM, dpi=None, calidad=None, destino=None):
+    """
+    Corrige la orientación EXIF, reduce la foto a la resolución que ocupará en el PDF
+    (`dpi` sobre `ancho_mm` x `alto_mm`) y la re-codifica como JPEG con calidad acotada.
+    Con `destino` escribe ahí y deja intacta la original (derivado cacheado del almacén);
+    si `destino` ya existe se reutiliza sin volver a procesar.
+    Se ejecuta en el pool de procesos (ejecutores.en_proceso), por eso es una función simple.
+    Retorna {'ruta', 'bytes_antes', 'bytes_despues', 'ms'}; si algo falla deja la original.
+    """
+    dpi = dpi or config.IMAGEN_DPI
+    calidad = calidad or config.IMAGEN_CALIDAD
+    inicio = time.perf_counter()
+    bytes_antes = os.path.getsize(ruta)
+    resultado = {"ruta": ruta, "bytes_antes": bytes_antes, "bytes_despues": bytes_antes, "ms": 0.0}
+    if destino and os.path.exists(destino):
+        resultado["ruta"] = destino
+        resultado["bytes_despues"] = os.path.getsize(destino)
+        return resultado
+    try:
+        with Image.open(ruta) as img:
+            objetivo = (_px(ancho_mm, dpi), _px(alto_mm, dpi))
+            orientacion = img.getexif().get(0x0112, 1)
+            if img.width <= objetivo[0] and img.height <= objetivo[1] and orientacion == 1 and img.format == "JPEG":
+                # Ya es pequeña y derecha: no vale la pena re-codificar
+                resultado["ms"] = round((time.perf_counter() - inicio) * 1000, 2)
+                return resultado
+
+            # JPEG: decodifica directo a una escala menor (antes de rotar, así que pedimos el lado mayor)
+            lado = max(objetivo)
+            img.draft("RGB", (lado, lado))
+            img = ImageOps.exif_transpose(img)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.thumbnail(objetivo, Image.LANCZOS)
+
+            reemplazar = destino is None
+            destino = destino or os.path.splitext(ruta)[0] + ".jpg"
+            temporal = f"{destino}.{os.getpid()}.tmp"
+            img.save(temporal, "JPEG", quality=calidad, optimize=True)
+        os.replace(temporal, destino)
+        if reemplazar and destino != ruta and os.path.exists(ruta):
+            os.remove(ruta)
+        resultado["ruta"] = destino
+        resultado["bytes_despues"] = os.path.getsize(destino)
+    except Exception as e:
+        print(f"⚠️ No se pudo normalizar {ruta}: {e}")
+    resultado["ms"] = round((time.perf_counter() - inicio) * 1000, 2)
+    return resultado
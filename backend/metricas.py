@@ -0,0 +1,72 @@
+import time
+import asyncio
+import threading
+from collections import defaultdict, deque
+
+# Registro de métricas en memoria del proceso (contadores, valores y muestras de latencia).
+# Se expone en GET /sistema/metricas. Cada proceso (API o worker) tiene el suyo.
+
+_lock = threading.Lock()
+_contadores = defaultdict(float)
+_valores = {}
+_muestras = defaultdict(lambda: deque(maxlen=2000))
+
+
+def incrementar(nombre, valor=1):
+    with _lock:
+        _contadores[nombre] += valor
+
+def fijar(nombre, valor):
+    with _lock:
+        _valores[nombre] = valor
+
+def observar(nombre, valor):
+    with _lock:
+        _muestras[nombre].append(valor)
+
+def _percentil(ordenados, p):
+    if not ordenados: return None
+    idx = min(len(ordenados) - 1, int(round(p / 100.0 * (len(ordenados) - 1))))
+    return ordenados[idx]
+
+def resumen_muestras(nombre):
+    with _lock:
+        datos = list(_muestras.get(nombre, ()))
+    return resumir(datos)
+
+def resumir(valores):
+    """Percentiles de una lista de valores (para muestras que no viven en este proceso)."""
+    datos = sorted(valores)
+    if not datos:
+        return {"n": 0}
+    return {
+        "n": len(datos),
+        "p50": round(_percentil(datos, 50), 3),
+        "p95": round(_percentil(datos, 95), 3),
+        "p99": round(_percentil(datos, 99), 3),
+        "max": round(datos[-1], 3),
+    }
+
+def instantanea():
+    with _lock:
+        contadores = dict(_contadores)
+        valores = dict(_valores)
+        nombres = list(_muestras.keys())
+    return {
+        "contadores": contadores,
+        "valores": valores,
+        "latencias": {n: resumen_muestras(n) for n in nombres},
+    }
+
+
+# --- LAG DEL EVENT LOOP ---
+# Duerme `intervalo` segundos y mide cuánto tarde despierta. Si algo bloquea el loop
+# (I/O síncrono, render de PDF), el retraso aparece aquí.
+
+async def monitorear_lag_event_loop(intervalo=0.5):
+    while True:
+        inicio = time.perf_counter()
+        await asyncio.sleep(intervalo)
+        lag_ms = max(0.0, (time.perf_counter() - inicio - intervalo) * 1000)
+        observar("event_loop_lag_ms", lag_ms)
+        fijar("event_loop_lag_ms_ultimo", round(lag_ms, 3))
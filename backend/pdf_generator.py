@@ -1,10 +1,35 @@
 import os
+import time
 import tempfile
 from fpdf import FPDF
 from fpdf.enums import XPos, YPos
+from PIL import Image
 import config
 import utils
 
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_SIN_RESOLVER = object()
+_logo = _SIN_RESOLVER
+
+def _imagen_logo():
+    """
+    Logo ya decodificado (PIL Image) o None. Se lee del disco una vez por proceso y cada
+    documento reutiliza la misma imagen en memoria.
+    """
+    global _logo
+    if _logo is _SIN_RESOLVER:
+        candidatos = [os.path.join(_BASE_DIR, "assets", n) for n in ("logo.png", "logo2.png")]
+        ruta = next((c for c in candidatos if os.path.exists(c)), None)
+        _logo = None
+        if ruta:
+            try:
+                with Image.open(ruta) as img:
+                    img.load()
+                    _logo = img.copy()
+            except Exception as e:
+                print(f"No se pudo cargar el logo {ruta}: {e}")
+    return _logo
+
 class PDFReporte(FPDF):
     def header(self):
         # 1. Fondo Cabecera Moderna (Azul con una línea inferior más oscura)
@@ -13,15 +38,8 @@ class PDFReporte(FPDF):
         self.set_fill_color(0, 86, 163) # Azul Oscuro (borde inferior)
         self.rect(0, 40, 210, 2, 'F')
         
-        # 2. Logo (Misma lógica de rutas)
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        logo_path = os.path.join(base_dir, "assets", "logo.png")
-        logo2_path = os.path.join(base_dir, "assets", "logo2.png")
-        
-        logo_final = None
-        if os.path.exists(logo_path): logo_final = logo_path
-        elif os.path.exists(logo2_path): logo_final = logo2_path
-            
+        # 2. Logo (decodificado una vez por proceso, ver _imagen_logo)
+        logo_final = _imagen_logo()
         if logo_final:
             try: 
                 self.image(logo_final, x=10, y=8, h=24) 
@@ -44,7 +62,46 @@ class PDFReporte(FPDF):
         self.set_text_color(150, 150, 150)
         self.cell(0, 10, f'Tecnocomp Ltda - Pág {self.page_no()}/{{nb}}', 0, 0, 'C')
 
+# Lienzo por defecto de las firmas (el mismo de utils.guardar_firma_img)
+LIENZO_FIRMA = (400, 200)
+
+def _dibujar_firma_vectorial(pdf, trazos, lienzo, x, y, alto):
+    """Dibuja los trazos de la firma como paths escalados a `alto` mm, sin pasar por PNG."""
+    _, alto_lienzo = lienzo or LIENZO_FIRMA
+    escala = alto / float(alto_lienzo)
+    with pdf.local_context(line_width=0.35, draw_color=(0, 0, 0), stroke_cap_style="ROUND", stroke_join_style="ROUND"):
+        for trazo in trazos:
+            puntos = [(x + px * escala, y + py * escala) for px, py in trazo]
+            if len(puntos) == 1:
+                pdf.line(puntos[0][0], puntos[0][1], puntos[0][0] + 0.01, puntos[0][1])  # Un toque: punto
+            else:
+                pdf.polyline(puntos, style="D")
+
 def generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios):
+    """Genera el PDF en el directorio temporal y retorna su ruta."""
+    nombre_archivo, contenido = generar_pdf_en_memoria(cliente, tecnico, obs, path_firma, datos_usuarios)
+    ruta = os.path.join(tempfile.gettempdir(), nombre_archivo)
+    with open(ruta, "wb") as f:
+        f.write(contenido)
+    return ruta
+
+def precalentar():
+    """
+    Deja listo el proceso para renderizar: carga el logo y genera un documento de prueba
+    (importa los módulos de imagen de fpdf2/PIL y carga las métricas de Helvetica).
+    Lo llama cada worker al iniciar para que el primer reporte no pague ese costo. Retorna ms.
+    """
+    inicio = time.perf_counter()
+    _imagen_logo()
+    generar_pdf_en_memoria("Precalentado", "-", "", None, [{"nombre": "-", "atendido": True, "trabajo": "a,b"}])
+    return round((time.perf_counter() - inicio) * 1000, 2)
+
+def generar_pdf_en_memoria(cliente, tecnico, obs, path_firma, datos_usuarios, estadisticas=None):
+    """
+    Genera el PDF sin tocar el disco. Retorna (nombre_archivo, bytearray).
+    Si se pasa el dict `estadisticas`, se completa con 'ms', 'paginas' y 'bytes'.
+    """
+    inicio = time.perf_counter()
     pdf = PDFReporte(orientation='P', unit='mm', format='A4')
     pdf.alias_nb_pages()
     pdf.set_auto_page_break(auto=True, margin=15)
@@ -184,9 +241,10 @@ def generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios):
             if count > 0 or (count == 0 and x_fotos == 12):
                 pdf.set_y(y_fotos + 40 if count > 0 else y_fotos)
 
-        # --- FIRMA USUARIO ---
+        # --- FIRMA USUARIO (vectorial si vienen los trazos; si no, la imagen subida) ---
         firma_usr = u.get('firma')
-        if firma_usr and os.path.exists(firma_usr):
+        trazos_firma = u.get('firma_trazos')
+        if trazos_firma or (firma_usr and os.path.exists(firma_usr)):
             # Verificar espacio
             if pdf.get_y() > 250: pdf.add_page()
             
@@ -194,9 +252,13 @@ def generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios):
             pdf.set_font("Helvetica", "I", 8)
             pdf.set_text_color(128, 128, 128)
             pdf.cell(0, 4, f"Conformidad: {u['nombre']}", 0, 1)
-            try:
-                pdf.image(firma_usr, x=15, h=12)
-            except: pass
+            if trazos_firma:
+                _dibujar_firma_vectorial(pdf, trazos_firma, u.get('firma_lienzo'), x=15, y=pdf.get_y(), alto=12)
+                pdf.set_y(pdf.get_y() + 12)
+            else:
+                try:
+                    pdf.image(firma_usr, x=15, h=12)
+                except: pass
         
         pdf.ln(5)
         # Línea separadora suave
@@ -224,10 +286,14 @@ def generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios):
     # Si quieres poner un pie de página o firma del técnico al final
     pdf.ln(10)
 
-    # Guardar
-    temp_dir = tempfile.gettempdir()
+    # Nombre y contenido: el bytearray de fpdf2 tal cual, sin copiarlo (los consumidores sólo lo leen)
     nombre_clean = "".join([c for c in cliente if c.isalnum() or c in (' ','-','_')]).strip()
     nombre_archivo = f"Reporte_{nombre_clean}_{utils.obtener_hora_chile().strftime('%Y%m%d_%H%M')}.pdf"
-    ruta = os.path.join(temp_dir, nombre_archivo)
-    pdf.output(ruta)
-    return ruta
\ No newline at end of file
+    contenido = pdf.output()
+    if estadisticas is not None:
+        estadisticas.update({
+            "ms": round((time.perf_counter() - inicio) * 1000, 2),
+            "paginas": pdf.pages_count,
+            "bytes": len(contenido),
+        })
+    return nombre_archivo, contenido
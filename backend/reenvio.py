@@ -0,0 +1,89 @@
+import os
+import time
+import threading
+from datetime import datetime
+
+import database
+import utils
+import metricas
+import config
+
+# Reenvío de correos pendientes (reportes con email_enviado = 0).
+# Corre como hilo dentro de la API (REENVIO_ACTIVO=1) o aparte con `python reenvio.py`.
+# Varios procesos pueden correrlo a la vez: cada ciclo reclama sus filas antes de enviar.
+
+
+def _espera_reintento(intentos):
+    """Backoff exponencial por reporte, con tope."""
+    return min(config.REENVIO_ESPERA_MAXIMA, config.REENVIO_ESPERA_BASE * (2 ** max(0, intentos)))
+
+def _pdf_archivado(ruta):
+    carpeta = os.path.abspath(config.PDF_ARCHIVO_FOLDER)
+    return bool(ruta) and os.path.abspath(ruta).startswith(carpeta + os.sep)
+
+def _registrar(fila, ok, msg):
+    id_rep, pdf_path, intentos = fila[0], fila[1], (fila[6] or 0) + 1
+    agotado = not ok and intentos >= config.REENVIO_MAX_INTENTOS
+    proximo = 0 if ok or agotado else time.time() + _espera_reintento(intentos)
+    database.registrar_intento_email(id_rep, ok, msg, proximo, agotado=agotado)
+    metricas.incrementar("reenvio_ok" if ok else "reenvio_agotado" if agotado else "reenvio_fallido")
+    print(f"{'📧' if ok else '❌' if agotado else '⚠️'} Reenvío reporte {id_rep}: {msg}"
+          + (f" (sin más reintentos tras {intentos})" if agotado else ""))
+    if ok and not config.ARCHIVAR_PDF and _pdf_archivado(pdf_path):
+        # Se archivó sólo para el reenvío: ya no hace falta
+        try:
+            os.remove(pdf_path)
+        except OSError as e:
+            print(f"⚠️ No se pudo borrar {pdf_path}: {e}")
+        database.quitar_pdf_reporte(id_rep)
+    return ok
+
+def actualizar_metricas_pendientes():
+    cantidad, fecha_min = database.estadisticas_pendientes_email()
+    metricas.fijar("reenvio_pendientes", cantidad)
+    antiguedad = None
+    if fecha_min:
+        try:
+            # fecha se guarda en hora de Chile (utils.obtener_hora_chile)
+            ahora = utils.obtener_hora_chile().replace(tzinfo=None)
+            antiguedad = int((ahora - datetime.strptime(fecha_min[:19], '%Y-%m-%d %H:%M:%S')).total_seconds())
+        except ValueError:
+            pass
+    metricas.fijar("reenvio_antiguedad_max_segundos", antiguedad)
+    return cantidad, antiguedad
+
+def ejecutar_ciclo():
+    """Reenvía juntos (vía $batch) los pendientes cuyo backoff venció. Retorna cuántos se intentaron."""
+    filas = database.reclamar_reportes_para_reenvio(time.time(), config.REENVIO_LOTE, config.REENVIO_BLOQUEO_SEGUNDOS)
+    if filas:
+        envios = {
+            id_rep: {"ruta_pdf": pdf_path or "", "cliente": cliente, "tecnico": tecnico,
+                     "email_tecnico": email_tecnico, "web_url": web_url}
+            for id_rep, pdf_path, cliente, tecnico, email_tecnico, web_url, _ in filas
+        }
+        resultados = utils.enviar_correos_lote(envios)
+        for fila in filas:
+            _registrar(fila, *resultados.get(fila[0], (False, "Sin respuesta del lote")))
+    actualizar_metricas_pendientes()
+    return len(filas)
+
+def ejecutar_programador(detener=None):
+    detener = detener or threading.Event()
+    print("📬 Reenvío de correos pendientes iniciado")
+    while not detener.is_set():
+        try:
+            ejecutar_ciclo()
+        except Exception as e:
+            print(f"Error en ciclo de reenvío: {e}")
+        detener.wait(config.REENVIO_INTERVALO_SEGUNDOS)
+
+def iniciar_programador():
+    """Lanza el programador en un hilo daemon. Retorna el Event para detenerlo."""
+    detener = threading.Event()
+    threading.Thread(target=ejecutar_programador, args=(detener,), name="reenvio", daemon=True).start()
+    return detener
+
+
+if __name__ == "__main__":
+    database.inicializar_db()
+    ejecutar_programador()
@@ -0,0 +1,107 @@
+import os
+import sys
+
+# Antes de importar config: sin workers ni reenvío en segundo plano durante las pruebas
+os.environ["WORKERS_REPORTES"] = "0"
+os.environ["REENVIO_ACTIVO"] = "0"
+os.environ["PRECALENTAR_GRAPH"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import requests
+
+import config
+import database
+
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    """Cada prueba usa su propia BD migrada y sus propias carpetas (nunca visitas.db)."""
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "visitas.db"))
+    for nombre in ("TRABAJOS_FOLDER", "PDF_ARCHIVO_FOLDER", "ALMACEN_FOLDER"):
+        carpeta = tmp_path / nombre.lower()
+        carpeta.mkdir()
+        monkeypatch.setattr(config, nombre, str(carpeta))
+    database.inicializar_db()
+    yield database.DB_NAME
+    database.cerrar_conexion()
+
+
+@pytest.fixture(scope="session")
+def _app(tmp_path_factory):
+    # api.py migra la BD al importarse: que sea una temporal. La app (y sus ejecutores,
+    # que se apagan en el shutdown) vive toda la sesión; cada prueba cambia DB_NAME y las
+    # conexiones por hilo se reabren solas contra la BD nueva.
+    database.DB_NAME = str(tmp_path_factory.mktemp("api") / "visitas.db")
+    import api
+    from fastapi.testclient import TestClient
+    with TestClient(api.app) as cliente:
+        yield cliente
+
+
+@pytest.fixture
+def cliente(_app, db):
+    return _app
+
+
+class RespuestaFalsa:
+    def __init__(self, status_code, cuerpo=None, headers=None):
+        self.status_code = status_code
+        self._cuerpo = cuerpo if cuerpo is not None else {}
+        self.headers = headers or {}
+        self.text = str(self._cuerpo)
+
+    def json(self):
+        return self._cuerpo
+
+
+class SharePointFalso:
+    """
+    Sesiones de subida de Graph en memoria (createUploadSession, PUT de rangos y GET de
+    estado). Con `caido = True` los PUT fallan como un corte de red; con `caer_tras = n`
+    la red se corta después de n fragmentos aceptados.
+    """
+    def __init__(self):
+        self.sesiones = {}
+        self.subidos = {}
+        self.creadas = 0
+        self.fragmentos = 0
+        self.caido = False
+        self.caer_tras = None
+
+    def post(self, url, endpoint="graph", **kwargs):
+        assert url.endswith(":/createUploadSession")
+        self.creadas += 1
+        upload_url = f"https://subida.invalid/{self.creadas}"
+        self.sesiones[upload_url] = bytearray()
+        return RespuestaFalsa(200, {"uploadUrl": upload_url, "expirationDateTime": "2999-01-01T00:00:00Z"})
+
+    def get(self, url, endpoint="graph", **kwargs):
+        if url not in self.sesiones:
+            return RespuestaFalsa(404)
+        return RespuestaFalsa(200, {"nextExpectedRanges": [f"{len(self.sesiones[url])}-"]})
+
+    def put(self, url, endpoint="graph", headers=None, data=None, **kwargs):
+        if self.caido or self.fragmentos == self.caer_tras:
+            self.caido = True
+            raise requests.exceptions.ConnectionError("corte simulado")
+        rango, total = headers["Content-Range"].split(" ")[1].split("/")
+        recibido = self.sesiones[url]
+        if int(rango.split("-")[0]) != len(recibido):
+            return RespuestaFalsa(416)
+        recibido.extend(data)
+        self.fragmentos += 1
+        if len(recibido) == int(total):
+            self.subidos[url] = bytes(self.sesiones.pop(url))
+            return RespuestaFalsa(201, {"webUrl": "https://sharepoint.invalid/reporte.pdf"})
+        return RespuestaFalsa(202, {"nextExpectedRanges": [f"{len(recibido)}-"]})
+
+
+@pytest.fixture
+def sharepoint_falso(monkeypatch):
+    import graph_cliente
+    falso = SharePointFalso()
+    for metodo in ("get", "post", "put"):
+        monkeypatch.setattr(graph_cliente.cliente, metodo, getattr(falso, metodo))
+    monkeypatch.setattr(config, "SHAREPOINT_TAM_FRAGMENTO", 1000)
+    return falso
@@ -0,0 +1,47 @@
+import json
+
+import database
+
+
+def _reporte(obs, usuarios=(), cliente="Intermar", fecha="2024-05-10 10:00:00"):
+    return database.guardar_reporte(fecha, cliente, "Pedro", obs, "[]", None, json.dumps(list(usuarios)), 0)
+
+
+def _ids(cliente_http, **params):
+    r = cliente_http.get("/reportes/buscar", params=params)
+    assert r.status_code == 200
+    return [item["id"] for item in r.json()]
+
+
+def test_busca_en_observaciones_y_en_trabajo_y_motivo(cliente):
+    obs = _reporte("Impresora HP-M402 atascada")
+    trabajo = _reporte("Sin novedad", [{"nombre": "Ana", "atendido": True, "trabajo": "Cambio de tóner"}])
+    motivo = _reporte("Sin novedad", [{"nombre": "Luis", "atendido": False, "motivo": "Licencia médica"}])
+
+    assert _ids(cliente, q="HP-M402") == [obs]
+    assert _ids(cliente, q="toner") == [trabajo]  # sin tildes
+    assert _ids(cliente, q="licencia medica") == [motivo]
+    assert _ids(cliente, q="licencia tóner") == []  # todos los términos son obligatorios
+    r = cliente.get("/reportes/buscar", params={"q": "toner"}).json()[0]
+    assert "[tóner]" in r["extracto"]
+
+
+def test_prefijo_filtros_y_cambios_del_reporte(cliente):
+    a = _reporte("Cambio de teclado")
+    _reporte("Cambio de teclado", cliente="Bodega Sur", fecha="2024-06-01 10:00:00")
+
+    assert _ids(cliente, q="tecl") == []
+    assert len(_ids(cliente, q="tecl", prefijo=True)) == 2 and len(_ids(cliente, q="tecl*")) == 2
+    assert _ids(cliente, q="teclado", cliente="Intermar") == [a]
+    assert _ids(cliente, q="teclado", hasta="2024-05-31") == [a]
+
+    database.actualizar_reporte(a, "2024-05-10 10:00:00", "Intermar", "Pedro", "Cambio de mouse", "[]", None, "[]", 0)
+    assert _ids(cliente, q="mouse") == [a] and _ids(cliente, q="teclado", cliente="Intermar") == []
+    database.eliminar_reporte(a)
+    assert _ids(cliente, q="mouse") == []
+
+
+def test_busqueda_vacia_o_con_comillas(cliente):
+    _reporte('Nota "rara" con comillas')
+    assert cliente.get("/reportes/buscar", params={"q": ' " * '}).status_code == 400
+    assert len(_ids(cliente, q='"rara')) == 1
@@ -0,0 +1,57 @@
+import json
+
+import config
+import database
+
+_REINICIO = "Reinicio Forzado (Shutdown -r -f -t 00)"
+_TEMPORALES = "Borrar Temporales (%temp%)"
+
+
+def _reporte(usuarios, cliente="Intermar"):
+    return database.guardar_reporte("2024-05-10 10:00:00", cliente, "Pedro", "obs", "[]", None,
+                                    json.dumps(usuarios), 0)
+
+
+def _tareas(reporte_id):
+    return database._consultar("""
+        SELECT u.nombre, t.tarea, t.hora FROM reporte_usuario_tareas t
+        JOIN reporte_usuarios u ON u.id = t.reporte_usuario_id
+        WHERE u.reporte_id = ? ORDER BY u.posicion, t.tarea
+    """, (reporte_id,))
+
+
+def test_tareas_salen_del_texto_trabajo_o_de_tareas_map():
+    reporte_id = _reporte([
+        {"nombre": "Ana", "atendido": True, "trabajo": f"{_REINICIO} (10:32), Cambio de mouse, {_TEMPORALES} (10:40)"},
+        {"nombre": "Luis", "atendido": True, "trabajo": "texto libre", "tareas_map": {_TEMPORALES: "11:05"}},
+    ])
+    assert _tareas(reporte_id) == [("Ana", _TEMPORALES, "10:40"), ("Ana", _REINICIO, "10:32"),
+                                   ("Luis", _TEMPORALES, "11:05")]
+
+
+def test_filas_por_usuario_siguen_al_reporte():
+    reporte_id = _reporte([{"nombre": "Ana", "atendido": True, "fotos": ["a.jpg", "b.jpg"], "firma_trazos": [[[0, 0]]]},
+                           {"nombre": "Luis", "atendido": False, "motivo": "Vacaciones"}, "no es un usuario"])
+    filas = database._consultar("SELECT nombre, atendido, motivo, fotos, con_firma FROM reporte_usuarios "
+                                "WHERE reporte_id = ? ORDER BY posicion", (reporte_id,))
+    assert filas == [("Ana", 1, None, 2, 1), ("Luis", 0, "Vacaciones", 0, 0)]
+
+    database.actualizar_reporte(reporte_id, "2024-05-10 10:00:00", "Intermar", "Pedro", "obs", "[]", None,
+                                json.dumps([{"nombre": "Luis", "atendido": True}]), 0)
+    assert database._consultar("SELECT nombre, atendido FROM reporte_usuarios WHERE reporte_id = ?",
+                               (reporte_id,)) == [("Luis", 1)]
+    database.eliminar_reporte(reporte_id)
+    assert database._consultar_uno("SELECT COUNT(*) FROM reporte_usuarios")[0] == 0
+
+
+def test_metricas_de_no_atendidos_y_tareas_omitidas(cliente):
+    _reporte([{"nombre": "Luis", "atendido": False, "motivo": "Vacaciones"},
+              {"nombre": "Ana", "atendido": True, "trabajo": f"{_REINICIO} (10:32)"}])
+    _reporte([{"nombre": "Luis", "atendido": True, "trabajo": f"{_REINICIO} (09:00), {_TEMPORALES} (09:10)"}])
+
+    assert cliente.get("/metricas/usuarios_no_atendidos").json() == [
+        {"cliente": "Intermar", "nombre": "Luis", "visitas": 2, "no_atendido": 1, "tasa": 0.5}]
+
+    omitidas = {f["tarea"]: (f["omitida"], f["realizada"]) for f in cliente.get("/metricas/tareas_omitidas").json()}
+    assert omitidas[_REINICIO] == (0, 2) and omitidas[_TEMPORALES] == (1, 1)
+    assert set(omitidas) == set(config.TAREAS_MANTENIMIENTO)
@@ -0,0 +1,51 @@
+import json
+
+import database
+
+
+def _reporte(fecha, cliente="Intermar"):
+    return database.guardar_reporte(fecha, cliente, "Pedro", "obs", "[]", None, "[]", 0)
+
+
+def test_fecha_a_epoch_entiende_hora_local_y_offset():
+    # Mayo en Chile continental: UTC-4
+    assert database.fecha_a_epoch("2024-05-10 22:30:00") == database.fecha_a_epoch("2024-05-11T02:30:00+00:00")
+    assert database.fecha_a_epoch("no es fecha") is None
+
+
+def test_periodo_local_usa_la_hora_de_chile():
+    ts = database.fecha_a_epoch("2024-05-11T02:30:00+00:00")
+    assert database.periodo_local(ts, "dia") == "2024-05-10"
+    assert database.periodo_local(ts, "semana") == "2024-05-06"  # lunes
+    assert database.periodo_local(ts, "mes") == "2024-05"
+
+
+def test_listado_filtra_el_rango_por_fecha_ts(cliente):
+    # Como texto, '2024-05-11T02:30...' quedaría fuera de hasta=2024-05-10; en hora local es el 10
+    dentro = _reporte("2024-05-11T02:30:00+00:00")
+    _reporte("2024-05-11 09:00:00")
+    _reporte("2024-05-08 09:00:00")
+
+    r = cliente.get("/reportes", params={"desde": "2024-05-09", "hasta": "2024-05-10", "fields": "id"})
+    assert [item["id"] for item in json.loads(r.text)["items"]] == [dentro]
+
+
+def test_serie_diaria_incluye_dias_vacios(cliente):
+    _reporte("2024-05-10 10:00:00")
+    _reporte("2024-05-10 18:00:00")
+    _reporte("2024-05-12 10:00:00", cliente="Bodega Sur")
+
+    serie = cliente.get("/metricas/serie", params={"desde": "2024-05-10", "hasta": "2024-05-12"}).json()["serie"]
+    assert serie == [{"periodo": "2024-05-10", "reportes": 2}, {"periodo": "2024-05-11", "reportes": 0},
+                     {"periodo": "2024-05-12", "reportes": 1}]
+    serie = cliente.get("/metricas/serie", params={"desde": "2024-05-10", "hasta": "2024-05-12",
+                                                    "cliente": "Bodega Sur"}).json()["serie"]
+    assert [p["reportes"] for p in serie] == [0, 0, 1]
+
+
+def test_listado_por_cliente_o_tecnico_no_ordena_en_temporal():
+    con = database.conectar()
+    for filtro in ("cliente = 'Intermar'", "tecnico = 'Pedro'"):
+        plan = con.execute(f"EXPLAIN QUERY PLAN SELECT id FROM reportes WHERE {filtro} AND id < 100 "
+                           "ORDER BY id DESC LIMIT 50").fetchall()
+        assert not any("TEMP B-TREE" in fila[3] for fila in plan)
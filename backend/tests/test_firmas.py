@@ -0,0 +1,31 @@
+import pytest
+
+import pdf_generator
+import utils
+
+
+def test_normalizar_trazos_acepta_pares_y_planos_y_simplifica():
+    recta = [[0, 0], [1, 0.01], [2, 0], [3, 0.02], [4, 0]]
+    plano = [10, 10, 20, 30]
+    assert utils.normalizar_trazos([recta, plano, []], tolerancia=1.0) == [[[0.0, 0.0], [4.0, 0.0]],
+                                                                         [[10.0, 10.0], [20.0, 30.0]]]
+    # Una esquina real se conserva
+    assert utils.normalizar_trazos([[[0, 0], [5, 5], [10, 0]]], tolerancia=1.0) == [[[0.0, 0.0], [5.0, 5.0], [10.0, 0.0]]]
+
+
+def test_normalizar_trazos_rechaza_formatos_invalidos():
+    with pytest.raises(ValueError):
+        utils.normalizar_trazos([[1, 2, 3]])
+    with pytest.raises((TypeError, ValueError)):
+        utils.normalizar_trazos([[["x", 1]]])
+
+
+def test_pdf_dibuja_la_firma_como_vector():
+    usuarios = [{"nombre": "Ana", "atendido": True, "trabajo": "Revisión", "fotos": [],
+                 "firma_trazos": [[[10, 10], [200, 150], [390, 20]], [[50, 50]]], "firma_lienzo": [400, 200]}]
+    _, contenido = pdf_generator.generar_pdf_en_memoria("Intermar", "Pedro", "obs", None, usuarios)
+    sin_firma = [{**usuarios[0], "firma_trazos": None}]
+    _, contenido_sin = pdf_generator.generar_pdf_en_memoria("Intermar", "Pedro", "obs", None, sin_firma)
+    assert bytes(contenido).startswith(b"%PDF") and len(contenido) > len(contenido_sin)
+    # Sin PNG intermedio: la firma no agrega imágenes al PDF
+    assert bytes(contenido).count(b"/Subtype /Image") == bytes(contenido_sin).count(b"/Subtype /Image")
@@ -0,0 +1,42 @@
+import database
+
+
+def _reporte(lat, lon, cliente="Intermar"):
+    return database.guardar_reporte("2024-05-10 10:00:00", cliente, "Pedro", "obs", "[]", None, "[]", 0,
+                                    lat=str(lat), lon=str(lon))
+
+
+def test_caja_radio_se_parte_en_el_antimeridiano():
+    este, oeste = database.caja_radio(-16.0, 179.99, 5000)
+    assert este[2] < 179.99 and este[3] == 180.0
+    assert oeste[2] == -180.0 and -180.0 < oeste[3] < -179.9
+    assert len(database.caja_radio(-33.45, -70.66, 5000)) == 1
+    # Si el círculo incluye un polo, cualquier longitud
+    (polo,) = database.caja_radio(89.99, 10.0, 5000)
+    assert polo[1:] == (90.0, -180.0, 180.0)
+
+
+def test_cerca_encuentra_visitas_al_otro_lado_del_antimeridiano(cliente):
+    al_otro_lado = _reporte(-16.0, -179.99)
+    _reporte(-16.0, 179.0)  # ~107 km
+    r = cliente.get("/reportes/cerca", params={"lat": -16.0, "lon": 179.99, "radio_m": 5000}).json()
+    assert [v["id"] for v in r] == [al_otro_lado]
+    assert 2000 < r[0]["distancia_m"] < 2200
+
+
+def test_cerca_ordena_por_distancia_y_valida_parametros(cliente):
+    lejos = _reporte(-33.50, -70.66)
+    cerca = _reporte(-33.451, -70.66)
+    _reporte(-33.451, -70.66, cliente="Bodega Sur")
+    _reporte("", "")  # sin coordenadas: no entra al índice
+
+    ids = [v["id"] for v in cliente.get("/reportes/cerca", params={"lat": -33.45, "lon": -70.66, "radio_m": 10000,
+                                                                  "cliente": "Intermar"}).json()]
+    assert ids == [cerca, lejos]
+    caja = {"lat_min": -33.46, "lat_max": -33.44, "lon_min": -70.67, "lon_max": -70.65, "cliente": "Intermar"}
+    assert [v["id"] for v in cliente.get("/reportes/cerca", params=caja).json()] == [cerca]
+
+    assert cliente.get("/reportes/cerca", params={"lat": -33.45, "lon": -70.66}).status_code == 400
+    assert cliente.get("/reportes/cerca", params={"lat": -33.45, "lon": -70.66, "radio_m": 10 ** 7}).status_code == 400
+    assert cliente.get("/reportes/cerca", params={**caja, "lat_min": -33.40}).status_code == 400
+    assert cliente.get("/reportes/cerca", params={"lat_min": -33.46}).status_code == 400
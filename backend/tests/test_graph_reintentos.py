@@ -0,0 +1,76 @@
+import pytest
+import requests
+
+import graph_cliente
+from conftest import RespuestaFalsa
+
+
+class SesionFalsa:
+    """Cada llamada consume la siguiente respuesta (o lanza la excepción) de la lista."""
+    def __init__(self, respuestas):
+        self.respuestas = list(respuestas)
+        self.llamadas = 0
+
+    def request(self, metodo, url, **kwargs):
+        self.llamadas += 1
+        respuesta = self.respuestas.pop(0)
+        if isinstance(respuesta, Exception):
+            raise respuesta
+        return respuesta
+
+
+@pytest.fixture
+def esperas(monkeypatch):
+    registro = []
+    monkeypatch.setattr(graph_cliente.time, "sleep", registro.append)
+    return registro
+
+
+def _cliente(respuestas):
+    cliente = graph_cliente.ClienteGraph(1, 1, max_reintentos=3, espera_base=0.01, tam_pool=1)
+    cliente.session = SesionFalsa(respuestas)
+    return cliente
+
+
+def test_get_se_reintenta_ante_5xx_y_errores_de_red(esperas):
+    cliente = _cliente([RespuestaFalsa(502), requests.exceptions.ReadTimeout(), RespuestaFalsa(200)])
+    assert cliente.get("https://graph.invalid/x").status_code == 200
+    assert cliente.session.llamadas == 3
+
+
+def test_post_con_500_no_se_repite(esperas):
+    cliente = _cliente([RespuestaFalsa(500), RespuestaFalsa(202)])
+    assert cliente.post("https://graph.invalid/sendMail").status_code == 500
+    assert cliente.session.llamadas == 1 and esperas == []
+
+
+def test_post_cortado_tras_enviar_no_se_repite(esperas):
+    cliente = _cliente([requests.exceptions.ReadTimeout(), RespuestaFalsa(202)])
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        cliente.post("https://graph.invalid/sendMail")
+    assert cliente.session.llamadas == 1
+
+
+def test_post_se_repite_ante_429_respetando_retry_after(esperas):
+    cliente = _cliente([RespuestaFalsa(429, headers={"Retry-After": "7"}), RespuestaFalsa(503), RespuestaFalsa(202)])
+    assert cliente.post("https://graph.invalid/sendMail").status_code == 202
+    assert cliente.session.llamadas == 3 and esperas[0] == 7.0
+
+
+def test_post_sin_conexion_establecida_se_repite(esperas):
+    cliente = _cliente([requests.exceptions.ConnectTimeout(), RespuestaFalsa(201)])
+    assert cliente.post("https://graph.invalid/items").status_code == 201
+
+
+def test_lote_reintenta_solo_los_subrequests_que_no_se_aplicaron(esperas):
+    primera = RespuestaFalsa(200, {"responses": [
+        {"id": "1", "status": 500}, {"id": "2", "status": 429, "headers": {"Retry-After": "2"}},
+        {"id": "3", "status": 502},
+    ]})
+    segunda = RespuestaFalsa(200, {"responses": [{"id": "2", "status": 202}, {"id": "3", "status": 200}]})
+    cliente = _cliente([primera, segunda])
+
+    resultados = cliente.lote([{"id": 1, "method": "POST", "url": "/a"}, {"id": 2, "method": "POST", "url": "/b"},
+                               {"id": 3, "method": "GET", "url": "/c"}], headers={})
+    assert {i: r["status"] for i, r in resultados.items()} == {"1": 500, "2": 202, "3": 200}
+    assert esperas == [2.0]
@@ -0,0 +1,50 @@
+import database
+
+_FORMULARIO = {"cliente": "Intermar", "tecnico": "Pedro", "obs": "Sin novedad", "datos_usuarios": "[]"}
+
+
+def _trabajos():
+    return database._consultar_uno("SELECT COUNT(*) FROM trabajos")[0]
+
+
+def test_reintento_con_la_misma_clave_devuelve_el_trabajo_original(cliente):
+    r1 = cliente.post("/reporte/crear", data=_FORMULARIO, headers={"Idempotency-Key": "tablet-1:42"})
+    r2 = cliente.post("/reporte/crear", data=_FORMULARIO, headers={"Idempotency-Key": "tablet-1:42"})
+    # La clave también puede venir como campo del formulario
+    r3 = cliente.post("/reporte/crear", data={**_FORMULARIO, "idempotency_key": "tablet-1:42"})
+
+    assert r1.status_code == r2.status_code == r3.status_code == 202
+    assert "replay" not in r1.json()
+    assert r2.json()["replay"] and r3.json()["replay"]
+    assert r1.json()["job_id"] == r2.json()["job_id"] == r3.json()["job_id"]
+    assert _trabajos() == 1
+
+
+def test_claves_distintas_o_sin_clave_crean_trabajos_nuevos(cliente):
+    cliente.post("/reporte/crear", data=_FORMULARIO, headers={"Idempotency-Key": "a"})
+    cliente.post("/reporte/crear", data=_FORMULARIO, headers={"Idempotency-Key": "b"})
+    cliente.post("/reporte/crear", data=_FORMULARIO)
+    cliente.post("/reporte/crear", data=_FORMULARIO)
+    assert _trabajos() == 4
+
+
+def test_replay_informa_el_estado_del_trabajo(cliente):
+    job_id = cliente.post("/reporte/crear", data=_FORMULARIO, headers={"Idempotency-Key": "k"}).json()["job_id"]
+    trabajo = database.tomar_trabajo("w1", 60)
+    database.finalizar_trabajo(trabajo["id"], "w1", "completado", {}, {"server_id": 15})
+
+    r = cliente.post("/reporte/crear", data=_FORMULARIO, headers={"Idempotency-Key": "k"}).json()
+    assert r["job_id"] == job_id and r["estado"] == "completado" and r["server_id"] == 15
+
+
+def test_claves_vencidas_se_purgan_y_la_misma_clave_crea_otro_trabajo(cliente):
+    job_id = cliente.post("/reporte/crear", data=_FORMULARIO, headers={"Idempotency-Key": "vieja"}).json()["job_id"]
+    with database.transaccion() as cur:
+        cur.execute("UPDATE idempotencia SET creado_en = 0")
+
+    r = cliente.post("/reporte/crear", data=_FORMULARIO, headers={"Idempotency-Key": "otra"})
+    assert r.status_code == 202
+    assert database._consultar("SELECT clave FROM idempotencia") == [("otra",)]
+    # Pasado el TTL la clave vuelve a ser nueva
+    r = cliente.post("/reporte/crear", data=_FORMULARIO, headers={"Idempotency-Key": "vieja"}).json()
+    assert "replay" not in r and r["job_id"] != job_id
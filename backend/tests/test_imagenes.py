@@ -0,0 +1,59 @@
+from PIL import Image
+
+import imagenes
+
+
+def _foto(ruta, tamano, formato="JPEG", orientacion=None):
+    img = Image.new("RGB", tamano, "green")
+    if orientacion:
+        exif = Image.Exif()
+        exif[0x0112] = orientacion
+        img.save(ruta, formato, exif=exif.tobytes())
+    else:
+        img.save(ruta, formato)
+    return str(ruta)
+
+
+def test_foto_grande_se_reduce_a_la_celda_del_pdf(tmp_path):
+    ruta = _foto(tmp_path / "foto.png", (4000, 3000), "PNG")
+    r = imagenes.normalizar_imagen(ruta, dpi=200)
+
+    assert r["ruta"].endswith(".jpg") and r["bytes_despues"] < r["bytes_antes"]
+    with Image.open(r["ruta"]) as img:
+        assert img.format == "JPEG"
+        assert img.width <= imagenes._px(45, 200) and img.height <= imagenes._px(35, 200)
+    assert not (tmp_path / "foto.png").exists()
+
+
+def test_orientacion_exif_se_aplica(tmp_path):
+    # Orientación 6: la cámara guardó de lado una foto vertical
+    ruta = _foto(tmp_path / "foto.jpg", (2000, 1000), orientacion=6)
+    r = imagenes.normalizar_imagen(ruta, dpi=200)
+    with Image.open(r["ruta"]) as img:
+        assert img.height > img.width
+        assert img.getexif().get(0x0112, 1) == 1
+
+
+def test_foto_pequena_y_derecha_no_se_recodifica(tmp_path):
+    ruta = _foto(tmp_path / "foto.jpg", (200, 150))
+    antes = (tmp_path / "foto.jpg").read_bytes()
+    r = imagenes.normalizar_imagen(ruta, dpi=200)
+    assert r["ruta"] == ruta and (tmp_path / "foto.jpg").read_bytes() == antes
+
+
+def test_con_destino_la_original_queda_y_el_derivado_se_reutiliza(tmp_path):
+    ruta = _foto(tmp_path / "foto.png", (3000, 3000), "PNG")
+    destino = str(tmp_path / "derivado.jpg")
+    assert imagenes.normalizar_imagen(ruta, destino=destino, dpi=200)["ruta"] == destino
+    assert (tmp_path / "foto.png").exists()
+
+    modificado = (tmp_path / "derivado.jpg").stat().st_mtime_ns
+    assert imagenes.normalizar_imagen(ruta, destino=destino, dpi=200)["ruta"] == destino
+    assert (tmp_path / "derivado.jpg").stat().st_mtime_ns == modificado
+
+
+def test_archivo_que_no_es_imagen_se_deja_tal_cual(tmp_path):
+    ruta = tmp_path / "foto.jpg"
+    ruta.write_bytes(b"no soy un jpeg")
+    assert imagenes.normalizar_imagen(str(ruta))["ruta"] == str(ruta)
+    assert ruta.read_bytes() == b"no soy un jpeg"
@@ -0,0 +1,54 @@
+import database
+
+
+def _reporte(fecha="2024-05-10 11:00:00", cliente="Intermar", tecnico="Pedro", email=0):
+    return database.guardar_reporte(fecha, cliente, tecnico, "obs", "[]", None, "[]", email)
+
+
+def _contadores():
+    return {(d, c): n for d, c, n in database._consultar("SELECT dimension, clave, reportes FROM kpi_resumen")}
+
+
+def test_triggers_siguen_altas_cambios_y_bajas():
+    a = _reporte()
+    _reporte(cliente="Bodega Sur", fecha="2024-06-01 08:00:00")
+    database.actualizar_reporte(a, "2024-06-02 10:00:00", "Bodega Sur", "Juan", "obs", "[]", None, "[]", 1)
+    database.actualizar_estado_email(a, 0)
+    database.eliminar_reporte(a)
+
+    # Los triggers dejaron lo mismo que un recálculo completo
+    assert database.reconstruir_kpis() == 0
+    kpis = database.obtener_resumen_kpis()
+    assert kpis["cliente"] == [("Bodega Sur", 1)]
+    assert kpis["mes"] == [("2024-06", 1)]
+
+
+def test_reconstruir_corrige_contadores_desviados():
+    _reporte()
+    _reporte(tecnico="Juan")
+    esperado = _contadores()
+    with database.transaccion() as cur:
+        cur.execute("UPDATE kpi_resumen SET reportes = 99 WHERE dimension = 'cliente'")
+        cur.execute("DELETE FROM kpi_resumen WHERE dimension = 'tecnico' AND clave = 'Juan'")
+        cur.execute("INSERT INTO kpi_resumen (dimension, clave, reportes) VALUES ('cliente', 'Fantasma', 3)")
+
+    assert database.reconstruir_kpis() == 3
+    assert _contadores() == esperado
+    assert database.reconstruir_kpis() == 0
+
+
+def test_endpoint_reconstruir_informa_desviados(cliente):
+    _reporte()
+    with database.transaccion() as cur:
+        cur.execute("UPDATE kpi_resumen SET reportes = 5 WHERE dimension = 'mes'")
+    r = cliente.post("/sistema/reconstruir_kpis")
+    assert r.status_code == 200 and r.json()["corregidos"] == 1
+    assert database.obtener_resumen_kpis()["mes"] == [("2024-05", 1)]
+
+
+def test_metricas_limita_los_meses(cliente):
+    for mes in ("2024-03", "2024-04", "2024-05"):
+        _reporte(fecha=f"{mes}-10 11:00:00")
+    assert [m["mes"] for m in cliente.get("/metricas", params={"meses": 2}).json()["por_mes"]] == ["2024-04", "2024-05"]
+    for meses in (-1, 0, 121):
+        assert cliente.get("/metricas", params={"meses": meses}).status_code == 422
@@ -0,0 +1,55 @@
+import json
+
+import database
+
+
+def _reporte(cliente="Intermar", email=0, detalles="[]"):
+    return database.guardar_reporte("2024-05-10 10:00:00", cliente, "Pedro", "obs", "[]", None, detalles, email)
+
+
+def _pagina(cliente_http, **params):
+    r = cliente_http.get("/reportes", params=params)
+    assert r.status_code == 200
+    return json.loads(r.text)
+
+
+def test_cursor_recorre_todo_sin_repetir_ni_saltar(cliente, monkeypatch):
+    import api  # después de `cliente`: al importarse migra DB_NAME, que debe ser la temporal
+    monkeypatch.setattr(api, "_LOTE_LISTADO", 2)  # la página se arma en varios lotes
+    ids = [_reporte() for _ in range(7)]
+
+    vistos, cursor = [], None
+    while True:
+        pagina = _pagina(cliente, limite=3, fields="id", **({"cursor": cursor} if cursor else {}))
+        vistos += [item["id"] for item in pagina["items"]]
+        cursor = pagina["next_cursor"]
+        if cursor is None:
+            break
+    assert vistos == sorted(ids, reverse=True)
+
+
+def test_cursor_es_estable_si_llegan_reportes_nuevos(cliente):
+    ids = [_reporte() for _ in range(4)]
+    primera = _pagina(cliente, limite=2, fields="id")
+    _reporte()  # Llega uno nuevo entre páginas: no desplaza la segunda
+    segunda = _pagina(cliente, limite=2, fields="id", cursor=primera["next_cursor"])
+    assert [i["id"] for i in segunda["items"]] == [ids[1], ids[0]]
+
+
+def test_fields_proyecta_columnas_y_decodifica_json(cliente):
+    _reporte(detalles=json.dumps([{"nombre": "Ana"}]))
+
+    item = _pagina(cliente, fields="cliente")["items"][0]
+    assert set(item) == {"id", "cliente"}
+    assert "detalles_usuarios" not in _pagina(cliente)["items"][0]
+    assert _pagina(cliente, fields="detalles_usuarios")["items"][0]["detalles_usuarios"] == [{"nombre": "Ana"}]
+
+
+def test_filtros_y_parametros_invalidos(cliente):
+    enviado = _reporte(email=1)
+    _reporte(email=0, cliente="Bodega Sur")
+    assert [i["id"] for i in _pagina(cliente, email_enviado=1, fields="id")["items"]] == [enviado]
+    assert [i["id"] for i in _pagina(cliente, cliente="Intermar", fields="id")["items"]] == [enviado]
+
+    assert cliente.get("/reportes", params={"fields": "id,clave_secreta"}).status_code == 400
+    assert cliente.get("/reportes", params={"limite": 0}).status_code == 400
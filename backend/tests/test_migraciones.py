@@ -0,0 +1,95 @@
+import json
+import sqlite3
+
+import database
+
+
+def _version(ruta):
+    con = sqlite3.connect(ruta)
+    try:
+        return con.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        con.close()
+
+
+def _crear_bd_antigua(ruta):
+    """Esquema de antes del versionado (user_version 0), con los datos que las migraciones deben conservar."""
+    con = sqlite3.connect(ruta)
+    con.executescript("""
+        CREATE TABLE reportes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT, cliente TEXT, tecnico TEXT,
+            observaciones TEXT, imagen_path TEXT,
+            pdf_path TEXT, detalles_usuarios TEXT,
+            email_enviado INTEGER DEFAULT 0,
+            latitud TEXT, longitud TEXT
+        );
+        CREATE TABLE tecnicos (id INTEGER PRIMARY KEY AUTOINCREMENT, nombre TEXT UNIQUE);
+        CREATE TABLE clientes (nombre TEXT PRIMARY KEY, email TEXT);
+        CREATE TABLE usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, nombre TEXT, cliente_nombre TEXT,
+            FOREIGN KEY(cliente_nombre) REFERENCES clientes(nombre) ON DELETE CASCADE
+        );
+        INSERT INTO clientes VALUES ('Intermar', 'a@b.cl');
+        INSERT INTO usuarios (nombre, cliente_nombre) VALUES ('Ana', 'Intermar'), ('Ana', 'Intermar'), ('Luis', 'Intermar');
+    """)
+    detalles = [{"nombre": "Ana", "atendido": True, "trabajo": "Cambio de tóner", "fotos": ["a.jpg"]},
+                {"nombre": "Luis", "atendido": False, "motivo": "Vacaciones"}]
+    con.execute("""
+        INSERT INTO reportes (fecha, cliente, tecnico, observaciones, detalles_usuarios, email_enviado, latitud, longitud)
+        VALUES ('2024-03-05 10:30:00', 'Intermar', 'Pedro', 'Impresora atascada', ?, 1, '-33.45', '-70.66')
+    """, (json.dumps(detalles),))
+    con.commit()
+    con.close()
+
+
+def test_bd_nueva_queda_en_la_ultima_version(db):
+    assert _version(db) == len(database.MIGRACIONES)
+    tablas = {f[0] for f in database._consultar("SELECT name FROM sqlite_master")}
+    assert {"kpi_resumen", "reporte_usuarios", "reportes_fts", "reportes_geo", "idempotencia"} <= tablas
+
+
+def test_reaplicar_migraciones_no_cambia_nada(db):
+    database.guardar_reporte("2024-01-02 09:00:00", "C", "T", "obs", "[]", None, "[]", 0)
+    database.inicializar_db()
+    assert _version(db) == len(database.MIGRACIONES)
+    assert database._consultar_uno("SELECT COUNT(*) FROM reportes")[0] == 1
+
+
+def test_actualiza_bd_antigua_conservando_datos(tmp_path, monkeypatch):
+    ruta = str(tmp_path / "antigua.db")
+    _crear_bd_antigua(ruta)
+    monkeypatch.setattr(database, "DB_NAME", ruta)
+
+    database.inicializar_db()
+
+    assert _version(ruta) == len(database.MIGRACIONES)
+    # m002: los usuarios duplicados se colapsan
+    assert sorted(database.obtener_usuarios_por_cliente("Intermar")) == ["Ana", "Luis"]
+    # m004: contadores calculados desde los reportes existentes
+    kpis = database.obtener_resumen_kpis()
+    assert ("Intermar", 1) in kpis["cliente"] and ("2024-03", 1) in kpis["mes"]
+    # m005: fecha_ts poblada
+    assert database._consultar_uno("SELECT fecha_ts FROM reportes")[0] == database.fecha_a_epoch("2024-03-05 10:30:00")
+    # m006: detalle normalizado
+    filas = database._consultar("SELECT nombre, atendido, motivo, trabajo FROM reporte_usuarios ORDER BY posicion")
+    assert filas == [("Ana", 1, None, "Cambio de tóner"), ("Luis", 0, "Vacaciones", None)]
+    # m007 y m008: índices de texto y geográfico con el reporte antiguo
+    assert len(database.buscar_reportes("toner")) == 1
+    assert len(database.reportes_cerca(-33.45, -70.66, database.caja_radio(-33.45, -70.66, 1000), 1000)) == 1
+
+
+def test_continua_desde_una_version_intermedia(tmp_path, monkeypatch):
+    ruta = str(tmp_path / "parcial.db")
+    monkeypatch.setattr(database, "DB_NAME", ruta)
+    monkeypatch.setattr(database, "MIGRACIONES", database.MIGRACIONES[:3])
+    database.inicializar_db()
+    assert _version(ruta) == 3
+    monkeypatch.undo()
+    monkeypatch.setattr(database, "DB_NAME", ruta)
+
+    database.inicializar_db()
+
+    assert _version(ruta) == len(database.MIGRACIONES)
+    database.guardar_reporte("2024-01-02 09:00:00", "C", "T", "obs", "[]", None, "[]", 0)
+    assert database.obtener_resumen_kpis()["cliente"] == [("C", 1)]
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+import requests
+
+import database
+import utils
+
+
+def test_reintento_desde_disco_retoma_la_sesion_creada_en_memoria(sharepoint_falso, tmp_path):
+    contenido = bytearray(os.urandom(3500))
+    sharepoint_falso.caer_tras = 2
+    with pytest.raises(requests.exceptions.ConnectionError):
+        utils._subir_por_sesion({}, "drive", "/Cliente/2024-05-10/Reporte.pdf", None, contenido)
+
+    # El trabajo se reprograma: worker_reportes._volcar_pdf deja el PDF en disco
+    ruta = tmp_path / "Reporte.pdf"
+    ruta.write_bytes(contenido)
+    sharepoint_falso.caido, sharepoint_falso.caer_tras = False, None
+    r = utils._subir_por_sesion({}, "drive", "/Cliente/2024-05-10/Reporte.pdf", str(ruta))
+
+    assert r.status_code == 201
+    assert sharepoint_falso.creadas == 1
+    assert sharepoint_falso.fragmentos == 4  # 2 antes del corte + los 2 que faltaban
+    assert list(sharepoint_falso.subidos.values()) == [bytes(contenido)]
+    assert database._consultar_uno("SELECT COUNT(*) FROM sesiones_subida")[0] == 0
+
+
+def test_guardar_sesion_purga_las_vencidas():
+    database.guardar_sesion_subida("vieja", "https://subida.invalid/1", "2020-01-01T00:00:00.000Z")
+    database.guardar_sesion_subida("nueva", "https://subida.invalid/2", "2999-01-01T00:00:00Z")
+    assert database.obtener_sesion_subida("vieja") is None
+    assert database.obtener_sesion_subida("nueva") == "https://subida.invalid/2"
@@ -0,0 +1,35 @@
+import database
+import reenvio
+
+
+def _pendiente():
+    return database.guardar_reporte("2024-05-10 10:00:00", "Intermar", "Pedro", "obs", "[]", None, "[]", 0)
+
+
+def test_reclamo_toma_los_vencidos_una_sola_vez():
+    primero, segundo = _pendiente(), _pendiente()
+    database.registrar_intento_email(segundo, False, "caído", proximo_intento=500)
+
+    filas = database.reclamar_reportes_para_reenvio(100, 10, 60)
+    assert [f[0] for f in filas] == [primero]
+    assert database.reclamar_reportes_para_reenvio(120, 10, 60) == []
+    assert [f[0] for f in database.reclamar_reportes_para_reenvio(600, 10, 60)] == [primero, segundo]
+
+
+def test_fallo_agotado_sale_de_la_cola(monkeypatch):
+    reporte_id = _pendiente()
+    monkeypatch.setattr(reenvio.config, "REENVIO_MAX_INTENTOS", 1)
+    fila = database.reclamar_reportes_para_reenvio(100, 10, 60)[0]
+    reenvio._registrar(fila, False, "rechazado")
+
+    estado = database._consultar_uno("SELECT email_enviado FROM reportes WHERE id = ?", (reporte_id,))[0]
+    assert estado == database.EMAIL_FALLIDO
+    assert database.reclamar_reportes_para_reenvio(10 ** 10, 10, 60) == []
+
+
+def test_reclamo_usa_el_indice_parcial():
+    plan = database.conectar().execute("""
+        EXPLAIN QUERY PLAN SELECT id FROM reportes
+        WHERE email_enviado = 0 AND proximo_intento_email <= 5 ORDER BY id ASC LIMIT 5
+    """).fetchall()
+    assert not any("SCAN reportes" in fila[3] for fila in plan)
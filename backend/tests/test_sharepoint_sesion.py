@@ -0,0 +1,61 @@
+import os
+
+import pytest
+import requests
+
+import database
+import utils
+
+_DESTINO = "/Cliente/2024-05-10/Reporte.pdf"
+
+
+@pytest.fixture
+def pdf(tmp_path):
+    ruta = tmp_path / "Reporte.pdf"
+    ruta.write_bytes(os.urandom(4500))
+    return ruta
+
+
+def _sesiones_guardadas():
+    return database._consultar_uno("SELECT COUNT(*) FROM sesiones_subida")[0]
+
+
+def test_corte_de_red_se_retoma_desde_el_rango_confirmado(sharepoint_falso, pdf):
+    sharepoint_falso.caer_tras = 3
+    with pytest.raises(requests.exceptions.ConnectionError):
+        utils._subir_por_sesion({}, "drive", _DESTINO, str(pdf))
+    assert _sesiones_guardadas() == 1
+
+    sharepoint_falso.caido, sharepoint_falso.caer_tras = False, None
+    r = utils._subir_por_sesion({}, "drive", _DESTINO, str(pdf))
+
+    assert r.status_code == 201
+    assert sharepoint_falso.creadas == 1 and sharepoint_falso.fragmentos == 5
+    assert list(sharepoint_falso.subidos.values()) == [pdf.read_bytes()]
+    assert _sesiones_guardadas() == 0
+
+
+def test_fragmento_recibido_sin_respuesta_no_se_duplica(sharepoint_falso, pdf):
+    contenido = pdf.read_bytes()
+    sharepoint_falso.caer_tras = 1
+    with pytest.raises(requests.exceptions.ConnectionError):
+        utils._subir_por_sesion({}, "drive", _DESTINO, str(pdf))
+    # Graph alcanzó a guardar el segundo fragmento, pero la respuesta se perdió
+    (upload_url, recibido), = sharepoint_falso.sesiones.items()
+    recibido.extend(contenido[1000:2000])
+
+    sharepoint_falso.caido, sharepoint_falso.caer_tras = False, None
+    assert utils._subir_por_sesion({}, "drive", _DESTINO, str(pdf)).status_code == 201
+    assert sharepoint_falso.subidos[upload_url] == contenido
+
+
+def test_sesion_expirada_se_crea_de_nuevo(sharepoint_falso, pdf):
+    sharepoint_falso.caer_tras = 2
+    with pytest.raises(requests.exceptions.ConnectionError):
+        utils._subir_por_sesion({}, "drive", _DESTINO, str(pdf))
+    sharepoint_falso.sesiones.clear()  # Graph ya no reconoce la uploadUrl
+
+    sharepoint_falso.caido, sharepoint_falso.caer_tras = False, None
+    assert utils._subir_por_sesion({}, "drive", _DESTINO, str(pdf)).status_code == 201
+    assert sharepoint_falso.creadas == 2
+    assert list(sharepoint_falso.subidos.values()) == [pdf.read_bytes()]
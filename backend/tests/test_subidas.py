@@ -0,0 +1,118 @@
+import hashlib
+import io
+import json
+import os
+
+from PIL import Image
+
+import almacen
+import database
+import worker_reportes
+
+_FORMULARIO = {"cliente": "Intermar", "tecnico": "Pedro", "obs": "Sin novedad", "datos_usuarios": "[]"}
+
+
+def _jpeg():
+    buffer = io.BytesIO()
+    Image.new("RGB", (320, 240), "blue").save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def _nueva(cliente, contenido):
+    return cliente.post("/subidas", json={"nombre": "foto.jpg", "tamano": len(contenido)}).json()["id"]
+
+
+def test_subida_cortada_se_reanuda_desde_el_offset(cliente):
+    contenido = _jpeg()
+    mitad = len(contenido) // 2
+    total = len(contenido)
+    id_subida = _nueva(cliente, contenido)
+
+    r = cliente.put(f"/subidas/{id_subida}", content=contenido[:mitad],
+                    headers={"Content-Range": f"bytes 0-{mitad - 1}/{total}"})
+    assert r.json()["offset"] == mitad
+
+    # Tras reconectar, el cliente pregunta dónde quedó
+    assert cliente.get(f"/subidas/{id_subida}").json()["offset"] == mitad
+    # Un rango que no empieza en el offset se rechaza indicando desde dónde seguir
+    r = cliente.put(f"/subidas/{id_subida}", content=contenido,
+                    headers={"Content-Range": f"bytes 0-{total - 1}/{total}"})
+    assert r.status_code == 409 and r.json()["detail"]["offset"] == mitad
+    # Finalizar antes de tener todos los bytes tampoco se permite
+    r = cliente.post(f"/subidas/{id_subida}/finalizar", json={"sha256": hashlib.sha256(contenido).hexdigest()})
+    assert r.status_code == 409
+
+    r = cliente.put(f"/subidas/{id_subida}", content=contenido[mitad:],
+                    headers={"Content-Range": f"bytes {mitad}-{total - 1}/{total}"})
+    assert r.json()["offset"] == total
+
+    r = cliente.post(f"/subidas/{id_subida}/finalizar", json={"sha256": hashlib.sha256(contenido).hexdigest()})
+    assert r.status_code == 200 and r.json()["estado"] == "completa"
+    ruta, tamano, refs = database.obtener_blob(r.json()["hash"])
+    assert tamano == total and refs == 1
+    with open(ruta, "rb") as f:
+        assert f.read() == contenido
+
+
+def test_put_concurrente_no_toca_el_parcial(cliente):
+    contenido = _jpeg()
+    id_subida = _nueva(cliente, contenido)
+    # Otro PUT tiene el bloqueo de escritura en el offset 0
+    assert database.reclamar_escritura_subida(id_subida, "otro", 0, 60)
+
+    r = cliente.put(f"/subidas/{id_subida}", content=contenido)
+    assert r.status_code == 409
+    assert not os.path.exists(almacen.ruta_parcial(id_subida))
+    assert cliente.get(f"/subidas/{id_subida}").json()["offset"] == 0
+
+    # Un bloqueo vencido (el PUT anterior murió) se puede tomar
+    with database.transaccion() as cur:
+        cur.execute("UPDATE subidas SET escritor_hasta = 0 WHERE id = ?", (id_subida,))
+    assert cliente.put(f"/subidas/{id_subida}", content=contenido).json()["offset"] == len(contenido)
+    # y el escritor anterior ya no mueve el offset
+    assert not database.avanzar_subida(id_subida, "otro", len(contenido), 1)
+
+
+def test_content_range_con_otra_unidad_se_rechaza(cliente):
+    contenido = _jpeg()
+    id_subida = _nueva(cliente, contenido)
+    r = cliente.put(f"/subidas/{id_subida}", content=contenido,
+                    headers={"Content-Range": f"items 0-{len(contenido) - 1}/{len(contenido)}"})
+    assert r.status_code == 400
+    assert cliente.get(f"/subidas/{id_subida}").json()["offset"] == 0
+
+
+def test_checksum_incorrecto_reinicia_la_subida(cliente):
+    contenido = _jpeg()
+    id_subida = _nueva(cliente, contenido)
+    cliente.put(f"/subidas/{id_subida}", content=contenido[:-1] + b"\x00")
+    r = cliente.post(f"/subidas/{id_subida}/finalizar", json={"sha256": hashlib.sha256(contenido).hexdigest()})
+    assert r.status_code == 422 and r.json()["detail"]["offset"] == 0
+
+    estado = cliente.get(f"/subidas/{id_subida}").json()
+    assert estado["estado"] == "abierta" and estado["offset"] == 0
+    assert not os.path.exists(almacen.ruta_parcial(id_subida))
+
+    # Se vuelve a subir desde el byte 0 y ahora sí finaliza
+    cliente.put(f"/subidas/{id_subida}", content=contenido)
+    r = cliente.post(f"/subidas/{id_subida}/finalizar", json={"sha256": hashlib.sha256(contenido).hexdigest()})
+    assert r.status_code == 200 and r.json()["hash"] == hashlib.sha256(contenido).hexdigest()
+
+
+def test_reporte_con_subida_finalizada_referencia_el_blob(cliente):
+    contenido = _jpeg()
+    id_subida = _nueva(cliente, contenido)
+    cliente.put(f"/subidas/{id_subida}", content=contenido)
+    hash_hex = cliente.post(f"/subidas/{id_subida}/finalizar",
+                            json={"sha256": hashlib.sha256(contenido).hexdigest()}).json()["hash"]
+
+    usuarios = [{"nombre": "Ana", "atendido": True, "trabajo": "a", "fotos": ["foto.jpg"]}]
+    r = cliente.post("/reporte/crear", data={**_FORMULARIO, "datos_usuarios": json.dumps(usuarios),
+                                             "subidas_fotos": json.dumps([id_subida])})
+    assert r.status_code == 202
+    # La subida y el trabajo tienen cada uno su referencia al mismo blob
+    assert database.obtener_blob(hash_hex)[2] == 2
+    trabajo = database.tomar_trabajo("w1", 60)
+    assert trabajo["payload"]["blobs"] == [hash_hex]
+    worker_reportes._limpiar_trabajo(trabajo["payload"])
+    assert database.obtener_blob(hash_hex)[2] == 1
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import graph_cliente
+import utils
+from conftest import RespuestaFalsa
+
+
+class SesionFalsa:
+    """Devuelve las respuestas en orden y anota el Authorization de cada llamada."""
+    def __init__(self, respuestas):
+        self.respuestas = list(respuestas)
+        self.autorizaciones = []
+
+    def request(self, metodo, url, **kwargs):
+        self.autorizaciones.append((kwargs.get("headers") or {}).get("Authorization"))
+        return self.respuestas.pop(0)
+
+
+def _tokens(monkeypatch, demora=0.0):
+    pedidos = []
+
+    def solicitar():
+        time.sleep(demora)
+        pedidos.append(1)
+        return f"token-{len(pedidos)}", 3600
+
+    monkeypatch.setattr(utils, "_solicitar_token_graph", solicitar)
+    monkeypatch.setattr(utils, "_cache_token", utils._CacheTokenGraph(margen=60))
+    return pedidos
+
+
+def test_un_solo_hilo_pide_el_token_y_los_demas_lo_reutilizan(monkeypatch):
+    pedidos = _tokens(monkeypatch, demora=0.2)
+    obtenidos = []
+    hilos = [threading.Thread(target=lambda: obtenidos.append(utils._obtener_token_graph())) for _ in range(8)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    assert len(pedidos) == 1 and obtenidos == ["token-1"] * 8
+
+
+def test_invalidar_un_token_viejo_no_descarta_el_nuevo(monkeypatch):
+    pedidos = _tokens(monkeypatch)
+    utils._obtener_token_graph()
+    utils._renovar_token_graph("token-1")
+    utils.invalidar_token_graph("token-1")  # otro hilo con el mismo 401, ya renovado
+    assert utils._obtener_token_graph() == "token-2" and len(pedidos) == 2
+
+
+def _cliente(respuestas):
+    cliente = graph_cliente.ClienteGraph(1, 1, max_reintentos=0, espera_base=0, tam_pool=1)
+    cliente.session = SesionFalsa(respuestas)
+    cliente.renovar_token = utils._renovar_token_graph
+    return cliente
+
+
+def test_401_renueva_el_token_y_repite_una_vez(monkeypatch):
+    _tokens(monkeypatch)
+    viejo = utils._obtener_token_graph()
+    cliente = _cliente([RespuestaFalsa(401), RespuestaFalsa(202)])
+
+    r = cliente.post("https://graph.invalid/sendMail", headers={"Authorization": f"Bearer {viejo}"})
+    assert r.status_code == 202
+    assert cliente.session.autorizaciones == ["Bearer token-1", "Bearer token-2"]
+
+
+def test_segundo_401_se_devuelve_sin_mas_renovaciones(monkeypatch):
+    pedidos = _tokens(monkeypatch)
+    cliente = _cliente([RespuestaFalsa(401), RespuestaFalsa(401), RespuestaFalsa(200)])
+
+    r = cliente.get("https://graph.invalid/x", headers={"Authorization": f"Bearer {utils._obtener_token_graph()}"})
+    assert r.status_code == 401 and len(cliente.session.autorizaciones) == 2 and len(pedidos) == 2
@@ -0,0 +1,93 @@
+import time
+
+import database
+import worker_reportes
+
+
+def _encolar():
+    return database.encolar_trabajo(worker_reportes.TIPO_REPORTE, {"carpeta": None, "blobs": []})
+
+
+def test_un_trabajo_lo_toma_un_solo_worker():
+    trabajo_id = _encolar()
+    trabajo = database.tomar_trabajo("w1", 60)
+    assert trabajo["id"] == trabajo_id and trabajo["worker"] == "w1"
+    assert database.tomar_trabajo("w2", 60) is None
+
+
+def test_bloqueo_vencido_se_reclama_y_el_dueno_anterior_ya_no_escribe():
+    trabajo_id = _encolar()
+    database.tomar_trabajo("w1", -1)  # bloqueo ya vencido: w1 "murió"
+    trabajo = database.tomar_trabajo("w2", 60)
+    assert trabajo["id"] == trabajo_id
+
+    assert not database.renovar_bloqueo_trabajo(trabajo_id, "w1", 60)
+    assert not database.guardar_progreso_trabajo(trabajo_id, "w1", {}, {}, 60)
+    assert not database.reprogramar_trabajo(trabajo_id, "w1", {}, {}, "error", 0)
+    assert not database.finalizar_trabajo(trabajo_id, "w1", "completado", {}, {})
+    assert database.obtener_trabajo(trabajo_id)["estado"] == "procesando"
+
+    assert database.finalizar_trabajo(trabajo_id, "w2", "completado", {"pdf": {"estado": "ok"}}, {"server_id": 7})
+    trabajo = database.obtener_trabajo(trabajo_id)
+    assert trabajo["estado"] == "completado" and trabajo["resultado"] == {"server_id": 7}
+
+
+def test_renovar_bloqueo_impide_que_otro_lo_tome():
+    trabajo_id = _encolar()
+    database.tomar_trabajo("w1", 0.2)
+    assert database.renovar_bloqueo_trabajo(trabajo_id, "w1", 60)
+    time.sleep(0.3)
+    assert database.tomar_trabajo("w2", 60) is None
+
+
+def test_reprogramado_vuelve_a_la_cola_despues_de_la_espera():
+    trabajo_id = _encolar()
+    database.tomar_trabajo("w1", 60)
+    assert database.reprogramar_trabajo(trabajo_id, "w1", {"sharepoint": {"estado": "pendiente"}}, {}, "429", 0.2)
+    assert database.tomar_trabajo("w2", 60) is None
+    time.sleep(0.3)
+    trabajo = database.tomar_trabajo("w2", 60)
+    assert trabajo["id"] == trabajo_id and trabajo["intentos"] == 1
+    assert trabajo["etapas"] == {"sharepoint": {"estado": "pendiente"}}
+
+
+def test_worker_que_pierde_el_trabajo_lo_abandona_sin_escribir(monkeypatch):
+    trabajo_id = _encolar()
+    trabajo = database.tomar_trabajo("w1", 60)
+
+    def etapa_lenta(payload, resultado):
+        # Mientras la etapa corre, el bloqueo vence y otro worker toma el trabajo
+        with database.transaccion() as cur:
+            cur.execute("UPDATE trabajos SET bloqueado_hasta = 0 WHERE id = ?", (trabajo_id,))
+        assert database.tomar_trabajo("w2", 60)["id"] == trabajo_id
+        return True, "PDF generado"
+
+    monkeypatch.setitem(worker_reportes._FUNCIONES_ETAPA, "pdf", etapa_lenta)
+    assert worker_reportes.procesar_trabajo(trabajo) is False
+    trabajo = database.obtener_trabajo(trabajo_id)
+    assert trabajo["estado"] == "procesando" and trabajo["etapas"] == {}
+
+
+def test_purga_solo_trabajos_terminados_y_viejos():
+    viejo, reciente, activo = _encolar(), _encolar(), _encolar()
+    for _ in (viejo, reciente):
+        trabajo = database.tomar_trabajo("w1", 60)
+        database.finalizar_trabajo(trabajo["id"], "w1", "completado", {}, {})
+    with database.transaccion() as cur:
+        cur.execute("UPDATE trabajos SET actualizado_en = 0 WHERE id IN (?, ?)", (viejo, activo))
+
+    assert database.purgar_trabajos_terminados(time.time() - 3600) == 1
+    restantes = [f[0] for f in database._consultar("SELECT id FROM trabajos ORDER BY id")]
+    assert restantes == [reciente, activo]
+
+
+def test_sondeo_y_admision_usan_indices():
+    con = database.conectar()
+    plan_tomar = con.execute("""
+        EXPLAIN QUERY PLAN SELECT id FROM trabajos
+        WHERE (estado = 'pendiente' AND proximo_intento <= 1) OR (estado = 'procesando' AND bloqueado_hasta < 1)
+    """).fetchall()
+    plan_contar = con.execute("""
+        EXPLAIN QUERY PLAN SELECT COUNT(*) FROM trabajos WHERE tipo = 'reporte' AND estado IN ('pendiente', 'procesando')
+    """).fetchall()
+    assert not any("SCAN trabajos" in fila[3] for fila in plan_tomar + plan_contar)
@@ -1,20 +1,27 @@
 import datetime
+import time
+import threading
 import pytz
-import requests
 import base64
+import hashlib
+import io
 import tempfile
 import os
 from PIL import Image, ImageDraw
 import config
+import database
+import metricas
+import graph_cliente
 
 def obtener_hora_chile():
     try:
-        return datetime.datetime.now(pytz.timezone('Chile/Continental'))
+        return datetime.datetime.now(pytz.timezone(config.ZONA_HORARIA))
     except:
         return datetime.datetime.now()
 
 # --- HELPER INTERNO PARA AUTH (Token Único) ---
-def _obtener_token_graph():
+def _solicitar_token_graph():
+    """Pide un token client-credentials a Azure AD. Retorna (token, expires_in) o (None, 0)."""
     url = f"https://login.microsoftonline.com/{config.GRAPH_TENANT_ID}/oauth2/v2.0/token"
     data = {
         'grant_type': 'client_credentials',
@@ -23,15 +30,76 @@ def _obtener_token_graph():
         'scope': 'https://graph.microsoft.com/.default'
     }
     try:
-        r = requests.post(url, data=data)
+        r = graph_cliente.cliente.post(url, endpoint="auth.token", data=data)
         js = r.json()
         if 'access_token' in js:
-            return js['access_token']
+            return js['access_token'], int(js.get('expires_in', 3599))
         print(f"Error Token: {js}")
-        return None
+        return None, 0
     except Exception as e:
         print(f"Excepción Token: {e}")
-        return None
+        return None, 0
+
+class _CacheTokenGraph:
+    """
+    Token de Graph compartido por todo el proceso. Se renueva `margen` segundos antes
+    de expirar y sólo un hilo lo pide a Azure: el resto espera ese mismo resultado.
+    """
+    def __init__(self, margen):
+        self.margen = margen
+        self._token = None
+        self._expira = 0.0
+        self._refrescando = False
+        self._cond = threading.Condition()
+
+    def _vigente(self):
+        return self._token is not None and time.time() < self._expira - self.margen
+
+    def obtener(self):
+        with self._cond:
+            while not self._vigente() and self._refrescando:
+                self._cond.wait(timeout=30)
+            if self._vigente():
+                metricas.incrementar("graph_token_hit")
+                return self._token
+            self._refrescando = True
+            metricas.incrementar("graph_token_miss")
+
+        token, expires_in = None, 0
+        try:
+            token, expires_in = _solicitar_token_graph()
+        finally:
+            with self._cond:
+                if token:
+                    self._token = token
+                    self._expira = time.time() + expires_in
+                self._refrescando = False
+                self._cond.notify_all()
+        return token
+
+    def invalidar(self, token=None):
+        """Descarta el token cacheado; con `token`, sólo si sigue siendo ése (otro hilo pudo renovarlo)."""
+        with self._cond:
+            if token is not None and token != self._token:
+                return
+            self._token = None
+            self._expira = 0.0
+
+_cache_token = _CacheTokenGraph(margen=config.GRAPH_TOKEN_MARGEN_SEGUNDOS)
+
+def _obtener_token_graph():
+    return _cache_token.obtener()
+
+def invalidar_token_graph(token=None):
+    """Descarta el token cacheado (p. ej. tras un 401 de Graph)."""
+    _cache_token.invalidar(token)
+
+def _renovar_token_graph(token_rechazado):
+    """Lo llama graph_cliente ante un 401: descarta el token rechazado y pide uno nuevo."""
+    invalidar_token_graph(token_rechazado)
+    return _obtener_token_graph()
+
+graph_cliente.cliente.renovar_token = _renovar_token_graph
 
 # --- HELPER PARA LIMPIAR NOMBRES DE CARPETAS ---
 def _sanitizar_nombre(nombre):
@@ -40,12 +108,218 @@ def _sanitizar_nombre(nombre):
         nombre = nombre.replace(char, '')
     return nombre.strip()
 
+# --- SHAREPOINT: RESOLUCIÓN DE SITIO Y BIBLIOTECA (CACHEADA) ---
+class _ResolverDriveSharePoint:
+    """
+    Cachea (site_id, drive_id) durante `ttl` segundos. Casi nunca cambian, así que
+    evitamos dos GET secuenciales a Graph por cada subida. Se invalida si la subida
+    devuelve 404/410 (biblioteca movida o borrada).
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._ids = None
+        self._expira = 0.0
+        self._lock = threading.Lock()
+
+    def _resolver(self, headers):
+        # 1. ID del Sitio (usamos el configurado; si no hay, lo buscamos por host/ruta)
+        site_id = config.SHAREPOINT_SITE_ID
+        if not site_id:
+            site_url = f"https://graph.microsoft.com/v1.0/sites/{config.SHAREPOINT_HOST_NAME}:{config.SHAREPOINT_SITE_PATH}"
+            r_site = graph_cliente.cliente.get(site_url, endpoint="sharepoint.sitio", headers=headers)
+            if r_site.status_code != 200:
+                return None, f"Error Sitio SP: {r_site.text}"
+            site_id = r_site.json()['id']
+
+        # 2. ID del Drive
+        drives_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives"
+        r_drives = graph_cliente.cliente.get(drives_url, endpoint="sharepoint.drives", headers=headers)
+        if r_drives.status_code != 200:
+            return None, f"Error Bibliotecas SP: {r_drives.text}"
+        drives = r_drives.json().get('value', [])
+        drive_id = None
+        for d in drives:
+            if d['name'] == config.SHAREPOINT_DRIVE_NAME or d['name'] in ["Documents", "Documentos"]:
+                drive_id = d['id']
+                break
+        if not drive_id and drives:
+            drive_id = drives[0]['id']
+        if not drive_id:
+            return None, "No se encontró biblioteca"
+        return (site_id, drive_id), "OK"
+
+    def obtener(self, headers):
+        """Retorna ((site_id, drive_id), mensaje) o (None, mensaje de error)."""
+        with self._lock:
+            if self._ids and time.time() < self._expira:
+                metricas.incrementar("sp_drive_cache_hit")
+                return self._ids, "OK"
+            metricas.incrementar("sp_drive_cache_miss")
+            ids, msg = self._resolver(headers)
+            if ids:
+                self._ids = ids
+                self._expira = time.time() + self.ttl
+            return ids, msg
+
+    def invalidar(self):
+        with self._lock:
+            self._ids = None
+            self._expira = 0.0
+
+_resolver_drive = _ResolverDriveSharePoint(ttl=config.SHAREPOINT_IDS_TTL_SEGUNDOS)
+
+def precalentar_graph():
+    """Obtiene token e IDs de SharePoint por adelantado (al iniciar API/worker)."""
+    token = _obtener_token_graph()
+    if not token:
+        return False, "No se pudo autenticar con Graph"
+    ids, msg = _resolver_drive.obtener({'Authorization': f'Bearer {token}'})
+    return ids is not None, msg
+
+# --- PDF: EN MEMORIA O EN DISCO ---
+# Las funciones de subida y correo aceptan la ruta del PDF o su contenido ya generado
+# (bytearray, ver pdf_generator.generar_pdf_en_memoria); así el worker no escribe ni relee el archivo.
+def _datos_pdf(ruta_pdf, contenido=None, nombre=None):
+    """Retorna (nombre, tamaño) del PDF, o (None, 0) si no hay contenido ni archivo."""
+    if contenido is not None:
+        return nombre or os.path.basename(ruta_pdf or "reporte.pdf"), len(contenido)
+    if ruta_pdf and os.path.exists(ruta_pdf):
+        return nombre or os.path.basename(ruta_pdf), os.path.getsize(ruta_pdf)
+    return None, 0
+
+class _LectorMemoria(io.RawIOBase):
+    """
+    Archivo de sólo lectura sobre un buffer (el bytearray de fpdf2) sin copiarlo entero:
+    io.BytesIO copia todo lo que no sea bytes. Cada read() copia sólo el trozo pedido.
+    """
+    def __init__(self, contenido):
+        self._vista = memoryview(contenido)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._vista)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def read(self, n=-1):
+        fin = len(self._vista) if n is None or n < 0 else min(self._pos + n, len(self._vista))
+        trozo = bytes(self._vista[self._pos:fin])
+        self._pos = max(self._pos, fin)
+        return trozo
+
+    def readinto(self, destino):
+        trozo = self.read(len(destino))
+        destino[:len(trozo)] = trozo
+        return len(trozo)
+
+    def close(self):
+        if not self.closed:
+            self._vista.release()
+        super().close()
+
+def _abrir_pdf(ruta_pdf, contenido=None):
+    """Objeto tipo file sobre el PDF: `contenido` se lee en su lugar, sin copiarlo."""
+    return _LectorMemoria(contenido) if contenido is not None else open(ruta_pdf, 'rb')
+
+# --- SHAREPOINT: SUBIDA POR SESIÓN (ARCHIVOS GRANDES) ---
+def _siguiente_byte(upload_url):
+    """Consulta la sesión y retorna el primer byte que Graph espera, o None si la sesión ya no existe."""
+    r = graph_cliente.cliente.get(upload_url, endpoint="sharepoint.sesion_estado")
+    if r.status_code != 200:
+        return None
+    rangos = r.json().get('nextExpectedRanges') or ["0-"]
+    return int(rangos[0].split('-')[0])
+
+def _sha256_archivo(ruta, tam_bloque=1024 * 1024):
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(tam_bloque), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+def _subir_por_sesion(headers, drive_id, ruta_sharepoint, ruta_local, contenido=None):
+    """
+    Sube `ruta_local` (o `contenido`) con createUploadSession en fragmentos de
+    SHAREPOINT_TAM_FRAGMENTO. La URL de la sesión queda en la BD: si el worker se cae,
+    el siguiente intento retoma desde el último rango confirmado. Desde disco sólo hay
+    un fragmento en memoria a la vez.
+    Retorna el Response final (200/201 con el driveItem) o el último error.
+    """
+    # La clave depende sólo del destino y del contenido, no de si viene de memoria o de disco:
+    # un trabajo reprogramado vuelca su PDF a disco y el reintento debe encontrar la misma sesión
+    if contenido is not None:
+        tamano = len(contenido)
+        resumen = hashlib.sha256(contenido).hexdigest()
+    else:
+        tamano = os.path.getsize(ruta_local)
+        resumen = _sha256_archivo(ruta_local)
+    clave = f"{drive_id}|{ruta_sharepoint}|{tamano}|{resumen}"
+
+    upload_url = database.obtener_sesion_subida(clave)
+    offset = _siguiente_byte(upload_url) if upload_url else None
+    if offset is None:
+        # Sin sesión previa (o expirada): creamos una nueva
+        url_sesion = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root:{ruta_sharepoint}:/createUploadSession"
+        cuerpo = {"item": {"@microsoft.graph.conflictBehavior": "replace"}}
+        r_ses = graph_cliente.cliente.post(url_sesion, endpoint="sharepoint.sesion_crear", headers=headers, json=cuerpo)
+        if r_ses.status_code != 200:
+            return r_ses
+        upload_url = r_ses.json()['uploadUrl']
+        database.guardar_sesion_subida(clave, upload_url, r_ses.json().get('expirationDateTime'))
+        offset = 0
+
+    fallos = 0
+    with _abrir_pdf(ruta_local, contenido) as f:
+        while True:
+            f.seek(offset)
+            fragmento = f.read(config.SHAREPOINT_TAM_FRAGMENTO)
+            fin = offset + len(fragmento) - 1
+            # La uploadUrl ya viene autenticada: Graph pide NO mandar Authorization aquí
+            headers_frag = {'Content-Length': str(len(fragmento)), 'Content-Range': f"bytes {offset}-{fin}/{tamano}"}
+            error = None
+            try:
+                r = graph_cliente.cliente.put(upload_url, endpoint="sharepoint.sesion_fragmento", headers=headers_frag, data=fragmento)
+            except Exception as e:
+                r, error = None, e
+                print(f"Fragmento {offset}-{fin} falló: {e}")
+
+            if r is not None and r.status_code in (200, 201):
+                database.eliminar_sesion_subida(clave)
+                return r
+            if r is not None and r.status_code == 202:
+                fallos = 0
+                rangos = r.json().get('nextExpectedRanges') or [f"{fin + 1}-"]
+                offset = int(rangos[0].split('-')[0])
+                continue
+
+            # Error (o 416 por rango ya recibido): preguntamos a Graph dónde quedó y seguimos desde ahí
+            fallos += 1
+            siguiente = _siguiente_byte(upload_url)
+            if siguiente is None:
+                database.eliminar_sesion_subida(clave)
+            if siguiente is None or fallos >= 3:
+                # Si la sesión sigue guardada, el próximo reintento del trabajo la retoma
+                if r is None: raise error
+                return r
+            offset = siguiente
+
 # --- SHAREPOINT: SUBIR ARCHIVO (Retorna URL) ---
-def subir_archivo_sharepoint(ruta_local, cliente):
+def subir_archivo_sharepoint(ruta_local, cliente, contenido=None, nombre=None):
     """
     Sube el PDF a SharePoint y retorna: (True/False, Mensaje, WebUrl)
+    Con `contenido` (bytes o bytearray) sube el PDF en memoria con el nombre `nombre`; `ruta_local` puede ser None.
     """
-    if not os.path.exists(ruta_local):
+    filename, tamano = _datos_pdf(ruta_local, contenido, nombre)
+    if not filename:
         return False, "Archivo local no existe", None
 
     token = _obtener_token_graph()
@@ -53,44 +327,33 @@ def subir_archivo_sharepoint(ruta_local, cliente):
         return False, "No se pudo autenticar con Graph", None
 
     headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
-    filename = os.path.basename(ruta_local)
     
     cliente_limpio = _sanitizar_nombre(cliente)
     fecha_carpeta = obtener_hora_chile().strftime('%Y-%m-%d')
 
     try:
-        # 1. Obtener ID del Sitio
-        site_url = f"https://graph.microsoft.com/v1.0/sites/{config.SHAREPOINT_HOST_NAME}:{config.SHAREPOINT_SITE_PATH}"
-        r_site = requests.get(site_url, headers=headers)
-        if r_site.status_code != 200:
-            return False, f"Error Sitio SP: {r_site.text}", None
-        
-        site_id = r_site.json()['id']
-
-        # 2. Obtener ID del Drive
-        drives_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives"
-        r_drives = requests.get(drives_url, headers=headers)
-        drive_id = None
-        
-        for d in r_drives.json().get('value', []):
-            if d['name'] == config.SHAREPOINT_DRIVE_NAME or d['name'] in ["Documents", "Documentos"]:
-                drive_id = d['id']
-                break
-        
-        if not drive_id and r_drives.json().get('value'):
-            drive_id = r_drives.json()['value'][0]['id']
+        # Si la biblioteca cacheada ya no existe (404/410) resolvemos de nuevo y reintentamos una vez
+        for intento in range(2):
+            ids, msg = _resolver_drive.obtener(headers)
+            if not ids:
+                return False, msg, None
+            _, drive_id = ids
 
-        if not drive_id:
-            return False, "No se encontró biblioteca", None
+            ruta_sharepoint = f"/{cliente_limpio}/{fecha_carpeta}/{filename}"
+            upload_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root:{ruta_sharepoint}:/content"
 
-        # 3. Subir Archivo
-        ruta_sharepoint = f"/{cliente_limpio}/{fecha_carpeta}/{filename}"
-        upload_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root:{ruta_sharepoint}:/content"
+            if tamano > config.SHAREPOINT_UMBRAL_SESION_BYTES:
+                r_up = _subir_por_sesion(headers, drive_id, ruta_sharepoint, ruta_local, contenido)
+            else:
+                with _abrir_pdf(ruta_local, contenido) as f_upload:
+                    headers_put = headers.copy()
+                    headers_put['Content-Type'] = 'application/pdf'
+                    r_up = graph_cliente.cliente.put(upload_url, endpoint="sharepoint.subida", headers=headers_put, data=f_upload)
 
-        with open(ruta_local, 'rb') as f_upload:
-            headers_put = headers.copy()
-            headers_put['Content-Type'] = 'application/pdf'
-            r_up = requests.put(upload_url, headers=headers_put, data=f_upload)
+            if r_up.status_code in [404, 410] and intento == 0:
+                _resolver_drive.invalidar()
+                continue
+            break
 
         if r_up.status_code in [200, 201]:
             resp = r_up.json()
@@ -103,55 +366,127 @@ def subir_archivo_sharepoint(ruta_local, cliente):
         return False, f"Excepción SP: {e}", None
 
 # --- SHAREPOINT: CREAR ITEM EN LISTA (NUEVO) ---
+def _url_items_lista():
+    return f"/sites/{config.SHAREPOINT_SITE_ID}/lists/{config.SHAREPOINT_LIST_ID}/items"
+
+def _cuerpo_item_lista(datos):
+    # Asegúrate de que los nombres de las claves ("Title", "Cliente", etc.)
+    # coincidan EXACTAMENTE con las columnas 'internal name' de tu lista SharePoint.
+    return {
+        "fields": {
+            "Title": datos['titulo'],
+            "Cliente": datos['cliente'],
+            "Tecnico": datos['tecnico'],
+            "Fecha": datos['fecha'],
+            "LinkPDF": datos['link'] 
+        }
+    }
+
 def crear_item_lista(datos):
     """
-    Crea un registro en la Lista de SharePoint.
+    Crea un registro en la Lista de SharePoint. Retorna (True/False, Mensaje, ItemId)
     datos = { 'titulo', 'cliente', 'tecnico', 'fecha', 'link' }
     """
     token = _obtener_token_graph()
-    if not token: return False, "No token"
+    if not token: return False, "No token", None
 
     # URL directa usando los IDs configurados
-    url = f"https://graph.microsoft.com/v1.0/sites/{config.SHAREPOINT_SITE_ID}/lists/{config.SHAREPOINT_LIST_ID}/items"
+    url = f"https://graph.microsoft.com/v1.0{_url_items_lista()}"
     
     headers = {
         'Authorization': f'Bearer {token}',
         'Content-Type': 'application/json'
     }
 
-    # Asegúrate de que los nombres de las claves ("Title", "Cliente", etc.)
-    # coincidan EXACTAMENTE con las columnas 'internal name' de tu lista SharePoint.
-    cuerpo = {
-        "fields": {
-            "Title": datos['titulo'],
-            "Cliente": datos['cliente'],
-            "Tecnico": datos['tecnico'],
-            "Fecha": datos['fecha'],
-            "LinkPDF": datos['link'] 
-        }
-    }
-
     try:
-        r = requests.post(url, headers=headers, json=cuerpo)
+        r = graph_cliente.cliente.post(url, endpoint="lista.crear_item", headers=headers, json=_cuerpo_item_lista(datos))
         if r.status_code == 201:
-            return True, "Item creado en lista"
+            return True, "Item creado en lista", r.json().get('id')
         else:
-            return False, f"Error Lista: {r.text}"
+            return False, f"Error Lista: {r.text}", None
     except Exception as e:
-        return False, f"Excepción Lista: {e}"
+        return False, f"Excepción Lista: {e}", None
+
+def obtener_links_lista():
+    """
+    {LinkPDF: item_id} de todos los items de la Lista, para no duplicar en el backfill.
+    Retorna None si no se pudo leer la lista completa.
+    """
+    token = _obtener_token_graph()
+    if not token: return None
+    headers = {'Authorization': f'Bearer {token}'}
+    url = f"https://graph.microsoft.com/v1.0{_url_items_lista()}?$expand=fields($select=LinkPDF)&$top=999"
+    links = {}
+    try:
+        while url:
+            r = graph_cliente.cliente.get(url, endpoint="lista.leer_items", headers=headers)
+            if r.status_code != 200:
+                print(f"⚠️ Error leyendo la Lista: {r.text}")
+                return None
+            datos = r.json()
+            for item in datos.get('value', []):
+                link = (item.get('fields') or {}).get('LinkPDF')
+                if link:
+                    links[link] = item.get('id')
+            url = datos.get('@odata.nextLink')
+    except Exception as e:
+        print(f"⚠️ Excepción leyendo la Lista: {e}")
+        return None
+    return links
+
+def crear_items_lista_lote(items):
+    """
+    Crea varios items de lista con $batch (20 por petición).
+    items = { reporte_id: datos } con el mismo formato que crear_item_lista.
+    Retorna { reporte_id: (True/False, Mensaje, ItemId) }.
+    """
+    token = _obtener_token_graph()
+    if not token: return {rid: (False, "No token", None) for rid in items}
+
+    solicitudes = [
+        {"id": rid, "method": "POST", "url": _url_items_lista(), "body": _cuerpo_item_lista(datos)}
+        for rid, datos in items.items()
+    ]
+    try:
+        respuestas = graph_cliente.cliente.lote(
+            solicitudes, headers={'Authorization': f'Bearer {token}'}, endpoint="lista.lote"
+        )
+    except Exception as e:
+        return {rid: (False, f"Excepción Lista: {e}", None) for rid in items}
+
+    resultado = {}
+    for rid in items:
+        resp = respuestas.get(str(rid), {"status": None, "body": {}})
+        if resp["status"] == 201:
+            resultado[rid] = (True, "Item creado en lista", resp["body"].get('id'))
+        else:
+            resultado[rid] = (False, f"Error Lista: {resp['status']} {resp['body']}", None)
+    return resultado
 
 # --- EMAIL (CON COPIA A TÉCNICO) ---
-def enviar_correo_graph(ruta_pdf, cliente, tecnico, email_tecnico=None):
-    if not os.path.exists(ruta_pdf): return False, "PDF no existe."
+def _preparar_correo(ruta_pdf, cliente, tecnico, email_tecnico=None, web_url=None, contenido=None, nombre=None):
+    """
+    Arma el mensaje de Graph para un reporte. Retorna (error, modo, mensaje, tamaño_pdf).
+    En modo "inline" el mensaje ya incluye el adjunto en base64.
+    """
+    nombre_pdf, tamano_pdf = _datos_pdf(ruta_pdf, contenido, nombre)
+    if not nombre_pdf: return "PDF no existe.", None, None, 0
     
-    destinatario = config.CORREOS_POR_CLIENTE.get(cliente, "")
-    if not destinatario: return False, f"No hay correo para {cliente}"
+    # Los workers corren en otro proceso: si la API actualizó el correo, está en la BD
+    destinatario = config.CORREOS_POR_CLIENTE.get(cliente) or database.obtener_correo_cliente(cliente)
+    if not destinatario: return f"No hay correo para {cliente}", None, None, 0
 
-    token = _obtener_token_graph()
-    if not token: return False, "Error Auth Azure"
+    if tamano_pdf <= config.CORREO_UMBRAL_ADJUNTO_BYTES:
+        modo = "inline"
+    elif config.CORREO_MODO_ADJUNTO_GRANDE == "enlace" and web_url:
+        modo = "enlace"
+    else:
+        modo = "sesion"
 
-    with open(ruta_pdf, "rb") as f:
-        pdf_content = base64.b64encode(f.read()).decode("utf-8")
+    if modo == "enlace":
+        nota_adjunto = f'📎 El informe completo está disponible en: <a href="{web_url}" style="color: {config.COLOR_PRIMARIO};">descargar PDF</a>.'
+    else:
+        nota_adjunto = "📎 El informe completo se encuentra adjunto en formato PDF."
     
     # --- DISEÑO DE CORREO MEJORADO ---
     color = config.COLOR_PRIMARIO
@@ -192,7 +527,7 @@ def enviar_correo_graph(ruta_pdf, cliente, tecnico, email_tecnico=None):
                                 </table>
 
                                 <p style="text-align: center; font-size: 14px; color: #888; margin-top: 30px;">
-                                    📎 El informe completo se encuentra adjunto en formato PDF.
+                                    {nota_adjunto}
                                 </p>
                             </td>
                         </tr>
@@ -221,33 +556,201 @@ def enviar_correo_graph(ruta_pdf, cliente, tecnico, email_tecnico=None):
     if email_tecnico:
         cc_destinatarios.append({"emailAddress": {"address": email_tecnico}})
 
-    email_data = {
-        "message": {
-            "subject": f"📍 Reporte Visita - {cliente}",
-            "body": {"contentType": "HTML", "content": html_body},
-            "toRecipients": destinatarios,
-            "ccRecipients": cc_destinatarios, # Agregamos copia aquí
-            "attachments": [{
-                "@odata.type": "#microsoft.graph.fileAttachment",
-                "name": os.path.basename(ruta_pdf),
-                "contentType": "application/pdf",
-                "contentBytes": pdf_content
-            }]
-        },
-        "saveToSentItems": "true"
+    mensaje = {
+        "subject": f"📍 Reporte Visita - {cliente}",
+        "body": {"contentType": "HTML", "content": html_body},
+        "toRecipients": destinatarios,
+        "ccRecipients": cc_destinatarios, # Agregamos copia aquí
     }
 
+    if modo == "inline":
+        # Sólo bajo el umbral: el base64 + la copia JSON quedan acotados en memoria
+        if contenido is None:
+            with open(ruta_pdf, "rb") as f:
+                contenido = f.read()
+        pdf_content = base64.b64encode(contenido).decode("utf-8")
+        mensaje["attachments"] = [{
+            "@odata.type": "#microsoft.graph.fileAttachment",
+            "name": nombre_pdf,
+            "contentType": "application/pdf",
+            "contentBytes": pdf_content
+        }]
+    return None, modo, mensaje, tamano_pdf
+
+def enviar_correo_graph(ruta_pdf, cliente, tecnico, email_tecnico=None, web_url=None, contenido=None, nombre=None):
+    """
+    Envía el reporte al cliente (con copia al técnico). Según el tamaño del PDF:
+    - Hasta CORREO_UMBRAL_ADJUNTO_BYTES: adjunto inline en sendMail (como siempre).
+    - Más grande: borrador + upload session del adjunto por fragmentos, o sólo el
+      link de SharePoint si CORREO_MODO_ADJUNTO_GRANDE = "enlace" y tenemos `web_url`.
+    Con `contenido` (bytes o bytearray) adjunta el PDF en memoria en vez de leer `ruta_pdf`.
+    """
+    error, modo, mensaje, tamano_pdf = _preparar_correo(ruta_pdf, cliente, tecnico, email_tecnico, web_url, contenido, nombre)
+    if error: return False, error
+
+    token = _obtener_token_graph()
+    if not token: return False, "Error Auth Azure"
+
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+
     try:
-        r = requests.post(
+        if modo == "sesion":
+            nombre_pdf, _ = _datos_pdf(ruta_pdf, contenido, nombre)
+            return _enviar_correo_con_sesion(headers, mensaje, ruta_pdf, tamano_pdf, contenido, nombre_pdf)
+
+        r = graph_cliente.cliente.post(
             f"https://graph.microsoft.com/v1.0/users/{config.GRAPH_USER_EMAIL}/sendMail",
-            headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'},
-            json=email_data
+            endpoint="correo.enviar",
+            headers=headers,
+            json={"message": mensaje, "saveToSentItems": "true"}
         )
-        if r.status_code == 202: return True, "Correo enviado"
+        if r.status_code == 202: return True, "Correo enviado" if modo == "inline" else "Correo enviado (con link)"
         return False, f"Error Email: {r.text}"
     except Exception as e:
         return False, f"Excepción Email: {e}"
 
+def _enviar_correo_con_sesion(headers, mensaje, ruta_pdf, tamano_pdf, contenido=None, nombre_pdf=None):
+    """Borrador -> createUploadSession del adjunto -> fragmentos (disco o memoria) -> send."""
+    base = f"https://graph.microsoft.com/v1.0/users/{config.GRAPH_USER_EMAIL}/messages"
+    r_draft = graph_cliente.cliente.post(base, endpoint="correo.borrador", headers=headers, json=mensaje)
+    if r_draft.status_code != 201:
+        return False, f"Error borrador Email: {r_draft.text}"
+    mensaje_id = r_draft.json()['id']
+
+    cuerpo_sesion = {"AttachmentItem": {
+        "attachmentType": "file",
+        "name": nombre_pdf or os.path.basename(ruta_pdf),
+        "size": tamano_pdf,
+        "contentType": "application/pdf"
+    }}
+    r_ses = graph_cliente.cliente.post(f"{base}/{mensaje_id}/attachments/createUploadSession",
+                                       endpoint="correo.adjunto_sesion", headers=headers, json=cuerpo_sesion)
+    if r_ses.status_code != 201:
+        return False, f"Error sesión adjunto: {r_ses.text}"
+    upload_url = r_ses.json()['uploadUrl']
+
+    offset = 0
+    with _abrir_pdf(ruta_pdf, contenido) as f:
+        while offset < tamano_pdf:
+            fragmento = f.read(config.CORREO_TAM_FRAGMENTO)
+            fin = offset + len(fragmento) - 1
+            r = graph_cliente.cliente.put(upload_url, endpoint="correo.adjunto_fragmento", data=fragmento, headers={
+                'Content-Length': str(len(fragmento)),
+                'Content-Range': f"bytes {offset}-{fin}/{tamano_pdf}",
+                'Content-Type': 'application/octet-stream'
+            })
+            if r.status_code not in (200, 201):
+                return False, f"Error subiendo adjunto: {r.status_code}"
+            offset = fin + 1
+
+    r_send = graph_cliente.cliente.post(f"{base}/{mensaje_id}/send", endpoint="correo.enviar_borrador", headers=headers)
+    if r_send.status_code == 202: return True, "Correo enviado (adjunto por sesión)"
+    return False, f"Error Email: {r_send.text}"
+
+def enviar_correos_lote(envios):
+    """
+    Envía varios reportes con $batch. envios = { reporte_id: {ruta_pdf, cliente, tecnico,
+    email_tecnico, web_url} }. Los PDFs que no caben inline se envían uno a uno.
+    Retorna { reporte_id: (True/False, Mensaje) }.
+    """
+    resultado = {}
+    token = _obtener_token_graph()
+    if not token: return {rid: (False, "Error Auth Azure") for rid in envios}
+
+    solicitudes = []
+    for rid, e in envios.items():
+        error, modo, mensaje, _ = _preparar_correo(
+            e['ruta_pdf'], e['cliente'], e['tecnico'], e.get('email_tecnico'), e.get('web_url')
+        )
+        if error:
+            resultado[rid] = (False, error)
+        elif modo == "sesion":
+            resultado[rid] = enviar_correo_graph(
+                e['ruta_pdf'], e['cliente'], e['tecnico'], e.get('email_tecnico'), e.get('web_url')
+            )
+        else:
+            solicitudes.append({
+                "id": rid, "method": "POST",
+                "url": f"/users/{config.GRAPH_USER_EMAIL}/sendMail",
+                "body": {"message": mensaje, "saveToSentItems": "true"}
+            })
+    if not solicitudes:
+        return resultado
+
+    # Los sendMail llevan el PDF en base64: agrupamos por tamaño acumulado para no pasar
+    # el límite de una petición $batch (además del máximo de 20 sub-requests).
+    grupos, actual, bytes_actual = [], [], 0
+    for sol in solicitudes:
+        peso = sum(len(a.get("contentBytes", "")) for a in sol["body"]["message"].get("attachments", []))
+        if actual and (len(actual) >= graph_cliente.TAM_LOTE or bytes_actual + peso > config.CORREO_MAX_BYTES_LOTE):
+            grupos.append(actual)
+            actual, bytes_actual = [], 0
+        actual.append(sol)
+        bytes_actual += peso
+    if actual:
+        grupos.append(actual)
+
+    headers = {'Authorization': f'Bearer {token}'}
+    for grupo in grupos:
+        try:
+            respuestas = graph_cliente.cliente.lote(grupo, headers=headers, endpoint="correo.lote")
+        except Exception as ex:
+            for sol in grupo: resultado[sol["id"]] = (False, f"Excepción Email: {ex}")
+            continue
+        for sol in grupo:
+            resp = respuestas.get(str(sol["id"]), {"status": None, "body": {}})
+            if resp["status"] == 202:
+                resultado[sol["id"]] = (True, "Correo enviado")
+            else:
+                resultado[sol["id"]] = (False, f"Error Email: {resp['status']} {resp['body']}")
+    return resultado
+
+# --- FIRMAS VECTORIALES (TRAZOS) ---
+def _distancia_a_segmento(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return ((p[0] - a[0]) ** 2 + (p[1] - a[1]) ** 2) ** 0.5
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)))
+    return ((p[0] - a[0] - t * dx) ** 2 + (p[1] - a[1] - t * dy) ** 2) ** 0.5
+
+def simplificar_trazo(puntos, tolerancia):
+    """Douglas-Peucker (iterativo, sin recursión): quita puntos a menos de `tolerancia` de la recta."""
+    if len(puntos) < 3:
+        return list(puntos)
+    conservar = [False] * len(puntos)
+    conservar[0] = conservar[-1] = True
+    pila = [(0, len(puntos) - 1)]
+    while pila:
+        ini, fin = pila.pop()
+        max_dist, idx = 0.0, None
+        for i in range(ini + 1, fin):
+            d = _distancia_a_segmento(puntos[i], puntos[ini], puntos[fin])
+            if d > max_dist:
+                max_dist, idx = d, i
+        if idx is not None and max_dist > tolerancia:
+            conservar[idx] = True
+            pila.append((ini, idx))
+            pila.append((idx, fin))
+    return [p for p, ok in zip(puntos, conservar) if ok]
+
+def normalizar_trazos(trazos, tolerancia=None):
+    """
+    Convierte los trazos de una firma a [[[x, y], ...], ...] simplificados y redondeados.
+    Cada trazo puede venir como lista de pares [[x, y], ...] o plano [x0, y0, x1, y1, ...].
+    Lanza ValueError/TypeError si el formato no es válido.
+    """
+    tolerancia = config.FIRMA_TOLERANCIA_PX if tolerancia is None else tolerancia
+    resultado = []
+    for trazo in trazos:
+        if trazo and not isinstance(trazo[0], (list, tuple)):
+            if len(trazo) % 2:
+                raise ValueError("Trazo plano con cantidad impar de coordenadas")
+            trazo = list(zip(trazo[0::2], trazo[1::2]))
+        puntos = [(float(x), float(y)) for x, y in trazo]
+        if puntos:
+            resultado.append([[round(x, 1), round(y, 1)] for x, y in simplificar_trazo(puntos, tolerancia)])
+    return resultado
+
 def guardar_firma_img(trazos, nombre_archivo="firma_temp.png"):
     if not trazos: return None
     temp_dir = tempfile.gettempdir()
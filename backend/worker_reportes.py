@@ -0,0 +1,382 @@
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import utils
+import pdf_generator
+import almacen
+import metricas
+import ejecutores
+import config
+
+TIPO_REPORTE = "reporte"
+
+# Orden del pipeline. Cada etapa guarda su estado en trabajos.etapas,
+# así un reintento salta directo a la que falló.
+ETAPAS = ["pdf", "sharepoint", "lista", "email", "registro"]
+
+# Etapas que se ejecutan en paralelo: la subida a SharePoint y el correo no dependen
+# una de otra (la lista sí necesita el webUrl de SharePoint). En modo "enlace" el correo
+# de un PDF grande lleva el webUrl, así que va después de SharePoint.
+if config.CORREO_MODO_ADJUNTO_GRANDE == "enlace":
+    GRUPOS_ETAPAS = [["pdf"], ["sharepoint"], ["lista", "email"], ["registro"]]
+else:
+    GRUPOS_ETAPAS = [["pdf"], ["sharepoint", "email"], ["lista"], ["registro"]]
+
+# Hilos para las llamadas a Graph de un mismo grupo (son I/O, el GIL se libera)
+_ejecutor_etapas = ThreadPoolExecutor(max_workers=2, thread_name_prefix="etapa")
+
+# PDFs generados en memoria por este proceso, por carpeta de trabajo: {carpeta: (nombre, bytearray)}.
+# SharePoint y el correo leen el mismo buffer; sólo se escribe a disco si el trabajo se
+# reprograma (para que el reintento use el mismo documento) o al archivarlo.
+_pdfs_en_memoria = {}
+# SharePoint y el correo corren en hilos paralelos: sin este lock ambos podrían regenerar
+# el PDF a la vez (y con minutos distintos en el nombre, dos documentos diferentes).
+_lock_pdfs = threading.Lock()
+
+
+# --- ETAPAS DEL PIPELINE ---
+# Cada etapa recibe el payload del trabajo y el dict `resultado` acumulado,
+# lo actualiza y retorna (ok, mensaje).
+
+def _etapa_pdf(payload, resultado):
+    stats = {}
+    nombre, contenido = pdf_generator.generar_pdf_en_memoria(
+        cliente=payload['cliente'],
+        tecnico=payload['tecnico'],
+        obs=payload['obs'],
+        path_firma=None,
+        datos_usuarios=payload['usuarios'],
+        estadisticas=stats
+    )
+    if not contenido:
+        return False, "No se generó el PDF"
+    _pdfs_en_memoria[payload['carpeta']] = (nombre, contenido)
+    metricas.observar("pdf_render_ms", stats['ms'])
+    metricas.observar("pdf_paginas", stats['paginas'])
+    metricas.observar("pdf_bytes", stats['bytes'])
+    # Queda en el resultado del trabajo: la API (otro proceso) lo agrega en /sistema/metricas
+    resultado['pdf_stats'] = stats
+    resultado['pdf_nombre'] = nombre
+    resultado['pdf_path'] = None
+    return True, "PDF generado"
+
+def _pdf_del_trabajo(payload, resultado):
+    """
+    Retorna (ruta, contenido, nombre) del PDF: el buffer en memoria si este proceso lo
+    generó, si no el volcado en la carpeta del trabajo. Si el worker que lo generó murió
+    sin volcarlo, se vuelve a generar (una sola vez, aunque lo pidan dos etapas a la vez).
+    """
+    with _lock_pdfs:
+        en_memoria = _pdfs_en_memoria.get(payload['carpeta'])
+        if en_memoria:
+            return None, en_memoria[1], en_memoria[0]
+        ruta = resultado.get('pdf_path')
+        if ruta and os.path.exists(ruta):
+            return ruta, None, os.path.basename(ruta)
+        _etapa_pdf(payload, resultado)
+        nombre, contenido = _pdfs_en_memoria[payload['carpeta']]
+        return None, contenido, nombre
+
+def _volcar_pdf(payload, resultado):
+    """Escribe el PDF en memoria a la carpeta del trabajo (antes de reprogramarlo)."""
+    with _lock_pdfs:
+        en_memoria = _pdfs_en_memoria.pop(payload['carpeta'], None)
+    if not en_memoria:
+        return
+    nombre, contenido = en_memoria
+    ruta = os.path.join(payload['carpeta'], nombre)
+    with open(ruta, "wb") as f:
+        f.write(contenido)
+    resultado['pdf_path'] = ruta
+
+def _etapa_sharepoint(payload, resultado):
+    ruta, contenido, nombre = _pdf_del_trabajo(payload, resultado)
+    ok_sp, msg_sp, web_url = utils.subir_archivo_sharepoint(ruta, payload['cliente'], contenido=contenido, nombre=nombre)
+    resultado['msg_sp'] = msg_sp
+    resultado['web_url'] = web_url
+    return ok_sp, msg_sp
+
+# La lista y el correo de un trabajo nuevo van como llamadas individuales, no por $batch:
+# cada etapa guarda su propio estado e intentos en trabajos.etapas y un worker procesa un
+# trabajo a la vez, así que juntar varios trabajos obligaría a compartir reintentos entre
+# ellos. El $batch (graph_cliente.ClienteGraph.lote) se usa donde sí hay muchos pendientes
+# juntos: el reenvío de correos (reenvio.py) y el backfill de la lista (backfill_lista.py).
+
+def _etapa_lista(payload, resultado):
+    if not resultado.get('web_url'):
+        resultado['msg_lista'] = "Lista omitida (sin URL)"
+        return True, resultado['msg_lista']
+    datos_lista = {
+        "titulo": f"Visita {payload['cliente']} - {payload['tecnico']}",
+        "cliente": payload['cliente'],
+        "tecnico": payload['tecnico'],
+        "fecha": payload['fecha_lista'],
+        "link": resultado['web_url']
+    }
+    ok_lista, msg_lista, item_id = utils.crear_item_lista(datos_lista)
+    resultado['msg_lista'] = msg_lista
+    resultado['sp_item_id'] = item_id
+    return ok_lista, msg_lista
+
+def _etapa_email(payload, resultado):
+    ruta, contenido, nombre = _pdf_del_trabajo(payload, resultado)
+    ok_email, msg_email = utils.enviar_correo_graph(
+        ruta, payload['cliente'], payload['tecnico'], payload.get('email_tecnico'),
+        web_url=resultado.get('web_url'), contenido=contenido, nombre=nombre
+    )
+    resultado['ok_email'] = ok_email
+    resultado['msg_email'] = msg_email
+    return ok_email, msg_email
+
+def _archivar_pdf(payload, resultado):
+    """Guarda el PDF en almacenamiento durable (la carpeta del trabajo se borra al terminar)."""
+    ruta, contenido, nombre = _pdf_del_trabajo(payload, resultado)
+    destino = os.path.join(config.PDF_ARCHIVO_FOLDER, f"{os.path.basename(payload['carpeta'])}_{nombre}")
+    if contenido is not None:
+        with open(destino, "wb") as f:
+            f.write(contenido)
+    else:
+        shutil.copyfile(ruta, destino)
+    return destino
+
+def _etapa_registro(payload, resultado):
+    pdf_path = None
+    if config.ARCHIVAR_PDF or not resultado.get('ok_email'):
+        # El reenvío (reenvio.py) necesitará el PDF cuando este trabajo ya no exista
+        pdf_path = _archivar_pdf(payload, resultado)
+    server_id = database.guardar_reporte(
+        fecha=payload['fecha'],
+        cliente=payload['cliente'],
+        tecnico=payload['tecnico'],
+        obs=payload['obs'],
+        fotos_json=json.dumps(payload['rutas_fotos']),
+        pdf_path=pdf_path,
+        detalles_json=json.dumps(payload['usuarios']),
+        estado_envio=1 if resultado.get('ok_email') else 0,
+        sp_web_url=resultado.get('web_url'),
+        sp_item_id=resultado.get('sp_item_id'),
+        email_tecnico=payload.get('email_tecnico'),
+        lat=payload.get('latitud') or "",
+        lon=payload.get('longitud') or ""
+    )
+    if not resultado.get('ok_email'):
+        database.registrar_intento_email(server_id, False, resultado.get('msg_email'), time.time() + config.REENVIO_ESPERA_BASE)
+    resultado['server_id'] = server_id
+    return True, f"Reporte guardado (id {server_id})"
+
+_FUNCIONES_ETAPA = {
+    "pdf": _etapa_pdf,
+    "sharepoint": _etapa_sharepoint,
+    "lista": _etapa_lista,
+    "email": _etapa_email,
+    "registro": _etapa_registro,
+}
+
+# Sin PDF no hay nada que subir ni enviar: si esta etapa se agota, el trabajo termina ahí.
+_ETAPAS_CRITICAS = {"pdf"}
+
+
+# --- EJECUCIÓN DE UN TRABAJO ---
+
+def _ejecutar_etapa(nombre, payload, resultado):
+    inicio = time.time()
+    try:
+        ok, msg = _FUNCIONES_ETAPA[nombre](payload, resultado)
+    except Exception as e:
+        ok, msg = False, f"Excepción {nombre}: {e}"
+    return ok, msg, round(time.time() - inicio, 3)
+
+def _iniciar_latido(trabajo_id, worker):
+    """
+    Renueva el bloqueo del trabajo cada BLOQUEO_TRABAJO_SEGUNDOS / 3 mientras corre: una etapa
+    de Graph (reintentos + Retry-After) puede durar más que el bloqueo, y sin esto otro worker
+    tomaría el trabajo y repetiría la subida y el correo.
+    Retorna (detener, perdido): `perdido` se activa si el trabajo dejó de ser nuestro.
+    """
+    detener, perdido = threading.Event(), threading.Event()
+
+    def latir():
+        try:
+            while not detener.wait(config.BLOQUEO_TRABAJO_SEGUNDOS / 3):
+                try:
+                    if not database.renovar_bloqueo_trabajo(trabajo_id, worker, config.BLOQUEO_TRABAJO_SEGUNDOS):
+                        perdido.set()
+                        return
+                except Exception as e:
+                    print(f"⚠️ Trabajo {trabajo_id}: no se pudo renovar el bloqueo ({e})")
+        finally:
+            database.cerrar_conexion()
+
+    threading.Thread(target=latir, name=f"latido-{trabajo_id}", daemon=True).start()
+    return detener, perdido
+
+def procesar_trabajo(trabajo):
+    """
+    Ejecuta las etapas pendientes de un trabajo, grupo por grupo. Si una etapa falla y
+    le quedan intentos, el trabajo se reprograma con backoff exponencial; si se agotan,
+    la etapa queda 'fallida' y se continúa con la siguiente (igual que el flujo síncrono
+    original, donde un error de SharePoint no impedía enviar el correo).
+    Si el trabajo pasa a otro worker (bloqueo perdido) se abandona sin escribir nada.
+    """
+    detener, perdido = _iniciar_latido(trabajo['id'], trabajo['worker'])
+    try:
+        return _procesar_etapas(trabajo, perdido)
+    finally:
+        detener.set()
+
+def _abandonar(trabajo_id):
+    print(f"⚠️ Trabajo {trabajo_id}: lo tomó otro worker (bloqueo perdido), se abandona")
+    return False
+
+def _procesar_etapas(trabajo, perdido):
+    trabajo_id = trabajo['id']
+    worker = trabajo['worker']
+    payload = trabajo['payload']
+    etapas = trabajo['etapas']
+    resultado = trabajo['resultado']
+
+    for grupo in GRUPOS_ETAPAS:
+        if perdido.is_set():
+            return _abandonar(trabajo_id)
+        pendientes = []
+        for nombre in grupo:
+            estado_etapa = etapas.setdefault(nombre, {"estado": "pendiente", "intentos": 0, "error": None})
+            if estado_etapa['estado'] not in ("ok", "fallida", "omitida"):
+                pendientes.append(nombre)
+        if not pendientes:
+            continue
+
+        if len(pendientes) == 1:
+            salidas = {pendientes[0]: _ejecutar_etapa(pendientes[0], payload, resultado)}
+        else:
+            futuros = {n: _ejecutor_etapas.submit(_ejecutar_etapa, n, payload, resultado) for n in pendientes}
+            salidas = {n: f.result() for n, f in futuros.items()}
+
+        espera_reintento = None
+        critica_fallida = False
+        for nombre in pendientes:
+            ok, msg, duracion = salidas[nombre]
+            estado_etapa = etapas[nombre]
+            estado_etapa['intentos'] += 1
+            estado_etapa['duracion'] = duracion
+            if ok:
+                estado_etapa['estado'] = "ok"
+                estado_etapa['error'] = None
+                continue
+
+            estado_etapa['error'] = msg
+            if estado_etapa['intentos'] < config.MAX_INTENTOS_ETAPA:
+                espera = config.ESPERA_BASE_REINTENTO * (2 ** (estado_etapa['intentos'] - 1))
+                print(f"⚠️ Trabajo {trabajo_id}: etapa '{nombre}' falló ({msg}). Reintento en {espera:.0f}s")
+                espera_reintento = espera if espera_reintento is None else min(espera_reintento, espera)
+            else:
+                print(f"❌ Trabajo {trabajo_id}: etapa '{nombre}' agotó sus intentos ({msg})")
+                estado_etapa['estado'] = "fallida"
+                critica_fallida = critica_fallida or nombre in _ETAPAS_CRITICAS
+
+        if espera_reintento is not None:
+            _volcar_pdf(payload, resultado)
+            error = "; ".join(etapas[n]['error'] for n in pendientes if etapas[n]['error'])
+            if not database.reprogramar_trabajo(trabajo_id, worker, etapas, resultado, error, espera_reintento):
+                return _abandonar(trabajo_id)
+            return False
+        if not database.guardar_progreso_trabajo(trabajo_id, worker, etapas, resultado, config.BLOQUEO_TRABAJO_SEGUNDOS):
+            return _abandonar(trabajo_id)
+        if critica_fallida:
+            for restante in ETAPAS:
+                etapas.setdefault(restante, {"estado": "omitida", "intentos": 0, "error": None})
+            break
+
+    fallidas = [n for n in ETAPAS if etapas.get(n, {}).get('estado') == "fallida"]
+    estado_final = "completado_con_errores" if fallidas else "completado"
+    error = "; ".join(etapas[n]['error'] for n in fallidas) if fallidas else None
+    if not database.finalizar_trabajo(trabajo_id, worker, estado_final, etapas, resultado, error):
+        # El nuevo dueño todavía necesita la carpeta y las subidas: no se limpia
+        return _abandonar(trabajo_id)
+    _limpiar_trabajo(payload)
+    print(f"✅ Trabajo {trabajo_id} {estado_final}")
+    return True
+
+def _limpiar_trabajo(payload):
+    """Suelta las referencias a las subidas del almacén y borra la carpeta del trabajo."""
+    _pdfs_en_memoria.pop(payload.get('carpeta'), None)
+    almacen.liberar(payload.get('blobs', []))
+    carpeta = payload.get('carpeta')
+    if carpeta and os.path.isdir(carpeta):
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+
+# --- LOOP DEL WORKER ---
+
+def _purgar_trabajos():
+    try:
+        borrados = database.purgar_trabajos_terminados(time.time() - config.TRABAJOS_RETENCION_SEGUNDOS)
+        if borrados:
+            print(f"🧹 {borrados} trabajos terminados purgados")
+    except Exception as e:
+        print(f"Error purgando trabajos: {e}")
+
+def ejecutar_worker(nombre=None, intervalo=1.0):
+    nombre = nombre or f"{socket.gethostname()}:{os.getpid()}"
+    print(f"👷 Worker de reportes '{nombre}' iniciado")
+    try:
+        print(f"🔥 Renderizador PDF precalentado en {pdf_generator.precalentar()} ms")
+    except Exception as e:
+        print(f"⚠️ No se pudo precalentar el renderizador: {e}")
+    if config.PRECALENTAR_GRAPH:
+        ok, msg = utils.precalentar_graph()
+        print(f"🔥 Precalentado Graph: {msg}")
+    proxima_purga = 0.0
+    while True:
+        try:
+            trabajo = database.tomar_trabajo(nombre, config.BLOQUEO_TRABAJO_SEGUNDOS)
+        except Exception as e:
+            print(f"Error tomando trabajo: {e}")
+            trabajo = None
+        if not trabajo:
+            if time.monotonic() >= proxima_purga:
+                proxima_purga = time.monotonic() + config.TRABAJOS_PURGA_INTERVALO
+                _purgar_trabajos()
+            time.sleep(intervalo)
+            continue
+        try:
+            procesar_trabajo(trabajo)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            _volcar_pdf(trabajo['payload'], trabajo['resultado'])
+            database.reprogramar_trabajo(
+                trabajo['id'], nombre, trabajo['etapas'], trabajo['resultado'], str(e), config.ESPERA_BASE_REINTENTO
+            )
+
+def iniciar_workers(cantidad):
+    """
+    Lanza `cantidad` procesos worker en segundo plano. Retorna la lista de procesos.
+    Salen del forkserver (ver ejecutores.contexto_procesos), no de un fork de la API con
+    sus hilos y conexiones abiertas: cada worker importa los módulos y abre su propia BD.
+    """
+    contexto = ejecutores.contexto_procesos()
+    procesos = []
+    for i in range(cantidad):
+        p = contexto.Process(target=ejecutar_worker, name=f"worker-reportes-{i}", daemon=True)
+        p.start()
+        procesos.append(p)
+    return procesos
+
+def detener_workers(procesos):
+    for p in procesos:
+        if p.is_alive():
+            p.terminate()
+    for p in procesos:
+        p.join(timeout=5)
+
+
+if __name__ == "__main__":
+    database.inicializar_db()
+    ejecutar_worker()
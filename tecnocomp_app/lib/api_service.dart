@@ -96,6 +96,9 @@ class ApiService {
       String baseUrl = await _getBaseUrl();
       var uri = Uri.parse('$baseUrl/reporte/crear');
       var request = http.MultipartRequest('POST', uri);
+      // Misma clave en cada reintento de este reporte: el servidor no lo procesa dos veces
+      request.headers['Idempotency-Key'] = base64Url.encode(utf8.encode(
+          '${reporte['tecnico']}|${reporte['id']}|${reporte['fecha_creacion']}'));
 
       request.fields['cliente'] = reporte['cliente'];
       request.fields['tecnico'] = reporte['tecnico'];
@@ -114,12 +117,14 @@ class ApiService {
              if (File(pathFoto).existsSync()) request.files.add(await http.MultipartFile.fromPath('fotos', pathFoto));
           }
         }
-        if (u['firma'] != null && File(u['firma']).existsSync()) {
+        // Con trazos el servidor dibuja la firma como vector; el PNG sólo se sube en reportes antiguos
+        if (u['firma'] != null && u['firma_trazos'] == null && File(u['firma']).existsSync()) {
              request.files.add(await http.MultipartFile.fromPath('firmas_usuarios', u['firma']));
         }
       }
       var response = await request.send();
-      return response.statusCode == 200;
+      // 202: el servidor encoló el reporte y lo procesa en segundo plano
+      return response.statusCode == 200 || response.statusCode == 202;
     } catch (e) { return false; }
   }
 
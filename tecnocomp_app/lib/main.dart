@@ -1142,6 +1142,17 @@ class _FormularioVisitaState extends State<FormularioVisita> {
     }
   }
 
+  // Trazos de la firma, cada uno plano [x0, y0, x1, y1, ...] en coordenadas del lienzo.
+  // El servidor los dibuja como vector en el PDF: no hace falta subir el PNG.
+  List<List<double>> _trazosFirma(List<Point> puntos) {
+    final trazos = <List<double>>[];
+    for (final p in puntos) {
+      if (p.type == PointType.tap || trazos.isEmpty) trazos.add(<double>[]);
+      trazos.last..add(p.offset.dx)..add(p.offset.dy);
+    }
+    return trazos;
+  }
+
   void _abrirFirma(int index) {
     if (widget.soloLectura) return;
     
@@ -1180,7 +1191,11 @@ class _FormularioVisitaState extends State<FormularioVisita> {
                 final directory = await getApplicationDocumentsDirectory();
                 final String path = '${directory.path}/firma_${DateTime.now().millisecondsSinceEpoch}.png';
                 await File(path).writeAsBytes(data);
-                setState(() => _usuarios[index]['firma'] = path);
+                setState(() {
+                  _usuarios[index]['firma'] = path;
+                  _usuarios[index]['firma_trazos'] = _trazosFirma(_controller.points);
+                  _usuarios[index]['firma_lienzo'] = [signatureWidth, signatureHeight];
+                });
                 Navigator.pop(context);
               }
             }